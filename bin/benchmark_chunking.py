@@ -0,0 +1,129 @@
+# Benchmarks ai_chunking.plan_chunks against the previous quadratic chunking implementation.
+"""
+Chunking benchmark.
+
+Builds synthetic Discord-like messages and times the linear chunk planner in
+src/ai_chunking.py against the legacy implementation that re-encoded the whole
+growing group for every message. The planner is given the legacy budget
+(MAX_TOKENS of the context length, no prompt) and the groups and counts are
+compared, so the benchmark also doubles as an equivalence check. The planner
+runs with its default token estimates, so its token total is an estimate.
+
+Usage:
+    python bin/benchmark_chunking.py                      # 1k, 5k and 50k messages
+    python bin/benchmark_chunking.py --sizes 1000 5000
+    python bin/benchmark_chunking.py --legacy-max 50000   # also time the legacy chunker on 50k (slow!)
+
+The legacy chunker is skipped above --legacy-max messages (default 5000) as it
+takes minutes on large inputs.
+"""
+
+import argparse
+import os
+import random
+import sys
+import time
+from types import SimpleNamespace
+
+sys.path.append(os.path.abspath(os.path.join(os.path.dirname(__file__), '..', 'src')))
+
+from ai_chunking import plan_chunks, get_tokens  # noqa: E402
+from constants import MAX_TOKENS, MODELS  # noqa: E402
+
+WORDS = ("the robot arm needs a new servo before friday can someone check the cad "
+         "files for the intake we are still waiting on the encoder wiring lol "
+         "https://tenor.com/view/happy-dance-gif-12345 :thumbsup: ok sounds good").split()
+AUTHORS = ["alice", "Bob the Builder", "carol_dev", "Dave (mentor)", "eve"]
+
+
+def make_messages(count, seed=42):
+    rng = random.Random(seed)
+    messages = []
+    for i in range(count):
+        content = " ".join(rng.choice(WORDS) for _ in range(rng.randint(3, 60)))
+        messages.append(SimpleNamespace(id=i,
+                                        author=SimpleNamespace(display_name=rng.choice(AUTHORS)),
+                                        content=content))
+    return messages
+
+
+def legacy_chunk_messages_by_model_token_limit(messages, model):
+    """The pre-linear implementation, kept here as the reference for equivalence and timing."""
+    next_group = True
+    groups = []
+    group_counts = []
+    starts = []
+    curr_group = ""
+    curr_count = 0
+    in_token_count = 0
+
+    for message in messages:
+        if next_group:
+            starts.append(message)
+            next_group = False
+
+        author_name = getattr(getattr(message, 'author', None), 'display_name', None)
+        content = getattr(message, 'content', None)
+
+        if not author_name or not content:
+            continue
+
+        m = f"{author_name}: {content}\n"
+
+        if get_tokens(curr_group + m, model["name"]) > (MAX_TOKENS * model["context_length"]):
+            in_token_count += get_tokens(curr_group, model["name"])
+            groups.append(curr_group)
+            group_counts.append(curr_count)
+            curr_group = ""
+            curr_count = 0
+            next_group = True
+
+        curr_group += m
+        curr_count += 1
+
+    starts.append(message)
+    groups.append(curr_group)
+    group_counts.append(curr_count)
+    in_token_count += get_tokens(curr_group, model["name"])
+
+    return groups, group_counts, starts, in_token_count
+
+
+def timed(func, *args):
+    started = time.perf_counter()
+    result = func(*args)
+    return result, time.perf_counter() - started
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--sizes", type=int, nargs="+", default=[1000, 5000, 50000])
+    parser.add_argument("--model", default="GPT-3.5 Turbo", choices=list(MODELS.keys()),
+                        help="Smaller context models produce more groups")
+    parser.add_argument("--legacy-max", type=int, default=5000)
+    args = parser.parse_args()
+
+    model = MODELS[args.model]
+    print(f"Model: {model['name']} (context {model['context_length']})")
+    print(f"{'messages':>10} {'groups':>7} {'tokens':>10} {'linear s':>10} {'legacy s':>10} {'speedup':>9}")
+
+    for size in args.sizes:
+        messages = make_messages(size)
+        legacy_reserve = model["context_length"] * (1 - MAX_TOKENS)
+        result, linear_seconds = timed(plan_chunks, messages, model, 0, legacy_reserve)
+        groups, group_counts, _, in_token_count = result
+
+        legacy_seconds = None
+        if size <= args.legacy_max:
+            legacy_result, legacy_seconds = timed(legacy_chunk_messages_by_model_token_limit, messages, model)
+            legacy_groups, legacy_counts, _, _ = legacy_result
+            assert (legacy_groups, legacy_counts) == (groups, group_counts), \
+                f"Chunk planner differs from legacy chunker for {size} messages"
+
+        legacy_column = f"{legacy_seconds:10.3f}" if legacy_seconds is not None else f"{'skipped':>10}"
+        speedup_column = f"{legacy_seconds / linear_seconds:8.1f}x" if legacy_seconds is not None else f"{'-':>9}"
+        print(f"{size:>10} {len(groups):>7} {in_token_count:>10} {linear_seconds:10.3f} {legacy_column} {speedup_column}")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,81 @@
+# Calibrates the character/byte token estimator in src/ai_chunking.py against the real tokenizers.
+"""
+Token estimator calibration.
+
+Fits the (tokens per character, tokens per extra UTF-8 byte) coefficients of
+ai_chunking.estimate_tokens for each encoding by least squares, then measures
+how far the estimates fall from the exact counts. The printed tuples go into
+TOKEN_ESTIMATES in src/constants.py.
+
+Usage:
+    python bin/calibrate_token_estimator.py messages.txt      # one message per line, e.g. exported chat
+    python bin/calibrate_token_estimator.py                   # synthetic messages from benchmark_chunking.py
+
+The relative error bound is chosen so every sample falls within
+relative_error * estimate + absolute_error of its estimate.
+"""
+
+import argparse
+import math
+import os
+import sys
+
+sys.path.append(os.path.abspath(os.path.join(os.path.dirname(__file__), '..', 'src')))
+
+from tiktoken import get_encoding  # noqa: E402
+
+from ai_chunking import format_message_line  # noqa: E402
+from benchmark_chunking import make_messages  # noqa: E402
+
+ENCODINGS = ["cl100k_base", "o200k_base"]
+
+
+def fit(samples):
+    """Least squares fit of tokens = a * chars + b * extra_bytes, without an intercept."""
+    sxx = sum(c * c for c, _, _ in samples)
+    sxy = sum(c * e for c, e, _ in samples)
+    syy = sum(e * e for _, e, _ in samples)
+    sxt = sum(c * t for c, _, t in samples)
+    syt = sum(e * t for _, e, t in samples)
+    determinant = sxx * syy - sxy * sxy
+    if determinant == 0:
+        # Pure ASCII samples: there is no extra byte term to fit
+        return sxt / sxx, 0.0
+    return (sxt * syy - syt * sxy) / determinant, (syt * sxx - sxt * sxy) / determinant
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("messages_file", nargs="?")
+    parser.add_argument("--absolute-error", type=int, default=4)
+    args = parser.parse_args()
+
+    if args.messages_file:
+        with open(args.messages_file, encoding="utf-8") as file:
+            lines = [line.rstrip("\n") + "\n" for line in file if line.strip()]
+    else:
+        lines = [format_message_line(message) for message in make_messages(5000)]
+
+    for encoding_name in ENCODINGS:
+        encoding = get_encoding(encoding_name)
+        samples = []
+        for line in lines:
+            chars = len(line)
+            extra_bytes = len(line.encode("utf-8")) - chars
+            samples.append((chars, extra_bytes, len(encoding.encode(line, disallowed_special=()))))
+
+        per_char, per_extra_byte = fit(samples)
+        relative_error = 0.0
+        for chars, extra_bytes, tokens in samples:
+            estimate = round(per_char * chars + per_extra_byte * extra_bytes)
+            miss = abs(tokens - estimate) - args.absolute_error
+            if miss > 0 and estimate > 0:
+                relative_error = max(relative_error, miss / estimate)
+
+        relative_error = math.ceil(relative_error * 100) / 100
+        print(f'"{encoding_name}": ({per_char:.2f}, {per_extra_byte:.2f}, {relative_error:.2f}, {args.absolute_error}),'
+              f'  # {len(samples)} samples')
+
+
+if __name__ == "__main__":
+    main()
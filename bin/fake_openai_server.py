@@ -0,0 +1,210 @@
+# A deterministic stand-in for the OpenAI chat completions API, for offline load testing of the summarization pipeline.
+"""
+Fake OpenAI server.
+
+Speaks the chat completions protocol used by OpenAISummarizer and Summary.summarize,
+streamed or not, with configurable latency, tokens-per-second streaming, injected
+429 and 5xx responses and OpenAI's rate-limit headers, backed by request and token
+buckets refilled per minute like OpenAI's limits.
+
+Every outcome (latency, injected error, answer) is drawn from a random generator
+seeded with --seed, the request's content and how many times that content was
+seen, so a run is reproducible whatever the order requests arrive in, and a
+retried request can succeed where the first attempt got a 429.
+
+Usage:
+    python bin/fake_openai_server.py --port 8090 --latency lognormal --latency-median 0.8 --rate-429 0.05
+    OPENAI_BASE_URL=http://localhost:8090/v1 OPENAI_API_KEY=fake python src/main.py
+
+GET /stats returns the counts of requests and of each kind of response.
+"""
+
+import argparse
+import hashlib
+import json
+import math
+import random
+import threading
+import time
+from collections import Counter
+
+from flask import Flask, Response, jsonify, request
+
+app = Flask(__name__)
+options = None
+stats = Counter()
+seen = Counter()
+lock = threading.Lock()
+
+
+class Bucket:
+    """A bucket of capacity `limit`, refilled at `limit` per minute."""
+
+    def __init__(self, limit):
+        self.limit = limit
+        self.available = float(limit)
+        self.updated = time.monotonic()
+
+    def refill(self):
+        now = time.monotonic()
+        self.available = min(self.limit, self.available + (now - self.updated) * self.limit / 60)
+        self.updated = now
+
+    def take(self, amount):
+        self.refill()
+        if self.available < amount:
+            return False
+        self.available -= amount
+        return True
+
+    def reset_after(self):
+        """Seconds until the bucket is full again."""
+        return (self.limit - self.available) * 60 / self.limit
+
+
+requests_bucket = None
+tokens_bucket = None
+
+
+def count_tokens(text):
+    return max(1, math.ceil(len(text) / 4))
+
+
+def duration(seconds):
+    return f"{max(1, round(seconds * 1000))}ms"
+
+
+def rate_limit_headers():
+    return {
+        "x-ratelimit-limit-requests": str(options.rpm),
+        "x-ratelimit-remaining-requests": str(int(requests_bucket.available)),
+        "x-ratelimit-reset-requests": duration(requests_bucket.reset_after()),
+        "x-ratelimit-limit-tokens": str(options.tpm),
+        "x-ratelimit-remaining-tokens": str(int(tokens_bucket.available)),
+        "x-ratelimit-reset-tokens": duration(tokens_bucket.reset_after()),
+    }
+
+
+def request_random(body):
+    content = json.dumps(body.get("messages", []), sort_keys=True)
+    with lock:
+        seen[content] += 1
+        attempt = seen[content]
+    digest = hashlib.sha256(f"{options.seed}:{attempt}:{content}".encode("utf-8")).digest()
+    return random.Random(int.from_bytes(digest[:8], "big"))
+
+
+def draw_latency(rng):
+    if options.latency == "fixed":
+        return options.latency_median
+    if options.latency == "uniform":
+        return rng.uniform(0, 2 * options.latency_median)
+    return options.latency_median * math.exp(rng.gauss(0, options.latency_sigma))
+
+
+def answer(rng, prompt, max_tokens):
+    """A summary made of words of the prompt, --output-tokens long unless max_tokens cuts it."""
+    words = prompt.split() or ["nothing"]
+    length = options.output_tokens
+    finish_reason = "stop"
+    if max_tokens is not None and max_tokens < length:
+        length = max_tokens
+        finish_reason = "length"
+    return ["Summary:"] + [rng.choice(words) for _ in range(length - 1)], finish_reason
+
+
+def error(status, message, kind, headers=None):
+    stats[str(status)] += 1
+    response = jsonify({"error": {"message": message, "type": kind, "param": None, "code": None}})
+    response.status_code = status
+    response.headers.update(headers or {})
+    return response
+
+
+@app.route("/v1/chat/completions", methods=["POST"])
+def chat_completions():
+    body = request.get_json()
+    stats["requests"] += 1
+    rng = request_random(body)
+    model = body.get("model", "gpt-4o")
+    prompt = "\n".join(str(message.get("content", "")) for message in body.get("messages", []))
+    prompt_tokens = count_tokens(prompt)
+
+    # Errors come back right away, as OpenAI's do
+    with lock:
+        within_limits = requests_bucket.take(1) and tokens_bucket.take(prompt_tokens)
+        headers = rate_limit_headers()
+    if not within_limits or rng.random() < options.rate_429:
+        headers["retry-after-ms"] = str(options.retry_after_ms)
+        return error(429, "Rate limit reached (fake server)", "requests", headers)
+    if rng.random() < options.rate_5xx:
+        return error(rng.choice([500, 502, 503]), "The server had an error (fake server)", "server_error")
+
+    time.sleep(draw_latency(rng))
+    words, finish_reason = answer(rng, prompt, body.get("max_tokens") or body.get("max_completion_tokens"))
+    completion_id = f"chatcmpl-fake{rng.getrandbits(48):012x}"
+    created = int(time.time())
+    usage = {"prompt_tokens": prompt_tokens, "completion_tokens": len(words), "total_tokens": prompt_tokens + len(words)}
+    stats["200"] += 1
+
+    if not body.get("stream"):
+        time.sleep(len(words) / options.tokens_per_second)
+        return jsonify({
+            "id": completion_id,
+            "object": "chat.completion",
+            "created": created,
+            "model": model,
+            "choices": [{"index": 0,
+                         "message": {"role": "assistant", "content": " ".join(words)},
+                         "finish_reason": finish_reason}],
+            "usage": usage,
+        }), 200, headers
+
+    def chunk(delta, reason=None):
+        return "data: " + json.dumps({
+            "id": completion_id,
+            "object": "chat.completion.chunk",
+            "created": created,
+            "model": model,
+            "choices": [{"index": 0, "delta": delta, "finish_reason": reason}],
+        }) + "\n\n"
+
+    def stream():
+        yield chunk({"role": "assistant", "content": ""})
+        for i, word in enumerate(words):
+            time.sleep(1 / options.tokens_per_second)
+            yield chunk({"content": word if i == 0 else " " + word})
+        yield chunk({}, finish_reason)
+        yield "data: [DONE]\n\n"
+
+    return Response(stream(), mimetype="text/event-stream", headers=headers)
+
+
+@app.route("/stats", methods=["GET"])
+def get_stats():
+    return jsonify(dict(stats))
+
+
+def parse_args(argv=None):
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--port", type=int, default=8090)
+    parser.add_argument("--seed", type=int, default=0)
+    parser.add_argument("--latency", choices=["fixed", "uniform", "lognormal"], default="lognormal",
+                        help="distribution of the time to the first token")
+    parser.add_argument("--latency-median", type=float, default=0.8, help="seconds")
+    parser.add_argument("--latency-sigma", type=float, default=0.5, help="spread of the lognormal distribution")
+    parser.add_argument("--tokens-per-second", type=float, default=80)
+    parser.add_argument("--output-tokens", type=int, default=200, help="length of a summary")
+    parser.add_argument("--rate-429", type=float, default=0.0, help="share of requests answered with an injected 429")
+    parser.add_argument("--rate-5xx", type=float, default=0.0, help="share of requests answered with a 500, 502 or 503")
+    parser.add_argument("--retry-after-ms", type=int, default=500)
+    parser.add_argument("--rpm", type=int, default=5000, help="requests per minute before 429s")
+    parser.add_argument("--tpm", type=int, default=800000, help="tokens per minute before 429s")
+    return parser.parse_args(argv)
+
+
+if __name__ == "__main__":
+    options = parse_args()
+    requests_bucket = Bucket(options.rpm)
+    tokens_bucket = Bucket(options.tpm)
+    app.run(host="127.0.0.1", port=options.port, threaded=True)
@@ -1,99 +1,371 @@
-from constants import MAX_TOKENS
-from tiktoken import encoding_for_model
+from constants import MODELS, OUTPUT_TOKEN_RESERVE, TOKEN_COUNT_CACHE_SIZE, TOKENIZE_BATCH_SIZE, TOKENIZER_THREADS, TOKEN_ESTIMATES
+from tiktoken import encoding_for_model, encoding_name_for_model, get_encoding
+from cachetools import LRUCache
+from concurrent.futures import ThreadPoolExecutor
+from functools import partial
+import asyncio
+import hashlib
 import logging 
+import threading
 
-TOKENIZER = encoding_for_model("gpt-3.5-turbo")
-def get_tokens(text):
-     return len(TOKENIZER.encode(text))
+# Used when no model is given, e.g. for counting output tokens. Matches the default model in MODELS.
+DEFAULT_TOKENIZER_MODEL = list(MODELS.values())[0]["name"]
+FALLBACK_ENCODING = "o200k_base"
 
-def chunk_messages(prior_messages, recent_channel_messages, max_tokens=30000, assumed_token_length=50, chunk_size=1000):
-        """
-        Chunk messages for summarization.
+_tokenizers = {}
+_token_counts = LRUCache(maxsize=TOKEN_COUNT_CACHE_SIZE)
+_lock = threading.Lock()
+_tokenizer_pool = ThreadPoolExecutor(max_workers=TOKENIZER_THREADS, thread_name_prefix="tokenizer")
 
-        Args:
-            prior_messages (list): List of prior messages for context.
-            recent_channel_messages (list): List of recent messages to summarize.
-            max_tokens (int): Maximum tokens for OpenAI API.
-            assumed_token_length (int): Assumed average token length.
-            chunk_size (int): Size of each chunk.
 
-        Returns:
-            list: List of message chunks.
-        """
-        logging.info("Chunking for summarization")
-        logging.debug(f"Length for prior messages: {len(prior_messages)}")
-        budget_for_chunk = max_tokens - len(prior_messages) * assumed_token_length
-        logging.debug(f"Budget for chunk: {budget_for_chunk}")
+def get_tokenizer(model_name=DEFAULT_TOKENIZER_MODEL):
+    """
+    Returns the tiktoken encoding for a model, loading it on first use.
+
+    Args:
+        model_name (str): The OpenAI model name, as in MODELS[...]["name"].
+
+    Returns:
+        tiktoken.Encoding: The encoding used by that model.
+    """
+    tokenizer = _tokenizers.get(model_name)
+    if tokenizer is None:
+        with _lock:
+            tokenizer = _tokenizers.get(model_name)
+            if tokenizer is None:
+                try:
+                    tokenizer = encoding_for_model(model_name)
+                except KeyError:
+                    logging.warning(f"No tokenizer known for {model_name}, using {FALLBACK_ENCODING}")
+                    tokenizer = get_encoding(FALLBACK_ENCODING)
+                logging.debug(f"Loaded tokenizer {tokenizer.name} for {model_name}")
+                _tokenizers[model_name] = tokenizer
+    return tokenizer
+
+
+def get_tokens(text, model_name=DEFAULT_TOKENIZER_MODEL):
+    return len(get_tokenizer(model_name).encode(text, disallowed_special=()))
+
+
+def _token_count_key(tokenizer, text):
+    return (tokenizer.name, hashlib.blake2b(text.encode("utf-8"), digest_size=16).digest())
+
+
+def get_message_tokens(text, model_name=DEFAULT_TOKENIZER_MODEL):
+    """
+    Counts the tokens of a single message, memoized by a hash of its content.
+
+    Repeated summaries of the same channel see the same messages again, so the
+    counts are kept in a bounded LRU keyed by encoding and content digest.
+
+    Args:
+        text (str): The message text.
+        model_name (str): The OpenAI model name the count is for.
+
+    Returns:
+        int: The number of tokens in the text.
+    """
+    tokenizer = get_tokenizer(model_name)
+    key = _token_count_key(tokenizer, text)
+    with _lock:
+        count = _token_counts.get(key)
+    if count is None:
+        count = len(tokenizer.encode(text, disallowed_special=()))
+        with _lock:
+            _token_counts[key] = count
+    return count
+
+
+def get_message_tokens_batch(texts, model_name=DEFAULT_TOKENIZER_MODEL):
+    """
+    Counts the tokens of many messages, encoding the ones not already memoized in batches.
+
+    Batches of TOKENIZE_BATCH_SIZE are handed to the tokenizer's batch encode,
+    which spreads them over TOKENIZER_THREADS native threads.
 
-        if budget_for_chunk < 0:
-            logging.error("Prior messages exceed token limit. Truncating.")
-            prior_messages = prior_messages[:int(max_tokens / assumed_token_length)]
-            budget_for_chunk = 0
+    Args:
+        texts (list): The message texts.
+        model_name (str): The OpenAI model name the counts are for.
 
-        chunks = []
-        for i in range(0, len(recent_channel_messages), chunk_size):
-            chunks.append(recent_channel_messages[i:i + chunk_size])
+    Returns:
+        list: The number of tokens in each text, in the same order.
+    """
+    tokenizer = get_tokenizer(model_name)
+    keys = [_token_count_key(tokenizer, text) for text in texts]
+    with _lock:
+        counts = [_token_counts.get(key) for key in keys]
+
+    missing = [i for i, count in enumerate(counts) if count is None]
+    for batch_start in range(0, len(missing), TOKENIZE_BATCH_SIZE):
+        batch = missing[batch_start:batch_start + TOKENIZE_BATCH_SIZE]
+        encoded = tokenizer.encode_batch([texts[i] for i in batch], num_threads=TOKENIZER_THREADS, disallowed_special=())
+        with _lock:
+            for i, tokens in zip(batch, encoded):
+                counts[i] = len(tokens)
+                _token_counts[keys[i]] = counts[i]
+
+    logging.debug(f"Tokenized {len(missing)} of {len(texts)} messages, the rest were memoized")
+    return counts
+
+
+def stored_token_count(message, encoding_name):
+    """
+    Returns the tokens of a message's `format_message_line` counted when it was stored, see message_store.py.
+
+    Args:
+        message (discord.Message or StoredMessage): The message.
+        encoding_name (str): The tiktoken encoding the count is for.
+
+    Returns:
+        int or None: The count, None if the message wasn't counted with that encoding.
+    """
+    if getattr(message, "encoding", None) == encoding_name:
+        return message.tokens
+    return None
+
+
+def get_encoding_name(model_name=DEFAULT_TOKENIZER_MODEL):
+    try:
+        return encoding_name_for_model(model_name)
+    except KeyError:
+        return FALLBACK_ENCODING
+
+
+def estimate_tokens(text, encoding_name=FALLBACK_ENCODING):
+    """
+    Estimates the tokens of a message from its character and byte counts, without tokenizing it.
+
+    The coefficients and error bound for each encoding are in TOKEN_ESTIMATES
+    (see bin/calibrate_token_estimator.py). A BPE token is never shorter than
+    one byte, so the UTF-8 length also caps the upper bound.
+
+    Args:
+        text (str): The message text.
+        encoding_name (str): The tiktoken encoding name, see `get_encoding_name`.
+
+    Returns:
+        tuple: (low, estimate, high) where the exact count lies between low and high.
+    """
+    per_char, per_extra_byte, relative_error, absolute_error = TOKEN_ESTIMATES.get(encoding_name, TOKEN_ESTIMATES[FALLBACK_ENCODING])
+    chars = len(text)
+    byte_count = len(text.encode("utf-8"))
+    estimate = round(per_char * chars + per_extra_byte * (byte_count - chars))
+    margin = relative_error * estimate + absolute_error
+    return max(0, int(estimate - margin)), estimate, min(byte_count, int(estimate + margin) + 1)
 
-        logging.debug(f"Number of chunks: {len(chunks)}")
-        return chunks
 
-# This is an Arun's implementation of chunking messages for OpenAI API.
-def chunk_messages_by_model_token_limit(messages, model):
+async def off_event_loop(func, *args, **kwargs):
     """
-    Groups messages into chunks based on the token limit of the model.
+    Runs a tokenizing function in the tokenizer thread pool, so large histories don't stall the event loop.
 
     Args:
-        messages (list): List of messages to be grouped.
-        model (dict): Model information containing the context length.
+        func (callable): The function to run, e.g. `plan_chunks` or `trim_to_token_budget`.
+        *args: Positional arguments for the function.
+        **kwargs: Keyword arguments for the function.
+
+    Returns:
+        The function's return value.
+    """
+    loop = asyncio.get_running_loop()
+    return await loop.run_in_executor(_tokenizer_pool, partial(func, *args, **kwargs))
+
+
+def input_token_budget(model, fixed_tokens=0, reserved_output_tokens=None):
+    """
+    Computes how many tokens of messages fit in one request to the model.
+
+    Args:
+        model (dict): Model information containing the name and context length.
+        fixed_tokens (int): Tokens sent with every chunk: system prompt, prompt template and prior context.
+        reserved_output_tokens (int, optional): Tokens kept free for the answer.
+            Defaults to OUTPUT_TOKEN_RESERVE, capped at a quarter of the context length.
+
+    Returns:
+        int: The number of message tokens available per chunk.
+    """
+    if reserved_output_tokens is None:
+        reserved_output_tokens = min(OUTPUT_TOKEN_RESERVE, model["context_length"] // 4)
+    return model["context_length"] - reserved_output_tokens - fixed_tokens
+
+
+def plan_chunks(messages, model, fixed_tokens=0, reserved_output_tokens=None, exact_counts=False, lines=None):
+    """
+    Plans the chunks a list of messages is summarized in, using as few chunks as the model allows.
+
+    Each chunk is budgeted against the real cost of a request: the fixed tokens
+    sent with every chunk (prompt template and prior context) and an allowance
+    reserved for the output are taken off the model's context length, and
+    messages are packed greedily into the remainder. Packing contiguous
+    messages greedily gives the minimum number of chunks.
+
+    Token counts start as estimates with a known error bound (`estimate_tokens`).
+    A message is only tokenized when the bounds can't tell whether it fits in
+    the current chunk; the chunk's lines are then counted exactly, in a batch.
+    Messages read from the message store come with their exact count.
+    Chunks far from the budget, which is every chunk of a typical summary,
+    never touch the tokenizer, yet the chunks are the same as with exact counts.
+    The running total of the current chunk is kept as a sum, so the work is
+    linear in the number of messages. Lines always end in a newline, which the
+    tokenizer never merges with the following line, so the per-line counts add
+    up to the count of the chunk. Call it through `off_event_loop` from async code.
+
+    Args:
+        messages (list): Discord messages, or already formatted message strings, in chronological order.
+        model (dict): Model information containing the name and context length.
+        fixed_tokens (int): Tokens sent with every chunk besides the messages.
+        reserved_output_tokens (int, optional): Tokens kept free for the answer, see `input_token_budget`.
+        exact_counts (bool): Tokenize every message so in_token_count is exact rather than estimated.
+        lines (list, optional): Prompt lines aligned with `messages`, e.g. from `MessageCompactor.compact`,
+            used instead of formatting the messages. None entries are skipped.
 
     Returns:
         tuple: A tuple containing:
             - groups (list): List of grouped messages as strings.
             - group_counts (list): List of counts of messages in each group.
-            - starts (list): List of starting messages for each group.
-            - in_token_count (int): Total number of input tokens.
+            - starts (list): The first message of each group, followed by the last message.
+            - in_token_count (int): Total number of input tokens, counting the fixed tokens once per group.
+              Estimated for chunks that were never close to the budget, unless exact_counts is set.
     """
-    next_group = True
+    model_name = model.get("name", DEFAULT_TOKENIZER_MODEL)
+    budget = input_token_budget(model, fixed_tokens, reserved_output_tokens)
+    logging.debug(f"Chunk budget for {model_name}: {budget} tokens ({fixed_tokens} fixed)")
+    if budget <= 0:
+        raise ValueError(f"Prompt and context ({fixed_tokens} tokens) leave no room for messages in {model_name}")
+
+    counted = lines is None  # the lines are those whose tokens the message store counted
+    if lines is None:
+        lines = [format_message_line(message) for message in messages]
+    else:
+        lines = [format_message_line(line) if line is not None else None for line in lines]
+
+    lines = [(message, m) for message, m in zip(messages, lines) if m is not None]
+    logging.debug(f"Skipped {len(messages) - len(lines)} incomplete or repeated messages")
+    texts = [m for _, m in lines]
+
+    encoding_name = get_encoding_name(model_name)
+    if exact_counts:
+        bounds = [(count, count, count) for count in get_message_tokens_batch(texts, model_name)]
+    else:
+        bounds = [estimate_tokens(m, encoding_name) for m in texts]
+    exact = [exact_counts] * len(texts)
+    if counted and not exact_counts:
+        for i, (message, _) in enumerate(lines):
+            count = stored_token_count(message, encoding_name)
+            if count is not None:
+                bounds[i] = (count, count, count)
+                exact[i] = True
+
+    def count_exactly(indexes):
+        indexes = [i for i in indexes if not exact[i]]
+        for i, count in zip(indexes, get_message_tokens_batch([texts[i] for i in indexes], model_name)):
+            if not bounds[i][0] <= count <= bounds[i][2]:
+                logging.warning(f"Token estimate {bounds[i]} missed the exact count {count}, check TOKEN_ESTIMATES")
+            bounds[i] = (count, count, count)
+            exact[i] = True
+
     groups = []
     group_counts = []
     starts = []
-    curr_group = ""
-    curr_count = 0
-    in_token_count = 0
+    curr = []
+    curr_low = curr_estimate = curr_high = 0
+    message_tokens = 0
+    last = None
 
-    for message in messages:
-        if next_group:
-            starts.append(message)
-            next_group = False
+    for i, (message, m) in enumerate(lines):
+        low, estimate, high = bounds[i]
+
+        if curr and curr_high + high > budget and curr_low + low <= budget:
+            # Too close to call on the estimates
+            count_exactly(curr + [i])
+            curr_low = curr_estimate = curr_high = sum(bounds[j][1] for j in curr)
+            low, estimate, high = bounds[i]
 
-        author_name = getattr(getattr(message, 'author', None), 'display_name', None)
-        content = getattr(message, 'content', None)
+        if low > budget:
+            logging.warning(f"Message of at least {low} tokens exceeds the chunk budget of {budget} tokens")
 
-        if not author_name or not content:
-            logging.debug(f"Skipping incomplete message: {message}")
-            continue  
+        if curr and curr_low + low > budget:
+            groups.append("".join(texts[j] for j in curr))
+            group_counts.append(len(curr))
+            message_tokens += curr_estimate
+            curr = []
+            curr_low = curr_estimate = curr_high = 0
 
-        m = f"{author_name}: {content}\n"
+        if not curr:
+            starts.append(message)
+        curr.append(i)
+        curr_low += low
+        curr_estimate += estimate
+        curr_high += high
+        last = message
 
-        if get_tokens(curr_group + m) > (MAX_TOKENS * model["context_length"]):
-            in_token_count += get_tokens(curr_group)
-            groups.append(curr_group)
-            group_counts.append(curr_count)
-            curr_group = ""
-            curr_count = 0
-            next_group = True
+    if curr:
+        groups.append("".join(texts[j] for j in curr))
+        group_counts.append(len(curr))
+        message_tokens += curr_estimate
+        starts.append(last)
 
-        curr_group += m
-        curr_count += 1
+    logging.debug(f"Tokenized {sum(exact)} of {len(texts)} messages exactly")
 
-    starts.append(message)
-    groups.append(curr_group)
-    group_counts.append(curr_count)
-    in_token_count += get_tokens(curr_group)
+    in_token_count = message_tokens + fixed_tokens * len(groups)
 
     logging.debug(f"Number of groups: {len(groups)}")
     logging.debug(f"Number of messages: {len(messages)}")
     logging.debug(f"Total tokens: {in_token_count}")
-    
 
-    return groups, group_counts, starts, in_token_count
\ No newline at end of file
+    return groups, group_counts, starts, in_token_count
+
+
+def trim_to_token_budget(lines, budget, model_name=DEFAULT_TOKENIZER_MODEL):
+    """
+    Keeps the most recent lines that fit in a token budget.
+
+    Args:
+        lines (list): Message strings in chronological order.
+        budget (int): The maximum number of tokens to keep.
+        model_name (str): The OpenAI model name the count is for.
+
+    Returns:
+        list: The trailing lines that fit in the budget, in chronological order.
+    """
+    encoding_name = get_encoding_name(model_name)
+    bounds = [estimate_tokens(line + "\n", encoding_name) for line in lines]
+    if sum(high for _, _, high in bounds) <= budget:
+        return lines
+
+    # Only the lines around the cut need counting exactly; count from the newest back in batches
+    kept = []
+    total = 0
+    for batch_end in range(len(lines), 0, -TOKENIZE_BATCH_SIZE):
+        batch = lines[max(0, batch_end - TOKENIZE_BATCH_SIZE):batch_end]
+        token_counts = get_message_tokens_batch([line + "\n" for line in batch], model_name)
+        for line, tokens in zip(reversed(batch), reversed(token_counts)):
+            if total + tokens > budget:
+                logging.info(f"Trimmed {len(lines) - len(kept)} of {len(lines)} lines to fit {budget} tokens")
+                kept.reverse()
+                return kept
+            kept.append(line)
+            total += tokens
+    kept.reverse()
+    return kept
+
+
+def format_message_line(message):
+    """
+    Formats a Discord message as a single `author: content` line for the prompt.
+
+    Args:
+        message (discord.Message or str): The message to format. Strings are taken as already formatted.
+
+    Returns:
+        str or None: The formatted line ending in a newline, or None if the message has no author name or content.
+    """
+    if isinstance(message, str):
+        return message + "\n" if message else None
+
+    author_name = getattr(getattr(message, 'author', None), 'display_name', None)
+    content = getattr(message, 'content', None)
+
+    if not author_name or not content:
+        return None
+
+    return f"{author_name}: {content}\n"
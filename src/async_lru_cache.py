@@ -1,18 +1,43 @@
 # Type: Source Code
-# Description: The code snippet defines an asynchronous least recently used (LRU) cache class that stores key-value pairs. 
-# The cache has a maximum size, and when the cache exceeds this size, the least recently used item is removed. 
+# Description: The code snippet defines an asynchronous least recently used (LRU) cache class that stores key-value pairs.
+# The cache is bounded by the total size of its values in bytes, and when it exceeds this size, the least recently used items are removed.
+# Values are strings, stored UTF-8 encoded and optionally zlib-compressed. Keys should be fixed-size digests (see summary_cache.cache_key).
 # The class provides methods to get and set values in the cache asynchronously.
 
+import logging
+import zlib
+
 from cachetools import LRUCache
 
+ENTRY_OVERHEAD_BYTES = 200  # key digest, cache bookkeeping and bytes object header
+
+
 class AsyncLRUCache:
-    def __init__(self, maxsize=100):
-        self.cache = LRUCache(maxsize=maxsize)
+    def __init__(self, max_bytes=1024 * 1024, compress=False):
+        self.cache = LRUCache(maxsize=max_bytes, getsizeof=lambda value: len(value) + ENTRY_OVERHEAD_BYTES)
+        self.compress = compress
 
     async def get(self, key):
-        return self.cache.get(key)
+        value = self.cache.get(key)
+        if value is None:
+            return None
+        if self.compress:
+            value = zlib.decompress(value)
+        return value.decode("utf-8")
 
     async def set(self, key, value):
-        self.cache[key] = value
-        if len(self.cache) > self.cache.maxsize:
-            self.cache.popitem()
+        if value is None:
+            return
+        value = value.encode("utf-8")
+        if self.compress:
+            value = zlib.compress(value)
+        try:
+            # LRUCache evicts the least recently used values until this one fits
+            self.cache[key] = value
+        except ValueError:
+            logging.debug(f"Value of {len(value)} bytes is too large for the cache")
+
+    @property
+    def currsize(self):
+        """The bytes the cache holds."""
+        return self.cache.currsize
@@ -0,0 +1,196 @@
+# Description: This file contains the batch execution mode used for catch-up jobs, which are not latency-sensitive.
+#  While `batch_requests` is set, `OpenAISummarizer` collects the summaries missing from the caches instead of calling
+#  OpenAI, and answers them with a pending placeholder. `OpenAISummarizer.summarize_in_batches` submits the collected
+#  requests as one batch job through a backend, waits for it, caches the results and runs the jobs again, until every
+#  summary, merges included, comes from the cache.
+#  `OpenAIBatchBackend` uses the OpenAI Batch API, `LocalBatchBackend` is a file-based stand-in for tests and development.
+
+import asyncio
+import contextvars
+import json
+import logging
+import os
+import uuid
+
+from constants import BATCH_DIR, BATCH_POLL_INTERVAL, BATCH_COMPLETION_WINDOW
+from openai_clients import openai_client
+
+# The requests collected for a batch job by key, None when summaries are made right away
+batch_requests = contextvars.ContextVar("batch_requests", default=None)
+
+PENDING = "<pending batch summary {}>"
+ENDPOINT = "/v1/chat/completions"
+DONE_STATUSES = ("completed", "failed", "expired", "cancelled")
+
+
+def pending_summary(key):
+    return PENDING.format(key)
+
+
+def is_pending(text):
+    """Whether a text contains a summary a batch job has yet to make, so it can't be sent or cached yet."""
+    return PENDING.split("{")[0] in text
+
+
+def batch_input(requests, model, max_tokens=None):
+    """
+    Formats requests as the JSONL input of a batch job.
+
+    Args:
+        requests (dict): The prompts by key, the key being the custom_id of the request.
+        model (str): The OpenAI model name.
+        max_tokens (dict, optional): The output tokens allowed to each request by key, unlimited if missing.
+
+    Returns:
+        str: One request per line.
+    """
+    lines = []
+    for key, prompt in requests.items():
+        body = {"model": model, "messages": [{"role": "assistant", "content": prompt}]}
+        if max_tokens and max_tokens.get(key):
+            body["max_tokens"] = max_tokens[key]
+        lines.append(json.dumps({"custom_id": key, "method": "POST", "url": ENDPOINT, "body": body}) + "\n")
+    return "".join(lines)
+
+
+def batch_output(text):
+    """
+    Parses the JSONL output of a batch job.
+
+    Args:
+        text (str): The output file's content.
+
+    Returns:
+        dict: The summary of each successful request by its custom_id.
+    """
+    summaries = {}
+    for line in text.splitlines():
+        if not line.strip():
+            continue
+        result = json.loads(line)
+        response = result.get("response") or {}
+        if response.get("status_code") == 200:
+            summaries[result["custom_id"]] = response["body"]["choices"][0]["message"]["content"]
+        else:
+            logging.warning(f"Batch request {result.get('custom_id')} failed: {result.get('error') or response}")
+    return summaries
+
+
+async def wait_for_batch(backend, batch_id, poll_interval=BATCH_POLL_INTERVAL):
+    """
+    Waits for a batch job to be done.
+
+    Args:
+        backend (OpenAIBatchBackend | LocalBatchBackend): The backend the job was submitted to.
+        batch_id (str): The job's ID.
+        poll_interval (float): Seconds between two checks.
+
+    Returns:
+        dict: The summary of each successful request by its custom_id.
+    """
+    while True:
+        status = await backend.status(batch_id)
+        if status in DONE_STATUSES:
+            break
+        logging.debug(f"Batch {batch_id} is {status}")
+        await asyncio.sleep(poll_interval)
+
+    if status != "completed":
+        raise RuntimeError(f"Batch {batch_id} is {status}")
+    return await backend.results(batch_id)
+
+
+class OpenAIBatchBackend:
+    def __init__(self, api_key, completion_window=BATCH_COMPLETION_WINDOW):
+        self.api_key = api_key
+        self.completion_window = completion_window
+        self.output_files = {}
+
+    async def submit(self, requests, model, max_tokens=None):
+        """
+        Submits requests as one batch job.
+
+        Args:
+            requests (dict): The prompts by key.
+            model (str): The OpenAI model name.
+            max_tokens (dict, optional): The output tokens allowed to each request by key.
+
+        Returns:
+            str: The job's ID.
+        """
+        async with openai_client(self.api_key) as client:
+            input_file = await client.files.create(file=("batch.jsonl", batch_input(requests, model, max_tokens).encode("utf-8")),
+                                                   purpose="batch")
+            batch = await client.batches.create(input_file_id=input_file.id,
+                                                endpoint=ENDPOINT,
+                                                completion_window=self.completion_window)
+        logging.info(f"Submitted batch {batch.id} of {len(requests)} requests")
+        return batch.id
+
+    async def status(self, batch_id):
+        async with openai_client(self.api_key) as client:
+            batch = await client.batches.retrieve(batch_id)
+        self.output_files[batch_id] = batch.output_file_id
+        return batch.status
+
+    async def results(self, batch_id):
+        output_file_id = self.output_files.get(batch_id)
+        if not output_file_id:
+            return {}
+        async with openai_client(self.api_key) as client:
+            content = await client.files.content(output_file_id)
+        return batch_output(content.text)
+
+
+class LocalBatchBackend:
+    def __init__(self, directory=BATCH_DIR, respond=None):
+        """
+        Args:
+            directory (str): Where the input and output files of the jobs are written.
+            respond (Callable[[str], str], optional): Makes the summary of a prompt, by default a placeholder text.
+        """
+        self.directory = directory
+        self.respond = respond or (lambda prompt: f"Summary of {len(prompt)} characters made by the local batch backend")
+
+    def path(self, batch_id, kind):
+        return os.path.join(self.directory, f"{batch_id}.{kind}.jsonl")
+
+    async def submit(self, requests, model, max_tokens=None):
+        os.makedirs(self.directory, exist_ok=True)
+        batch_id = f"batch_{uuid.uuid4().hex}"
+        with open(self.path(batch_id, "input"), "w", encoding="utf-8") as file:
+            file.write(batch_input(requests, model, max_tokens))
+        logging.info(f"Submitted local batch {batch_id} of {len(requests)} requests")
+        return batch_id
+
+    async def status(self, batch_id):
+        # The job is done when it is first checked, writing the output like the Batch API does
+        output_path = self.path(batch_id, "output")
+        if not os.path.exists(output_path):
+            with open(self.path(batch_id, "input"), encoding="utf-8") as file:
+                requests = [json.loads(line) for line in file if line.strip()]
+            with open(output_path, "w", encoding="utf-8") as file:
+                for request in requests:
+                    content = self.respond(request["body"]["messages"][-1]["content"])
+                    body = {"choices": [{"index": 0, "message": {"role": "assistant", "content": content}}]}
+                    file.write(json.dumps({"custom_id": request["custom_id"],
+                                           "response": {"status_code": 200, "body": body},
+                                           "error": None}) + "\n")
+        return "completed"
+
+    async def results(self, batch_id):
+        with open(self.path(batch_id, "output"), encoding="utf-8") as file:
+            return batch_output(file.read())
+
+
+def get_batch_backend(name, api_key):
+    """
+    Returns the batch backend named in BATCH_BACKEND.
+
+    Args:
+        name (str): "openai" or "local".
+        api_key (str): The OpenAI API key, for the OpenAI backend.
+    """
+    if name == "local":
+        return LocalBatchBackend()
+    return OpenAIBatchBackend(api_key)
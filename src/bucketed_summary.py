@@ -0,0 +1,129 @@
+# Description: This file contains the time-bucketed summaries used by the webhook.
+#  A range such as the last 7 days is split into buckets aligned on SUMMARY_BUCKET, e.g. whole days. The summary of
+#  each channel in a bucket that is over is kept in the persistent summary cache, so the next call over an overlapping
+#  range only summarizes the buckets at its edges, which are still open or cut by the range, and merges the bucket
+#  summaries into one with `map_reduce.reduce_summaries`. Bucketing is opt-in: without a bucket size, or when the range
+#  holds no complete bucket, the channels are summarized over the whole range with the quiet ones packed together.
+
+import logging
+from datetime import datetime
+
+from ai_chunking import get_tokens, off_event_loop
+from batch_api import is_pending
+from channel_packing import summarize_channels_between_dates
+from history import channel_heading, merging_prompts, summarize_channel_messages
+from map_reduce import gather_or_cancel, join_summaries, reduce_summaries
+from openai_summarizer import summarizer, summary_cache
+from summary_cache import cache_key
+
+
+def time_buckets(starttime, endtime, size, now=None):
+    """
+    Splits a time range into buckets aligned on multiples of `size` since the epoch.
+
+    Args:
+        starttime (datetime): The start of the range.
+        endtime (datetime): The end of the range.
+        size (timedelta): The length of a bucket.
+        now (datetime, optional): The current time, defaults to datetime.now().
+
+    Returns:
+        list: (start, end, complete) for each bucket, cut to the range. A bucket is complete when it is
+              entirely within the range and over, so that its summary can be cached.
+    """
+    if now is None:
+        now = datetime.now(starttime.tzinfo)
+    epoch = datetime(1970, 1, 1, tzinfo=starttime.tzinfo)
+
+    buckets = []
+    bucket_start = starttime - (starttime - epoch) % size
+    while bucket_start < endtime:
+        bucket_end = bucket_start + size
+        complete = bucket_start >= starttime and bucket_end <= min(endtime, now)
+        buckets.append((max(bucket_start, starttime), min(bucket_end, endtime), complete))
+        bucket_start = bucket_end
+    return buckets
+
+
+async def summarize_channels_in_buckets(channels, starttime_to_summarize, endtime_to_summarize, prior_timeframe_for_context, ai_prompts, size):
+    """
+    Summarizes several channels from cached bucket summaries, falling back to
+    `summarize_channels_between_dates`, which packs the quiet channels, when bucketing
+    is off or the range holds no complete bucket.
+
+    Args:
+        channels (list): The discord.TextChannel objects to summarize.
+        starttime_to_summarize (datetime): The start time of the period to summarize messages.
+        endtime_to_summarize (datetime): The end time of the period to summarize messages.
+        prior_timeframe_for_context (datetime): The start time of the period to retrieve prior messages for context.
+        ai_prompts (dict): The AI prompts to use for summarization.
+        size (timedelta, optional): The length of a bucket, None to summarize the whole range at once.
+
+    Returns:
+        list: The summary of each channel, in the same order and format as `summarize_contents_of_channel_between_dates`.
+    """
+    buckets = time_buckets(starttime_to_summarize, endtime_to_summarize, size) if size else []
+    if not any(complete for _, _, complete in buckets):
+        return await summarize_channels_between_dates(channels, starttime_to_summarize, endtime_to_summarize,
+                                                      prior_timeframe_for_context, ai_prompts)
+
+    lookback = starttime_to_summarize - prior_timeframe_for_context
+    responses = []
+    for channel in channels:
+        summaries = await gather_or_cancel(*(summarize_bucket(channel, start, end, complete, size, lookback, ai_prompts)
+                                             for start, end, complete in buckets))
+        summary = await merge_bucket_summaries([summary for summary in summaries if summary], ai_prompts)
+        responses.append(channel_heading(channel, starttime_to_summarize, endtime_to_summarize) + summary + "\n")
+    return responses
+
+
+async def summarize_bucket(channel, starttime, endtime, complete, size, lookback, ai_prompts):
+    """
+    Summarizes a channel in one bucket, from the cache when the bucket is complete.
+
+    Args:
+        channel (discord.TextChannel): The channel.
+        starttime (datetime): The start of the bucket, cut to the range.
+        endtime (datetime): The end of the bucket, cut to the range.
+        complete (bool): Whether the bucket is over and entirely within the range.
+        size (timedelta): The length of a bucket.
+        lookback (timedelta): How far before the bucket the prior context goes.
+        ai_prompts (dict): The AI prompts to use for summarization.
+
+    Returns:
+        str: The summary, "" if there are no messages in the bucket.
+    """
+    key = None
+    if complete:
+        key = cache_key("bucket", summarizer.model["name"], channel.id, starttime.isoformat(),
+                        size.total_seconds(), lookback.total_seconds(), ai_prompts)
+        summary = await summary_cache.get(key)
+        if summary is not None:
+            logging.debug(f"Bucket {starttime} of {channel} from the cache")
+            return summary
+
+    summary = await summarize_channel_messages(channel, starttime, endtime, starttime - lookback, ai_prompts)
+    if key and not is_pending(summary):
+        await summary_cache.set(key, summary)
+    return summary
+
+
+async def merge_bucket_summaries(summaries, ai_prompts):
+    """
+    Merges the summaries of consecutive buckets into one.
+
+    Args:
+        summaries (list): The summaries, oldest first.
+        ai_prompts (dict): The AI prompts to use for summarization.
+
+    Returns:
+        str: The merged summary, "" if there are none.
+    """
+    model = summarizer.model
+    merge_prompts = merging_prompts(ai_prompts)
+
+    async def merge_summaries(group, final=False):
+        return await summarizer.get_cached_summary_from_ai("", join_summaries(group), merge_prompts, final)
+
+    merge_tokens = await off_event_loop(get_tokens, summarizer.build_prompt("", "", merge_prompts), model["name"])
+    return await reduce_summaries(summaries, merge_summaries, model, merge_tokens)
@@ -0,0 +1,184 @@
+# Description: This file contains the packing mode used for multi-channel digests.
+#  `summarize_channels_between_dates` summarizes a list of channels. Busy channels go through
+#  `summarize_contents_of_channel_between_dates` on their own, while quiet channels are bin-packed into shared
+#  requests within the model's budget. The model is asked for one section per channel and the answer is split back
+#  into per-channel summaries, so a guild with dozens of quiet channels costs a handful of OpenAI calls.
+
+import logging
+import re
+
+from ai_chunking import estimate_tokens, get_encoding_name, get_tokens, input_token_budget, off_event_loop, stored_token_count, trim_to_token_budget
+from batch_api import is_pending
+from constants import COMPACT_MESSAGES, PACK_SMALL_CHANNELS, PACK_CHANNEL_MAX_TOKENS, PACK_CONTEXT_TOKENS, PACK_MAX_CHANNELS, PACK_REQUEST_MAX_TOKENS
+from history import channel_heading, fetch_channel_messages, format_channel_messages, summarize_contents_of_channel_between_dates
+from message_compaction import MessageCompactor
+from openai_summarizer import summarizer, DEFAULT_AI_PROMPTS
+
+SECTION = "=== Channel {}: #{} ==="
+SECTION_LINE = re.compile(r"^.*?={3} *Channel (\d+):.*$", re.MULTILINE)
+SECTION_OVERHEAD_TOKENS = 20
+
+PACKING_INSTRUCTIONS = (" The conversation comes from several Discord channels. The messages of each channel follow a line "
+                        "like '=== Channel 1: #name ==='. Summarize each channel separately, following my instructions for each one. "
+                        "Start the summary of each channel with its '=== Channel N: #name ===' line, copied exactly, "
+                        "and write nothing outside those sections.")
+
+
+async def summarize_channels_between_dates(channels, starttime_to_summarize, endtime_to_summarize, prior_timeframe_for_context, ai_prompts):
+    """
+    Summarizes several channels, packing the quiet ones into shared requests.
+
+    Args:
+        channels (list): The discord.TextChannel objects to summarize.
+        starttime_to_summarize (datetime): The start time of the period to summarize messages.
+        endtime_to_summarize (datetime): The end time of the period to summarize messages.
+        prior_timeframe_for_context (datetime): The start time of the period to retrieve prior messages for context.
+        ai_prompts (dict): The AI prompts to use for summarization.
+
+    Returns:
+        list: The summary of each channel, in the same order and format as `summarize_contents_of_channel_between_dates`.
+    """
+    if not PACK_SMALL_CHANNELS:
+        return [await summarize_contents_of_channel_between_dates(channel, starttime_to_summarize, endtime_to_summarize,
+                                                                  prior_timeframe_for_context, ai_prompts)
+                for channel in channels]
+
+    model = summarizer.model
+    encoding_name = get_encoding_name(model["name"])
+    responses = [None] * len(channels)
+    quiet_channels = []
+
+    for index, channel in enumerate(channels):
+        recent_messages = await fetch_channel_messages(channel, starttime_to_summarize, endtime_to_summarize)
+        if not recent_messages:
+            responses[index] = channel_heading(channel, starttime_to_summarize, endtime_to_summarize) + "\n"
+            continue
+
+        link, *lines = format_channel_messages(recent_messages)
+        # Messages from the message store were counted when stored
+        size = estimate_tokens(link + "\n", encoding_name)[2] + sum(
+            stored_token_count(message, encoding_name) or estimate_tokens(line + "\n", encoding_name)[2]
+            for message, line in zip(recent_messages, lines))
+        if size > PACK_CHANNEL_MAX_TOKENS:
+            responses[index] = await summarize_contents_of_channel_between_dates(channel, starttime_to_summarize, endtime_to_summarize,
+                                                                                prior_timeframe_for_context, ai_prompts,
+                                                                                recent_messages=recent_messages)
+        else:
+            quiet_channels.append((index, channel, recent_messages, size + PACK_CONTEXT_TOKENS + SECTION_OVERHEAD_TOKENS))
+
+    packed_prompts = packing_prompts(ai_prompts)
+    fixed_tokens = await off_event_loop(get_tokens, summarizer.build_prompt("", "", packed_prompts), model["name"])
+    capacity = min(PACK_REQUEST_MAX_TOKENS, input_token_budget(model, fixed_tokens))
+
+    bins = pack_channels(quiet_channels, capacity, PACK_MAX_CHANNELS)
+    logging.info(f"Packed {len(quiet_channels)} quiet channels into {len(bins)} requests")
+
+    for packed in bins:
+        if len(packed) == 1:
+            index, channel, recent_messages, _ = packed[0]
+            responses[index] = await summarize_contents_of_channel_between_dates(channel, starttime_to_summarize, endtime_to_summarize,
+                                                                                prior_timeframe_for_context, ai_prompts,
+                                                                                recent_messages=recent_messages)
+            continue
+
+        summaries = await summarize_packed_channels(packed, starttime_to_summarize, prior_timeframe_for_context, packed_prompts)
+        for number, (index, channel, recent_messages, _) in enumerate(packed, 1):
+            summary = summaries.get(number)
+            if summary is None:
+                logging.warning(f"Packed summary has no section for #{channel.name}, summarizing it on its own")
+                responses[index] = await summarize_contents_of_channel_between_dates(channel, starttime_to_summarize, endtime_to_summarize,
+                                                                                    prior_timeframe_for_context, ai_prompts,
+                                                                                    recent_messages=recent_messages)
+            else:
+                responses[index] = channel_heading(channel, starttime_to_summarize, endtime_to_summarize) + summary + "\n"
+
+    return responses
+
+
+def packing_prompts(ai_prompts):
+    packed_prompts = dict(ai_prompts or {})
+    packed_prompts["recent_messages_prompt"] = packed_prompts.get("recent_messages_prompt",
+                                                                  DEFAULT_AI_PROMPTS["recent_messages_prompt"]) + PACKING_INSTRUCTIONS
+    return packed_prompts
+
+
+def pack_channels(channels, capacity, max_channels):
+    """
+    Bin-packs channels into requests, first fit by decreasing size.
+
+    Args:
+        channels (list): (index, channel, recent_messages, size) tuples, size being the tokens the channel needs.
+        capacity (int): Tokens available per request.
+        max_channels (int): Channels allowed per request.
+
+    Returns:
+        list: The requests, each a list of the tuples in channel order.
+    """
+    bins = []
+    for item in sorted(channels, key=lambda item: item[3], reverse=True):
+        for packed in bins:
+            if packed[0] + item[3] <= capacity and len(packed[1]) < max_channels:
+                packed[0] += item[3]
+                packed[1].append(item)
+                break
+        else:
+            bins.append([item[3], [item]])
+    return [sorted(packed, key=lambda item: item[0]) for _, packed in bins]
+
+
+async def summarize_packed_channels(packed, starttime_to_summarize, prior_timeframe_for_context, packed_prompts):
+    """
+    Summarizes several quiet channels in one request.
+
+    Args:
+        packed (list): (index, channel, recent_messages, size) tuples from `pack_channels`.
+        starttime_to_summarize (datetime): The start time of the period to summarize messages.
+        prior_timeframe_for_context (datetime): The start time of the period to retrieve prior messages for context.
+        packed_prompts (dict): The AI prompts, with the packing instructions added.
+
+    Returns:
+        dict: The summary of each channel by its section number, starting at 1. Missing sections are left out.
+    """
+    model = summarizer.model
+    compactor = MessageCompactor(model["name"]) if COMPACT_MESSAGES else None
+    contexts = []
+    sections = []
+
+    for number, (_, channel, recent_messages, _) in enumerate(packed, 1):
+        marker = SECTION.format(number, channel.name)
+        prior_messages = await fetch_channel_messages(channel, prior_timeframe_for_context, starttime_to_summarize)
+        prior_lines = await off_event_loop(trim_to_token_budget, format_channel_messages(prior_messages, compactor),
+                                           PACK_CONTEXT_TOKENS, model["name"])
+        if prior_lines:
+            contexts.append(marker + "\n" + "\n".join(prior_lines))
+        sections.append(marker + "\n" + "\n".join(format_channel_messages(recent_messages, compactor)))
+
+    prior_context = "\n\n".join(contexts)
+    if compactor:
+        prior_context = compactor.legend() + prior_context
+
+    response = await summarizer.get_cached_summary_from_ai(prior_context, "\n\n".join(sections), packed_prompts)
+    if is_pending(response):
+        # Collected for a batch job, the channels share the placeholder until it is made
+        return {number: response for number in range(1, len(packed) + 1)}
+    if compactor:
+        response = compactor.expand(response)
+    return split_sections(response)
+
+
+def split_sections(response):
+    """
+    Splits a packed summary into the sections started by '=== Channel N: #name ===' lines.
+
+    Args:
+        response (str): The packed summary.
+
+    Returns:
+        dict: The text of each section by its number.
+    """
+    sections = {}
+    matches = list(SECTION_LINE.finditer(response))
+    for match, following in zip(matches, matches[1:] + [None]):
+        end = following.start() if following else len(response)
+        sections[int(match.group(1))] = response[match.end():end].strip()
+    return sections
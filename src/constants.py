@@ -168,6 +168,8 @@ MODELS = {
         "price_out": 0.6,
         "context_length": 128000,
         "cutoff": "October 2023",
+        "latency": 0.5,
+        "output_speed": 100,
     },
     "GPT-3.5 Turbo": {
         "name": "gpt-3.5-turbo",
@@ -176,6 +178,8 @@ MODELS = {
         "price_out": 1.5,
         "context_length": 16385,
         "cutoff": "September 2021",
+        "latency": 0.4,
+        "output_speed": 90,
     },
     "GPT-4 Turbo (Omni)": {
         "name": "gpt-4o",
@@ -184,6 +188,8 @@ MODELS = {
         "price_out": 15,
         "context_length": 128000,
         "cutoff": "October 2023",
+        "latency": 0.6,
+        "output_speed": 80,
     },
     "GPT-4 Turbo": {
         "name": "gpt-4-turbo",
@@ -192,6 +198,8 @@ MODELS = {
         "price_out": 30,
         "context_length": 128000,
         "cutoff": "December 2023",
+        "latency": 0.8,
+        "output_speed": 30,
     },
     "GPT-4": {
         "name": "gpt-4",
@@ -200,6 +208,8 @@ MODELS = {
         "price_out": 30,
         "context_length": 8192,
         "cutoff": "September 2021",
+        "latency": 0.9,
+        "output_speed": 25,
     }
 }
 
@@ -210,6 +220,71 @@ CONTEXT_LOOKBACK_DAYS = 3
 MESSAGE_CHUNK_SIZE = 1900
 LOG_DIAGNOSTICS_TO_CHANNEL = False
 FILE_FORMAT = "md"
+TOKEN_COUNT_CACHE_SIZE = 50000  # per-message token counts memoized by ai_chunking
+TOKENIZE_BATCH_SIZE = 1000  # messages per batch encode call
+TOKENIZER_THREADS = 4  # worker threads used for tokenizing off the event loop
+# Token estimates per encoding, from bin/calibrate_token_estimator.py:
+# (tokens per character, tokens per extra UTF-8 byte, relative error bound, absolute error bound per message)
+TOKEN_ESTIMATES = {
+    "cl100k_base": (0.28, 0.45, 0.6, 4),
+    "o200k_base": (0.27, 0.35, 0.6, 4),
+}
+OUTPUT_TOKEN_RESERVE = 4096  # tokens of each request's context kept free for the summary
+OUTPUT_TOKEN_SHARE = 0.15  # output tokens allowed to a summary that will be merged, per token it summarizes
+OUTPUT_TOKEN_MIN = 256  # output tokens allowed to any summary at least
+MODE_OUTPUT_FACTORS = {"brief": 0.5, "list": 0.75, "common words": 0.25, "descriptive": 2.0}  # other modes get 1
+CONTEXT_TOKEN_SHARE = 0.25  # share of a request's input budget the prior context may use
+CONTEXT_BRIEF = True  # condense the prior context into a brief shared by all the chunks of a channel
+CONTEXT_BRIEF_TOKENS = 600  # tokens of a context brief at most, larger prior contexts are condensed
+WEBHOOK_MODEL = "GPT-4 Turbo (Omni)"  # MODELS key used by the webhook, scheduled and /summarize_all summaries
+COMPACT_MESSAGES = True  # alias long author names and shorten links, mentions and IDs before summarizing
+COMPACT_URL_MIN_LENGTH = 24  # shorter URLs are kept as they are
+PACK_SMALL_CHANNELS = True  # summarize quiet channels together in one request for multi-channel digests
+PACK_CHANNEL_MAX_TOKENS = 2000  # channels with more message tokens than this are summarized on their own
+PACK_CONTEXT_TOKENS = 500  # prior context kept per packed channel
+PACK_REQUEST_MAX_TOKENS = 24000  # message and context tokens per packed request
+PACK_MAX_CHANNELS = 12  # channels per packed request, bounded by the output each one needs
+OPENAI_MAX_CONNECTIONS = 20  # concurrent connections to the OpenAI API shared by all summaries
+OPENAI_MAX_KEEPALIVE_CONNECTIONS = 10  # idle connections kept open for reuse
+OPENAI_KEEPALIVE_EXPIRY = 60  # seconds an idle connection is kept open
+OPENAI_TIMEOUT = 600  # seconds to wait for a completion
+OPENAI_CONNECT_TIMEOUT = 10  # seconds to wait for a connection
+OPENAI_BASE_URL = os.getenv("OPENAI_BASE_URL")  # e.g. http://localhost:8090/v1 for bin/fake_openai_server.py, None for OpenAI
+OPENAI_CLIENT_POOL_SIZE = 32  # API keys whose clients and connections are kept open
+OPENAI_CLIENT_IDLE_SECONDS = 900  # seconds after which an unused API key's client is closed
+RATE_LIMITER_CACHE_SIZE = 128  # API keys whose rate limits and concurrency are tracked
+OPENAI_RETRIES = 4  # times a call is retried after a 429, a timeout or a server error
+RETRY_BASE_DELAY = 1  # seconds, doubled on each retry and jittered
+RETRY_MAX_DELAY = 30  # seconds
+# Concurrent calls per API key, adapted by additive increase / multiplicative decrease:
+# +AIMD_INCREASE per window of successful calls, times AIMD_DECREASE after a 429, a timeout or a server error
+AIMD_INITIAL_CONCURRENCY = 2
+AIMD_MAX_CONCURRENCY = 50
+AIMD_INCREASE = 1
+AIMD_DECREASE = 0.5
+REDUCE_FAN_IN = 8  # chunk summaries merged by one call, so N chunks take about log8(N) merge levels
+STREAM_EDIT_INTERVAL = 1.2  # seconds between edits of a summary message while it is streamed
+SUMMARY_CACHE_PATH = os.getenv("SUMMARY_CACHE_PATH", "data/summary_cache.sqlite3")  # on the app's volume
+SUMMARY_CACHE_TTL = 30 * 24 * 3600  # seconds a cached summary is kept
+SUMMARY_CACHE_MAX_ENTRIES = 20000  # cached summaries kept, the least recently used are evicted first
+SUMMARY_CACHE_EVICT_EVERY = 100  # writes between two evictions
+SUMMARY_MEMORY_CACHE_BYTES = 32 * 1024 * 1024  # summaries kept in memory in front of the persistent cache
+SUMMARY_MEMORY_CACHE_COMPRESS = True  # zlib-compress the summaries kept in memory
+SUMMARY_BUCKET = ""  # aligned time buckets, e.g. "1d", whose per-channel summaries are cached for webhook summaries, "" to pack the channels instead
+BATCH_CATCHUP = os.getenv("BATCH_CATCHUP") == "true"  # make the catch-up jobs' summaries with batch jobs, see batch_api.py
+BATCH_BACKEND = os.getenv("BATCH_BACKEND", "openai")  # "openai" for the Batch API, "local" for the file-based stand-in
+BATCH_DIR = os.getenv("BATCH_DIR", "data/batches")  # where the local backend writes its batch files
+BATCH_POLL_INTERVAL = 60  # seconds between two checks of a batch job
+BATCH_COMPLETION_WINDOW = "24h"  # the only window the Batch API offers
+ROUTE_MODELS = True  # send small calls that don't give the final summary to a cheaper, faster model, see model_routing.py
+ROUTING_MODELS = ["GPT-4o Mini"]  # MODELS keys such calls may be routed to
+ROUTING_MAX_TOKENS = 16000  # input tokens above which a call keeps the requested model
+ROUTING_OUTPUT_TOKENS = 600  # typical summary length, for comparing the price and latency of models
+SUMMARY_RUN_TIMEOUT = 14 * 60  # seconds a /summarize run may take, Discord's interaction tokens expire after 15 minutes
+MESSAGE_STORE = os.getenv("MESSAGE_STORE") == "true"  # keep the channels' messages on the volume, see message_store.py. Needs the message content intent
+MESSAGE_STORE_PATH = os.getenv("MESSAGE_STORE_PATH", "data/messages.sqlite3")  # on the app's volume
+MESSAGE_STORE_RETENTION = 45 * 24 * 3600  # seconds messages are kept, longer than the periods and lookbacks summarized
+MESSAGE_STORE_PAGE = 500  # messages read from the store at once when paging back through a channel
 
 def calc_cost(in_tokens, out_tokens, model):
     in_tokens = model["price_in"] * in_tokens / 1000000
@@ -296,6 +371,8 @@ def setup_user(username, server_name, server_id):
         user["in_token_count"] = 0
     if "out_token_count" not in user:
         user["out_token_count"] = 0
+    if "out_token_counts" not in user:
+        user["out_token_counts"] = {}
     if "secret_mode" not in user:
         user["secret_mode"] = False
     if "developer_mode" not in user:
@@ -310,6 +387,8 @@ def setup_user(username, server_name, server_id):
         server["in_token_count"] = 0
     if "out_token_count" not in server:
         server["out_token_count"] = 0
+    if "out_token_counts" not in server:
+        server["out_token_counts"] = {}
     if "api-key" not in server:
         server["api-key"] = "NONE"
     if "secret_mode" not in server:
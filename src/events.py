@@ -1,6 +1,10 @@
 from constants import *
+from message_store import message_store
 
 async def on_guild_join(guild):
+    if MESSAGE_STORE:
+        # The messages sent before the bot joined are backfilled when read
+        await message_store.guild_joined(guild)
     channel = guild.system_channel
     if channel and channel.permissions_for(guild.me).send_messages:
         await channel.send(GUIDE)
@@ -8,3 +12,24 @@ async def on_guild_join(guild):
 async def on_guild_remove(guild):
     print(f"\n\n\n\nKicked out of '{guild.name}'\n\n\n\n")
 
+# The events feeding the message store, registered when MESSAGE_STORE is on
+async def on_message(message):
+    if message.guild is not None:
+        await message_store.received(message)
+
+async def on_raw_message_edit(payload):
+    # Raw events, so the messages sent before the bot's message cache was filled are updated too
+    await message_store.edited(payload.message_id, payload.data.get("content"))
+
+async def on_raw_message_delete(payload):
+    await message_store.deleted([payload.message_id])
+
+async def on_raw_bulk_message_delete(payload):
+    await message_store.deleted(payload.message_ids)
+
+async def on_disconnect():
+    await message_store.disconnected()
+
+async def on_resumed():
+    await message_store.resumed()
+
@@ -2,14 +2,26 @@
 #  The `summarize_contents_of_channel_between_dates` function processes messages from a Discord channel within a specified time frame, retrieves prior messages for context, and generates a summarized response.
 #  The `get_channel_messages` function retrieves messages from a specified Discord channel within a given time range.
 
+import contextvars
 import logging
 from openai_summarizer import *
-from constants import MESSAGE_CHUNK_SIZE
+from constants import MESSAGE_CHUNK_SIZE, CONTEXT_TOKEN_SHARE, CONTEXT_BRIEF, CONTEXT_BRIEF_TOKENS, COMPACT_MESSAGES
 from datetime import datetime, timedelta
 import re
-from ai_chunking import chunk_messages, chunk_messages_by_model_token_limit
+from ai_chunking import plan_chunks, input_token_budget, trim_to_token_budget, get_tokens, off_event_loop
+from message_compaction import MessageCompactor
+from message_store import message_store
+from map_reduce import map_reduce_summaries, join_summaries, MERGE_INSTRUCTIONS
 
-async def summarize_contents_of_channel_between_dates(channel, starttime_to_summarize, endtime_to_summarize, prior_timeframe_for_context, ai_prompts):
+# Channel histories already fetched by (channel ID, start, end), set for runs that read them repeatedly such as the
+# levels of the batch catch-up jobs. None when every read goes to Discord (or the message store).
+fetched_histories = contextvars.ContextVar("fetched_histories", default=None)
+
+CONTEXT_BRIEF_INSTRUCTIONS = ("Now, please condense the following earlier conversation into a brief of at most {} words. "
+                              "It will be the context for summarizing what came next. Keep the open topics, the decisions, "
+                              "who is involved and the terms used, writing names and references as they are written.")
+
+async def summarize_contents_of_channel_between_dates(channel, starttime_to_summarize, endtime_to_summarize, prior_timeframe_for_context, ai_prompts, recent_messages=None):
     """
     Asynchronously processes messages from a Discord channel within a specified time frame, retrieves prior messages for context, and generates a summarized response.
     Args:
@@ -18,45 +30,124 @@ async def summarize_contents_of_channel_between_dates(channel, starttime_to_summ
         endtime_to_summarize (datetime): The end time of the period to summarize messages.
         prior_timeframe_for_context (datetime): The start time of the period to retrieve prior messages for context.
         ai_prompts (str): The AI prompts to use for summarization.
+        recent_messages (list, optional): The Discord messages of the period, if already fetched with `fetch_channel_messages`.
     Returns:
         str: A formatted HTML string containing the summarized content of the channel messages within the specified time frame.
     """
+    response = channel_heading(channel, starttime_to_summarize, endtime_to_summarize)
+    response += await summarize_channel_messages(channel, starttime_to_summarize, endtime_to_summarize,
+                                                 prior_timeframe_for_context, ai_prompts, recent_messages)
+    response += "\n"
+    return response
+
+
+async def summarize_channel_messages(channel, starttime_to_summarize, endtime_to_summarize, prior_timeframe_for_context, ai_prompts, recent_messages=None):
+    """
+    Summarizes the messages of a Discord channel within a time frame, without the heading.
+    Args:
+        channel (discord.TextChannel): The Discord channel to process messages from.
+        starttime_to_summarize (datetime): The start time of the period to summarize messages.
+        endtime_to_summarize (datetime): The end time of the period to summarize messages.
+        prior_timeframe_for_context (datetime): The start time of the period to retrieve prior messages for context.
+        ai_prompts (str): The AI prompts to use for summarization.
+        recent_messages (list, optional): The Discord messages of the period, if already fetched with `fetch_channel_messages`.
+    Returns:
+        str: The summary, "" if there are no messages in the time frame.
+    """
 
-    recent_channel_messages = await get_channel_messages(channel, start=starttime_to_summarize, end=endtime_to_summarize) 
+    compactor = MessageCompactor() if COMPACT_MESSAGES else None
+    if recent_messages is None:
+        recent_messages = await fetch_channel_messages(channel, start=starttime_to_summarize, end=endtime_to_summarize)
+    recent_channel_messages = format_channel_messages(recent_messages, compactor)
 
     logging.info(f"Messages received from Discord about {channel} from {starttime_to_summarize.date()} and prior during {prior_timeframe_for_context.date()}:")
    # logging.debug(recent_channel_messages)
 
-    response = f"## Contents of #{channel.name} between {starttime_to_summarize.date()} and {endtime_to_summarize.date()}\n\n" 
-
     prior_messages = []
     if recent_channel_messages:
-        prior_messages = await get_channel_messages(channel, start=prior_timeframe_for_context, end=starttime_to_summarize)
+        prior_messages = await get_channel_messages(channel, start=prior_timeframe_for_context, end=starttime_to_summarize, compactor=compactor)
         logging.debug(f"For context, retrieved prior messages during {prior_timeframe_for_context} in {channel}: {prior_messages}")
         if len(prior_messages) == 0:
             logging.debug("No prior messages found for context")
 
-    # TODO: merge these chunks and groups mechanisms
-    chunks = chunk_messages(prior_messages, recent_channel_messages)
-    groups,  group_counts, starts, in_token_count = chunk_messages_by_model_token_limit(recent_channel_messages, "gpt-4o")
-    logging.debug(f"Number of groups: {len(groups)}")
+    model = summarizer.model
+    prior_messages = await off_event_loop(trim_to_token_budget,
+                                          prior_messages,
+                                          int(input_token_budget(model) * CONTEXT_TOKEN_SHARE),
+                                          model["name"])
+    legend = compactor.legend() if compactor else ""
+    prior_context = legend + "\n".join(prior_messages)
+    fixed_tokens = await off_event_loop(get_tokens, summarizer.build_prompt(prior_context, "", ai_prompts), model["name"])
+
+    chunks, chunk_counts, starts, in_token_count = await off_event_loop(plan_chunks, recent_channel_messages, model, fixed_tokens)
+
+    # Rather than sending the whole prior context with every chunk, it is condensed once into a brief they share
+    if CONTEXT_BRIEF and len(chunks) > 1:
+        prior_tokens = await off_event_loop(get_tokens, "\n".join(prior_messages), model["name"])
+        if prior_tokens > CONTEXT_BRIEF_TOKENS:
+            prior_context = legend + await context_brief(prior_messages, legend, ai_prompts)
+            fixed_tokens = await off_event_loop(get_tokens, summarizer.build_prompt(prior_context, "", ai_prompts), model["name"])
+            chunks, chunk_counts, starts, in_token_count = await off_event_loop(plan_chunks, recent_channel_messages, model, fixed_tokens)
+            logging.debug(f"Prior context of {prior_tokens} tokens condensed for {len(chunks)} chunks")
+
     logging.debug(f"Number of chunks: {len(chunks)}")
-    logging.debug(f"Number of starts: {len(starts)}")
     logging.debug(f"Total tokens: {in_token_count}")
-    logging.debug(f"Group counts: {group_counts}")
+    logging.debug(f"Chunk counts: {chunk_counts}")
 
-    chunked_responses = []
-    for chunk in chunks:
-        chunked_response = await summarizer.get_cached_summary_from_ai("\n".join(prior_messages),
-                                                                "\n".join(chunk),
-                                                                 ai_prompts)
-        chunked_responses.append(chunked_response)
+    # The chunks are summarized concurrently, then their summaries are merged into one. How many calls are in
+    # flight is adapted to the API key by openai_clients.create_chat_completion.
+    async def summarize_chunk(chunk, final=False):
+        return await summarizer.get_cached_summary_from_ai(prior_context,
+                                                    chunk,
+                                                     ai_prompts,
+                                                     final)
 
-    response += "\n".join(chunked_responses) + "\n"
+    # The summaries stay compacted until the end, the merges get the legend as their context
+    merge_prompts = merging_prompts(ai_prompts)
 
-    return response
+    async def merge_summaries(summaries, final=False):
+        return await summarizer.get_cached_summary_from_ai(legend, join_summaries(summaries), merge_prompts, final)
+
+    merge_tokens = await off_event_loop(get_tokens, summarizer.build_prompt(legend, "", merge_prompts), model["name"])
+    summary = await map_reduce_summaries(chunks, summarize_chunk, merge_summaries, model, merge_tokens)
+    if compactor:
+        summary = compactor.expand(summary)
+
+    return summary
+
+
+async def context_brief(prior_messages, legend, ai_prompts):
+    """
+    Condenses the prior messages of a channel into a brief of at most CONTEXT_BRIEF_TOKENS tokens.
+    The brief is cached like any summary, so it is made once per channel and context window.
 
-async def get_channel_messages(channel, start, end):
+    Args:
+        prior_messages (list): The prior message strings, in chronological order.
+        legend (str): The compactor's legend, "" if the messages are not compacted.
+        ai_prompts (dict): The AI prompts to use for summarization.
+
+    Returns:
+        str: The brief.
+    """
+    brief_prompts = dict(ai_prompts or {})
+    brief_prompts["recent_messages_prompt"] = CONTEXT_BRIEF_INSTRUCTIONS.format(int(CONTEXT_BRIEF_TOKENS * 0.75))
+    brief = await summarizer.get_cached_summary_from_ai(legend, "\n".join(prior_messages), brief_prompts, final=False)
+    model_name = summarizer.model["name"]
+    return "\n".join(await off_event_loop(trim_to_token_budget, brief.splitlines(), CONTEXT_BRIEF_TOKENS, model_name))
+
+
+def merging_prompts(ai_prompts):
+    merge_prompts = dict(ai_prompts or {})
+    merge_prompts["recent_messages_prompt"] = merge_prompts.get("recent_messages_prompt",
+                                                                DEFAULT_AI_PROMPTS["recent_messages_prompt"]) + " " + MERGE_INSTRUCTIONS
+    return merge_prompts
+
+
+def channel_heading(channel, starttime_to_summarize, endtime_to_summarize):
+    return f"## Contents of #{channel.name} between {starttime_to_summarize.date()} and {endtime_to_summarize.date()}\n\n"
+
+
+async def get_channel_messages(channel, start, end, compactor=None):
     """
     Retrieve messages from a specified Discord channel within a given time range.
 
@@ -64,35 +155,92 @@ async def get_channel_messages(channel, start, end):
         channel (discord.TextChannel): The Discord channel to retrieve messages from.
         start (datetime.datetime): The start time to retrieve messages from.
         end (datetime.datetime): The end time to retrieve messages until.
+        compactor (MessageCompactor, optional): Compacts the messages to save tokens when given.
 
     Returns:
         list: A list of strings containing the messages retrieved from the channel.
               The first message includes a link to the messages in the channel.
     """
+    messages = await fetch_channel_messages(channel, start, end)
+    return format_channel_messages(messages, compactor)
+
+
+async def fetch_channel_messages(channel, start, end):
+    """
+    Retrieve the Discord messages of a channel within a given time range, leaving out the bot's own messages and commands.
+    They are read from the message store when it is enabled, which fetches from Discord only what it is missing.
+    Within a run that sets `fetched_histories`, a range is fetched once.
+
+    Args:
+        channel (discord.TextChannel): The Discord channel to retrieve messages from.
+        start (datetime.datetime): The start time to retrieve messages from.
+        end (datetime.datetime): The end time to retrieve messages until.
+
+    Returns:
+        list: The discord.Message or StoredMessage objects, oldest first.
+    """
     logging.debug(f"Retrieving messages from {channel} between {start} and {end}")
+    fetched = fetched_histories.get()
+    key = (channel.id, start, end)
+    if fetched is not None and key in fetched:
+        return fetched[key]
 
     # Get the bot object from the channel
     bot = channel.guild.me._state._get_client() #TDO - code smell
     bot = channel.guild.me.guild.me
 
-    channel_messages = []
-    async for msg in channel.history(after=start, before=end):
-        first_message = True
+    history = await message_store.fetch(channel, start, end)
+    if history is None:
+        history = [msg async for msg in channel.history(after=start, before=end)]
+
+    messages = []
+    for msg in history:
+        if msg.author.id != bot.id and not msg.content.startswith("/"):
+            messages.append(msg)
+    if fetched is not None:
+        fetched[key] = messages
+    return messages
 
-        if msg.author != bot.user and not msg.content.startswith("/"):
-            if first_message:
-                message_url = f"https://discord.com/channels/{msg.guild.id}/{msg.channel.id}/{msg.id}"
-                channel_messages.append(f"Discord: <a href='{message_url}'>Link to messages in {msg.guild.name}</a>")
-                channel_messages.append(f"{msg.author.display_name}: {msg.content}")
-                first_message = False
-            else:
-                channel_messages.append(f"{msg.author.display_name}: {msg.content}")
-    return channel_messages
+
+def format_channel_messages(messages, compactor=None):
+    """
+    Formats Discord messages as prompt lines, preceded by a link to the first message.
+
+    Args:
+        messages (list): The discord.Message objects, oldest first.
+        compactor (MessageCompactor, optional): Compacts the messages to save tokens when given.
+
+    Returns:
+        list: A list of strings, empty if there are no messages.
+    """
+    if not messages:
+        return []
+
+    first = messages[0]
+    message_url = f"https://discord.com/channels/{first.guild.id}/{first.channel.id}/{first.id}"
+    link = f"Discord: <a href='{message_url}'>Link to messages in {first.guild.name}</a>"
+
+    if compactor:
+        lines = [line for line in compactor.compact(messages) if line is not None]
+        return [compactor.compact_text(link)] + lines
+    return [link] + [f"{msg.author.display_name}: {msg.content}" for msg in messages]
 
 
 # Legacy Helper function
 def time_for_dating_back(enddate, time_period):
+    return enddate - parse_time_period(time_period)
+
 
+def parse_time_period(time_period):
+    """
+    Parses a time period such as '1d', '6h' or '30m'.
+
+    Args:
+        time_period (str): A number followed by d, h or m.
+
+    Returns:
+        timedelta: The duration of the period.
+    """
     match = re.match(r'(\d+)([dhm])$', time_period)
     if not match:
         raise ValueError("Invalid time period format. Use '<number><d/h/m>' (e.g., '1d', '6h', '30m').")
@@ -100,10 +248,9 @@ def time_for_dating_back(enddate, time_period):
     quantity, unit = match.groups()
     quantity = int(quantity)
 
-
     return {
-        'd': enddate - timedelta(days=quantity),
-        'h': enddate - timedelta(hours=quantity),
-        'm': enddate - timedelta(minutes=quantity)
-    }.get(unit, ValueError("Invalid time unit. Use 'd' for days, 'h' for hours, or 'm' for minutes."))
+        'd': timedelta(days=quantity),
+        'h': timedelta(hours=quantity),
+        'm': timedelta(minutes=quantity)
+    }[unit]
 
@@ -0,0 +1,68 @@
+# Description: This file contains `LiveMessage`, which shows a growing text, such as a streamed summary, in Discord.
+#  The text is split in MESSAGE_CHUNK_SIZE pieces like any summary. The last piece is edited as the text grows,
+#  at most every STREAM_EDIT_INTERVAL seconds to stay within Discord's rate limits, and overflow rolls into new messages.
+
+import logging
+import textwrap
+import time
+
+from constants import MESSAGE_CHUNK_SIZE, STREAM_EDIT_INTERVAL
+
+
+class LiveMessage:
+    def __init__(self, send_message, interval=STREAM_EDIT_INTERVAL, size=MESSAGE_CHUNK_SIZE):
+        """
+        Args:
+            send_message (Callable[[str], Awaitable[discord.Message]]): Sends a new message and returns it.
+            interval (float): Seconds between two updates of the messages.
+            size (int): Characters per message.
+        """
+        self.send_message = send_message
+        self.interval = interval
+        self.size = size
+        self.messages = []
+        self.shown = []     # the text of each message
+        self.text = ""
+        self.last_flush = 0.0
+
+    async def update(self, text):
+        """
+        Sets the text, updating the messages if the last update is old enough.
+
+        Args:
+            text (str): The whole text so far.
+        """
+        self.text = text
+        if time.monotonic() - self.last_flush >= self.interval:
+            await self.flush()
+
+    async def finish(self, text):
+        """
+        Sets the final text and updates the messages right away.
+
+        Args:
+            text (str): The whole text.
+        """
+        self.text = text
+        await self.flush()
+
+    async def flush(self):
+        self.last_flush = time.monotonic()
+        pieces = textwrap.wrap(self.text, self.size, replace_whitespace=False)
+
+        for i, piece in enumerate(pieces):
+            if i == len(self.messages):
+                self.messages.append(await self.send_message(piece))
+                self.shown.append(piece)
+            elif self.shown[i] != piece:
+                await self.messages[i].edit(content=piece)
+                self.shown[i] = piece
+
+        # The text got shorter, e.g. a retried call started over
+        while len(self.messages) > max(len(pieces), 1):
+            message = self.messages.pop()
+            self.shown.pop()
+            try:
+                await message.delete()
+            except Exception as e:
+                logging.warning(f"Could not delete a summary message: {e}")
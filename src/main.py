@@ -63,8 +63,12 @@ from tasks_beaverworx import perform_catchup_and_queue_future_jobs, print_jobs
 from webhook import *
 from summary_for_webhook import summary_for_webhook 
 from tagged_channels import *
+from message_store import message_store
 
 intents = discord.Intents.default()
+if MESSAGE_STORE:
+    # Privileged, to be enabled for the bot in the Discord developer portal too
+    intents.message_content = True
 bot = discord.Bot(intents=intents)
 summarizer = OpenAISummarizer()
 
@@ -99,6 +103,8 @@ tasklist_thread.start()
 
 async def on_ready():
     logging.info(f"{bot.user.name} is ready")
+    if MESSAGE_STORE:
+        await message_store.connected(bot.guilds)
     for guild in bot.guilds:
         for channel in guild.channels:
             if channel.permissions_for(guild.me).view_channel:
@@ -125,6 +131,13 @@ async def on_error(error, *args, **kwargs):
 bot.event(on_ready)
 bot.event(on_guild_join)
 bot.event(on_guild_remove)
+if MESSAGE_STORE:
+    bot.event(on_message)
+    bot.event(on_raw_message_edit)
+    bot.event(on_raw_message_delete)
+    bot.event(on_raw_bulk_message_delete)
+    bot.event(on_disconnect)
+    bot.event(on_resumed)
 
 bot.slash_command(name="summary", description="Get a summary of the last messages in this channel")(summary)
 bot.slash_command(name="fromtosummary", description="Get a summary from a certain time to a certain time")(fromtosummary)
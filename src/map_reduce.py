@@ -0,0 +1,125 @@
+# Description: This file contains the hierarchical map-reduce used when a conversation needs more than one chunk.
+#  `map_reduce_summaries` summarizes the chunks in parallel, then merges consecutive summaries in parallel, up to
+#  REDUCE_FAN_IN at a time and within the model's input budget, level after level until one summary remains.
+#  The depth of the tree grows with the logarithm of the number of chunks.
+#  If the summary is cancelled or a call fails, the calls still pending or in flight are cancelled with it.
+
+import asyncio
+import logging
+
+from ai_chunking import get_message_tokens_batch, input_token_budget, off_event_loop
+from constants import REDUCE_FAN_IN
+
+SEPARATOR = "\n" + "-" * 10 + "\n"
+SEPARATOR_TOKENS = 4
+
+MERGE_INSTRUCTIONS = ("The text below is not a conversation but the summaries of consecutive parts of one, oldest first, "
+                      "separated by lines of dashes. Merge them into a single summary of the whole conversation, following "
+                      "my instructions and format. Combine related points, drop repetitions and keep the links.")
+
+
+def join_summaries(summaries):
+    return SEPARATOR.join(summaries)
+
+
+async def gather_or_cancel(*coroutines):
+    """
+    Runs coroutines concurrently like asyncio.gather, but cancels the others as soon as one fails,
+    so that calls of a doomed summary stop using quota and concurrency slots.
+
+    Returns:
+        list: The results, in order.
+    """
+    tasks = [asyncio.ensure_future(coroutine) for coroutine in coroutines]
+    try:
+        return list(await asyncio.gather(*tasks))
+    except BaseException:
+        for task in tasks:
+            task.cancel()
+        raise
+
+
+async def map_reduce_summaries(chunks, summarize_chunk, merge_summaries, model, fixed_tokens=0, fan_in=REDUCE_FAN_IN):
+    """
+    Summarizes chunks in parallel, then merges the summaries in parallel levels until one remains.
+
+    Args:
+        chunks (list): The chunks to summarize, in chronological order.
+        summarize_chunk (coroutine function): Summarizes one chunk.
+        merge_summaries (coroutine function): Merges a list of consecutive summaries into one,
+            e.g. by sending MERGE_INSTRUCTIONS and `join_summaries(summaries)`.
+            Both are also passed `final`, True for the call that gives the final summary, e.g. to stream it.
+        model (dict): Model information containing the name and context length.
+        fixed_tokens (int): Tokens sent with every merge besides the summaries.
+        fan_in (int): Summaries merged by one call at most.
+
+    Returns:
+        str: The summary of all the chunks, "" if there are none.
+    """
+    final = len(chunks) == 1
+    summaries = await gather_or_cancel(*(summarize_chunk(chunk, final=final) for chunk in chunks))
+    return await reduce_summaries(summaries, merge_summaries, model, fixed_tokens, fan_in)
+
+
+async def reduce_summaries(summaries, merge_summaries, model, fixed_tokens=0, fan_in=REDUCE_FAN_IN):
+    """
+    Merges summaries level by level until one remains.
+
+    Args:
+        summaries (list): The summaries, in chronological order.
+        merge_summaries (coroutine function): Merges a list of consecutive summaries into one, `final` for the last merge.
+        model (dict): Model information containing the name and context length.
+        fixed_tokens (int): Tokens sent with every merge besides the summaries.
+        fan_in (int): Summaries merged by one call at most.
+
+    Returns:
+        str: The merged summary. If summaries are too large to be merged, the rest are joined as they are.
+    """
+    if not summaries:
+        return ""
+    budget = input_token_budget(model, fixed_tokens)
+    level = 0
+    while len(summaries) > 1:
+        counts = await off_event_loop(get_message_tokens_batch, summaries, model["name"])
+        groups = group_summaries(summaries, counts, budget, fan_in)
+        if len(groups) == len(summaries):
+            logging.warning(f"{len(summaries)} summaries are too large to be merged, joining them")
+            return "\n".join(summaries)
+
+        level += 1
+        logging.debug(f"Merge level {level}: {len(summaries)} summaries into {len(groups)}")
+        final = len(groups) == 1
+        merged = await gather_or_cancel(*(merge_summaries(group, final=final) for group in groups if len(group) > 1))
+        merged = iter(merged)
+        summaries = [next(merged) if len(group) > 1 else group[0] for group in groups]
+
+    return summaries[0]
+
+
+def group_summaries(summaries, counts, budget, fan_in):
+    """
+    Groups consecutive summaries for merging, up to `fan_in` per group and within the token budget.
+
+    Args:
+        summaries (list): The summaries.
+        counts (list): The tokens of each summary.
+        budget (int): The tokens available per merge.
+        fan_in (int): Summaries per group at most.
+
+    Returns:
+        list: The groups, lists of summaries. A summary that fits with no neighbour is alone in its group.
+    """
+    groups = []
+    group = []
+    group_tokens = 0
+    for summary, count in zip(summaries, counts):
+        count += SEPARATOR_TOKENS
+        if group and (len(group) == fan_in or group_tokens + count > budget):
+            groups.append(group)
+            group = []
+            group_tokens = 0
+        group.append(summary)
+        group_tokens += count
+    if group:
+        groups.append(group)
+    return groups
@@ -0,0 +1,157 @@
+# Description: This file contains the compaction pass applied to Discord messages before they are sent to OpenAI.
+#  Author names that cost more tokens than an alias are interned to aliases listed in a legend, long URLs,
+#  mentions and raw snowflake IDs are replaced by short reference tokens, custom emoji markup is reduced to its
+#  name and consecutive duplicate messages are collapsed. `MessageCompactor.expand` turns the aliases and references in the summary back into
+#  names and links.
+
+import logging
+import re
+
+from ai_chunking import DEFAULT_TOKENIZER_MODEL, get_message_tokens
+from constants import COMPACT_URL_MIN_LENGTH
+
+CUSTOM_EMOJI = re.compile(r"<a?:(\w+):\d{17,20}>")
+MENTION = re.compile(r"<(@!?|@&|#)(\d{17,20})>")
+URL = re.compile(r"https?://[^\s<>'\"]+")
+SNOWFLAKE = re.compile(r"\b\d{17,20}\b")
+
+# Aliases [U1], links [L1] and mentions [M1]. compact_text lowercases the letter of such text in the chat.
+REFERENCE = re.compile(r"\[([LMU])(\d+)\]")
+
+
+class MessageCompactor:
+    """
+    Compacts the messages of one summary so they cost fewer input tokens.
+
+    Use one compactor for every message that goes into the same summary, including
+    the prior context, so the aliases and references stay consistent. Aliases and
+    references are numbered in order of first appearance, so the same messages
+    always compact to the same text and cached summaries still match.
+    """
+
+    def __init__(self, model_name=DEFAULT_TOKENIZER_MODEL):
+        self.model_name = model_name
+        self.aliases = {}       # display name -> alias, only for names that cost more tokens than their alias
+        self.kept = set()       # display names that are cheaper than an alias
+        self.references = {}    # original text -> reference token
+        self.counts = {"L": 0, "M": 0}
+        self.expansions = {}    # alias or reference token -> original text
+
+    def compact(self, messages):
+        """
+        Compacts Discord messages into prompt lines.
+
+        Args:
+            messages (list): Discord messages in chronological order.
+
+        Returns:
+            list: One line per message, aligned with `messages`. Consecutive duplicates are
+                  collapsed into the first line with a count, the repeats and messages without
+                  an author or content are None.
+        """
+        lines = []
+        previous = None
+        repeats = 0
+        for message in messages:
+            author_name = getattr(getattr(message, 'author', None), 'display_name', None)
+            content = getattr(message, 'content', None)
+            if not author_name or not content:
+                lines.append(None)
+                continue
+
+            if previous is not None and (author_name, content) == previous:
+                repeats += 1
+                lines.append(None)
+                lines[first_index] = f"{first_line} (x{repeats + 1})"
+                continue
+
+            previous = (author_name, content)
+            repeats = 0
+            first_index = len(lines)
+            first_line = f"{self.alias(author_name)}: {self.compact_text(content, getattr(message, 'mentions', []))}"
+            lines.append(first_line)
+
+        collapsed = sum(1 for line, message in zip(lines, messages) if line is None and getattr(message, 'content', None))
+        if collapsed:
+            logging.debug(f"Collapsed {collapsed} repeated messages")
+        return lines
+
+    def compact_text(self, text, mentions=()):
+        """
+        Replaces custom emoji, mentions, long URLs and snowflake IDs in a text. Text like
+        [L1] becomes [l1], so the chat can't be mistaken for an alias or a reference.
+
+        Args:
+            text (str): The text to compact.
+            mentions (list): Users mentioned in the text, whose mentions become @alias.
+
+        Returns:
+            str: The compacted text.
+        """
+        names = {str(user.id): user.display_name for user in mentions}
+
+        def mention(match):
+            kind, id = match.groups()
+            if kind.startswith("@") and kind != "@&" and id in names:
+                return f"@{self.alias(names[id])}"
+            return self.reference("M", match.group(0))
+
+        text = REFERENCE.sub(lambda match: f"[{match.group(1).lower()}{match.group(2)}]", text)
+        text = CUSTOM_EMOJI.sub(r":\1:", text)
+        text = MENTION.sub(mention, text)
+        text = URL.sub(lambda match: self.reference("L", match.group(0))
+                       if len(match.group(0)) >= COMPACT_URL_MIN_LENGTH else match.group(0), text)
+        text = SNOWFLAKE.sub(lambda match: self.reference("M", match.group(0)), text)
+        return text
+
+    def alias(self, author_name):
+        if author_name in self.aliases:
+            return self.aliases[author_name]
+        if author_name not in self.kept:
+            alias = f"[U{len(self.aliases) + 1}]"
+            if get_message_tokens(author_name, self.model_name) <= get_message_tokens(alias, self.model_name):
+                self.kept.add(author_name)
+                return author_name
+            self.aliases[author_name] = alias
+            self.expansions[alias] = author_name
+            return alias
+        return author_name
+
+    def reference(self, kind, original):
+        if original not in self.references:
+            self.counts[kind] += 1
+            token = f"[{kind}{self.counts[kind]}]"
+            self.references[original] = token
+            self.expansions[token] = original
+        return self.references[original]
+
+    def legend(self):
+        """
+        Explains the aliases and references to the model.
+
+        Returns:
+            str: The legend to send with every request, or "" when nothing was abbreviated.
+        """
+        legend = ""
+        if self.aliases:
+            legend += "Some author names are abbreviated: " + \
+                      ", ".join(f"{alias} = {name}" for name, alias in self.aliases.items()) + \
+                      ". Keep these aliases exactly as written.\n"
+        if self.references:
+            legend += "Links are written as [L1], [L2]... and mentions or IDs as [M1], [M2]... " + \
+                      "Keep these references exactly as written when you cite them.\n"
+        return legend
+
+    def expand(self, text):
+        """
+        Turns the aliases and references in a summary back into names, links and mentions.
+
+        Args:
+            text (str): The summary written by the model.
+
+        Returns:
+            str: The summary with the originals restored.
+        """
+        if not self.expansions:
+            return text
+        return REFERENCE.sub(lambda match: self.expansions.get(match.group(0), match.group(0)), text)
@@ -0,0 +1,355 @@
+# Description: This file contains the local message store, a SQLite database on the app's volume holding a copy of
+#  the channels' messages, so summaries don't page through channel.history over the REST API every time.
+#  The store is fed by the gateway events for new, edited and deleted messages, and by the REST fetches it makes to
+#  backfill what it is missing. It records the time ranges it holds in full: a backfill covers the channel and window it
+#  fetched, a gateway session covers a guild from the time the bot connected or joined it. A channel the bot could only
+#  read later, e.g. once given access, is covered by the session from the first message the gateway delivered in it,
+#  so the messages sent there before are backfilled. A history read whose window is covered is answered from disk and
+#  only the gaps are fetched. Each message's token count is computed when it is
+#  stored, see `stored_token_count`. Messages sent during a disconnect that wasn't resumed are a gap, backfilled by
+#  the next read, edits and deletions made then are missed. Like the summary cache, the database is shared through one
+#  connection guarded by a lock and its queries run in worker threads. A store that fails logs a warning and the
+#  messages are fetched from the REST API as if it were disabled.
+
+import asyncio
+import json
+import logging
+import os
+import sqlite3
+import threading
+import time
+from collections import namedtuple
+from datetime import datetime, timezone
+
+from ai_chunking import format_message_line, get_encoding_name, get_message_tokens_batch
+from constants import MESSAGE_STORE, MESSAGE_STORE_PATH, MESSAGE_STORE_RETENTION, MESSAGE_STORE_PAGE, MODELS, WEBHOOK_MODEL
+
+StoredUser = namedtuple("StoredUser", "id display_name")
+
+
+class StoredMessage:
+    """A message read from the store, with the attributes of discord.Message the summaries use."""
+
+    def __init__(self, row, channel):
+        id, _, author_id, author_name, content, mentions, created, tokens, encoding = row
+        self.id = id
+        self.channel = channel
+        self.guild = channel.guild
+        self.author = StoredUser(author_id, author_name)
+        self.content = content
+        self.mentions = [StoredUser(*mention) for mention in json.loads(mentions)]
+        self.created_at = datetime.fromtimestamp(created, timezone.utc)
+        self.tokens = tokens
+        self.encoding = encoding
+
+
+def uncovered(intervals, start, stop):
+    """
+    Finds the parts of a time range that no interval covers.
+
+    Args:
+        intervals (list): (start, stop) pairs of timestamps, in any order, possibly overlapping.
+        start (float): The start of the range.
+        stop (float): The end of the range.
+
+    Returns:
+        list: The (start, stop) pairs of the gaps, in order.
+    """
+    gaps = []
+    position = start
+    for interval_start, interval_stop in sorted(intervals):
+        if position >= stop or interval_start >= stop:
+            break
+        if interval_stop <= position:
+            continue
+        if interval_start > position:
+            gaps.append((position, interval_start))
+        position = interval_stop
+    if position < stop:
+        gaps.append((position, stop))
+    return gaps
+
+
+def covered_since(intervals, now):
+    """
+    Finds when the coverage that reaches `now` without a gap starts.
+
+    Args:
+        intervals (list): (start, stop) pairs of timestamps.
+        now (float): The current time.
+
+    Returns:
+        float: The start of that coverage, `now` if there is none.
+    """
+    since = now
+    for interval_start, interval_stop in sorted(intervals, reverse=True):
+        if interval_start < since <= interval_stop:
+            since = interval_start
+    return since
+
+
+class MessageStore:
+    def __init__(self, path=MESSAGE_STORE_PATH, retention=MESSAGE_STORE_RETENTION, enabled=MESSAGE_STORE,
+                 model_name=MODELS[WEBHOOK_MODEL]["name"]):
+        """
+        Args:
+            path (str): The SQLite database.
+            retention (float): Seconds messages are kept.
+            enabled (bool): Whether history reads go through the store, see MESSAGE_STORE.
+            model_name (str): The OpenAI model whose tokenizer counts the messages when they are stored.
+        """
+        self.path = path
+        self.retention = retention
+        self.enabled = enabled
+        self.model_name = model_name
+        self.encoding = get_encoding_name(model_name)
+        self.sessions = {}  # guild ID -> (rowid, start) of the coverage of the current gateway session
+        self.live = False  # connected, every message sent now reaches the store
+        self.connection = None
+        self.lock = threading.Lock()
+
+    async def received(self, message):
+        """Stores a message received from the gateway."""
+        session = self.sessions.get(message.guild.id) if self.live else None
+        await self._run(self._add, [message], session[0] if session else None)
+
+    async def edited(self, message_id, content):
+        """Updates the content of a stored message, from the gateway's raw edit event."""
+        if content is not None:
+            await self._run(self._edit, message_id, content)
+
+    async def deleted(self, message_ids):
+        """Removes deleted messages, from the gateway's raw delete events."""
+        await self._run(self._delete, list(message_ids))
+
+    async def connected(self, guilds):
+        """Starts the coverage of a new gateway session of each guild, when the bot is ready."""
+        now = time.time()
+        self.sessions = {}
+        for guild in guilds:
+            await self.guild_joined(guild, now)
+        self.live = True
+        await self._run(self._prune, now)
+
+    async def guild_joined(self, guild, now=None):
+        """Starts the coverage of a guild the bot joined, which the gateway covers from then on."""
+        now = now or time.time()
+        session = await self._run(self._start_session, guild.id, now)
+        if session is not None:
+            self.sessions[guild.id] = (session, now)
+
+    async def disconnected(self):
+        self.live = False
+        await self._run(self._extend_sessions, [session for session, _ in self.sessions.values()], time.time())
+
+    async def resumed(self):
+        # Discord replays the events missed while disconnected when a session resumes
+        self.live = True
+
+    async def fetch(self, channel, start, end):
+        """
+        Returns the messages of a channel within a time range, fetching from the REST API only what the store misses.
+
+        Args:
+            channel (discord.TextChannel): The Discord channel.
+            start (datetime.datetime): The start of the range.
+            end (datetime.datetime): The end of the range.
+
+        Returns:
+            list: The messages, oldest first, or None if the store is disabled or failed.
+        """
+        if not self.enabled:
+            return None
+        try:
+            now = time.time()
+            start, end = start.timestamp(), end.timestamp()
+            gaps = uncovered(await self._coverage(channel, now), start, min(end, now))
+            for gap_start, gap_stop in gaps:
+                messages = [message async for message in channel.history(after=as_datetime(gap_start),
+                                                                         before=as_datetime(gap_stop),
+                                                                         limit=None)]
+                await asyncio.to_thread(self._add, messages)
+                await asyncio.to_thread(self._cover, channel.id, gap_start, gap_stop)
+            rows = await asyncio.to_thread(self._read, channel.id, start, end)
+        except sqlite3.Error as e:
+            logging.warning(f"Message store read failed, fetching from Discord: {e}")
+            return None
+        logging.debug(f"Read {len(rows)} messages of {channel} from the store, backfilled {len(gaps)} gaps")
+        return [StoredMessage(row, channel) for row in rows]
+
+    async def history(self, channel):
+        """
+        Yields the messages of a channel newest first, like channel.history(limit=None).
+        The messages the store holds up to now are read from it, the older ones are fetched from the REST API,
+        stored and covered. Use it with contextlib.aclosing, so what was fetched is stored when the caller stops.
+
+        Args:
+            channel (discord.TextChannel): The Discord channel.
+        """
+        if not self.enabled:
+            async for message in channel.history(limit=None):
+                yield message
+            return
+
+        now = time.time()
+        before = (now + 1, 0)  # (created, id) of the last message yielded
+        try:
+            since = covered_since(await self._coverage(channel, now), now)
+            while True:
+                rows = await asyncio.to_thread(self._page, channel.id, since, before)
+                for row in rows:
+                    before = (row[6], row[0])
+                    yield StoredMessage(row, channel)
+                if len(rows) < MESSAGE_STORE_PAGE:
+                    break
+        except sqlite3.Error as e:
+            logging.warning(f"Message store read failed, fetching from Discord: {e}")
+            since = min(before[0], now)
+
+        fetched = []
+        try:
+            async for message in channel.history(limit=None, before=as_datetime(since)):
+                fetched.append(message)
+                yield message
+        finally:
+            if fetched:
+                await self._run(self._add, fetched)
+                await self._run(self._cover, channel.id, fetched[-1].created_at.timestamp(), since)
+
+    async def _coverage(self, channel, now):
+        intervals, sessions, first_received = await asyncio.to_thread(self._intervals, channel.id, channel.guild.id)
+        session = self.sessions.get(channel.guild.id)
+        if self.live and session:
+            sessions.append((session[1], now))
+        # The sessions of the guild only cover the channel since the gateway delivered messages from it
+        if first_received is not None:
+            intervals += [(max(start, first_received), stop) for start, stop in sessions if stop > first_received]
+        return intervals
+
+    async def _run(self, func, *args):
+        try:
+            return await asyncio.to_thread(func, *args)
+        except sqlite3.Error as e:
+            logging.warning(f"Message store {func.__name__[1:]} failed: {e}")
+            return None
+
+    def _connect(self):
+        if self.connection is None:
+            directory = os.path.dirname(self.path)
+            if directory:
+                os.makedirs(directory, exist_ok=True)
+            connection = sqlite3.connect(self.path, check_same_thread=False)
+            connection.execute("PRAGMA journal_mode=WAL")
+            connection.execute("CREATE TABLE IF NOT EXISTS messages "
+                               "(id INTEGER PRIMARY KEY, channel_id INTEGER NOT NULL, author_id INTEGER NOT NULL, "
+                               "author_name TEXT NOT NULL, content TEXT NOT NULL, mentions TEXT NOT NULL, "
+                               "created REAL NOT NULL, tokens INTEGER NOT NULL, encoding TEXT NOT NULL)")
+            connection.execute("CREATE INDEX IF NOT EXISTS messages_channel_created ON messages (channel_id, created)")
+            connection.execute("CREATE TABLE IF NOT EXISTS coverage "
+                               "(channel_id INTEGER NOT NULL, start REAL NOT NULL, stop REAL NOT NULL)")
+            connection.execute("CREATE INDEX IF NOT EXISTS coverage_channel ON coverage (channel_id, start)")
+            connection.execute("CREATE TABLE IF NOT EXISTS sessions (guild_id INTEGER NOT NULL, start REAL NOT NULL, stop REAL NOT NULL)")
+            connection.execute("CREATE TABLE IF NOT EXISTS channels (channel_id INTEGER PRIMARY KEY, first_received REAL NOT NULL)")
+            connection.commit()
+            self.connection = connection
+            logging.info(f"Message store opened at {self.path}")
+        return self.connection
+
+    def _add(self, messages, session=None):
+        texts = [format_message_line(message) or "" for message in messages]
+        counts = get_message_tokens_batch(texts, self.model_name)
+        rows = [(message.id, message.channel.id, message.author.id, message.author.display_name, message.content or "",
+                 json.dumps([(user.id, user.display_name) for user in message.mentions]),
+                 message.created_at.timestamp(), count, self.encoding)
+                for message, count in zip(messages, counts)]
+        with self.lock:
+            connection = self._connect()
+            connection.executemany("INSERT OR REPLACE INTO messages VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?)", rows)
+            if session is not None:
+                connection.execute("UPDATE sessions SET stop = ? WHERE rowid = ?", (time.time(), session))
+                connection.executemany("INSERT OR IGNORE INTO channels VALUES (?, ?)",
+                                       [(row[1], row[6]) for row in rows])
+            connection.commit()
+
+    def _edit(self, message_id, content):
+        with self.lock:
+            connection = self._connect()
+            row = connection.execute("SELECT author_name FROM messages WHERE id = ?", (message_id,)).fetchone()
+        if row is None:
+            return
+        count = get_message_tokens_batch([format_message_line(f"{row[0]}: {content}") or ""], self.model_name)[0]
+        with self.lock:
+            connection.execute("UPDATE messages SET content = ?, tokens = ?, encoding = ? WHERE id = ?",
+                               (content, count, self.encoding, message_id))
+            connection.commit()
+
+    def _delete(self, message_ids):
+        with self.lock:
+            connection = self._connect()
+            connection.executemany("DELETE FROM messages WHERE id = ?", [(id,) for id in message_ids])
+            connection.commit()
+
+    def _start_session(self, guild_id, now):
+        with self.lock:
+            connection = self._connect()
+            session = connection.execute("INSERT INTO sessions VALUES (?, ?, ?)", (guild_id, now, now)).lastrowid
+            connection.commit()
+        return session
+
+    def _extend_sessions(self, sessions, now):
+        with self.lock:
+            connection = self._connect()
+            connection.executemany("UPDATE sessions SET stop = ? WHERE rowid = ?", [(now, session) for session in sessions])
+            connection.commit()
+
+    def _cover(self, channel_id, start, stop):
+        # Overlapping or touching ranges of the channel are merged into one
+        with self.lock:
+            connection = self._connect()
+            rows = connection.execute("SELECT rowid, start, stop FROM coverage "
+                                      "WHERE channel_id = ? AND start <= ? AND stop >= ?", (channel_id, stop, start)).fetchall()
+            start = min([start] + [row[1] for row in rows])
+            stop = max([stop] + [row[2] for row in rows])
+            connection.executemany("DELETE FROM coverage WHERE rowid = ?", [(row[0],) for row in rows])
+            connection.execute("INSERT INTO coverage VALUES (?, ?, ?)", (channel_id, start, stop))
+            connection.commit()
+
+    def _intervals(self, channel_id, guild_id):
+        with self.lock:
+            connection = self._connect()
+            intervals = connection.execute("SELECT start, stop FROM coverage WHERE channel_id = ?", (channel_id,)).fetchall()
+            sessions = connection.execute("SELECT start, stop FROM sessions WHERE guild_id = ?", (guild_id,)).fetchall()
+            row = connection.execute("SELECT first_received FROM channels WHERE channel_id = ?", (channel_id,)).fetchone()
+        return intervals, sessions, row[0] if row else None
+
+    def _read(self, channel_id, start, end):
+        with self.lock:
+            connection = self._connect()
+            return connection.execute("SELECT * FROM messages WHERE channel_id = ? AND created > ? AND created < ? "
+                                      "ORDER BY created, id", (channel_id, start, end)).fetchall()
+
+    def _page(self, channel_id, since, before):
+        with self.lock:
+            connection = self._connect()
+            return connection.execute("SELECT * FROM messages WHERE channel_id = ? AND created >= ? AND (created, id) < (?, ?) "
+                                      "ORDER BY created DESC, id DESC LIMIT ?",
+                                      (channel_id, since, *before, MESSAGE_STORE_PAGE)).fetchall()
+
+    def _prune(self, now):
+        cutoff = now - self.retention
+        with self.lock:
+            connection = self._connect()
+            pruned = connection.execute("DELETE FROM messages WHERE created < ?", (cutoff,)).rowcount
+            for table in ("coverage", "sessions"):
+                connection.execute(f"DELETE FROM {table} WHERE stop < ?", (cutoff,))
+                connection.execute(f"UPDATE {table} SET start = ? WHERE start < ?", (cutoff, cutoff))
+            connection.commit()
+        if pruned:
+            logging.info(f"Message store pruned {pruned} messages older than {self.retention} seconds")
+
+
+def as_datetime(timestamp):
+    return datetime.fromtimestamp(timestamp, timezone.utc)
+
+
+message_store = MessageStore()
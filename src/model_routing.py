@@ -0,0 +1,47 @@
+# Description: This file contains the routing of calls between models.
+#  The model a user or the webhook chose makes the final summary and the calls with big inputs. The other calls,
+#  such as the summaries of the chunks of a long conversation and the merges before the last one, are small and
+#  only feed later calls, so they go to the model of ROUTING_MODELS that is cheaper for their size without being
+#  slower, using the prices, latency and output speed of the MODELS table.
+
+import logging
+
+from constants import MODELS, OUTPUT_TOKEN_RESERVE, ROUTE_MODELS, ROUTING_MODELS, ROUTING_MAX_TOKENS, ROUTING_OUTPUT_TOKENS
+
+
+def route_model(model, tokens, final=False):
+    """
+    Picks the model for one call.
+
+    Args:
+        model (dict): The requested model, from MODELS.
+        tokens (int): The input tokens of the call.
+        final (bool): Whether the call gives the final summary.
+
+    Returns:
+        dict: The model to use, from MODELS.
+    """
+    if not ROUTE_MODELS or final or tokens > ROUTING_MAX_TOKENS:
+        return model
+
+    best = model
+    for name in ROUTING_MODELS:
+        candidate = MODELS[name]
+        if candidate["context_length"] < tokens + OUTPUT_TOKEN_RESERVE:
+            continue
+        if call_price(candidate, tokens) < call_price(best, tokens) and call_latency(candidate) <= call_latency(model):
+            best = candidate
+
+    if best is not model:
+        logging.debug(f"Routing a call of {tokens} tokens from {model['name']} to {best['name']}")
+    return best
+
+
+def call_price(model, tokens):
+    """The price of a call in dollars, for a summary of ROUTING_OUTPUT_TOKENS tokens."""
+    return (model["price_in"] * tokens + model["price_out"] * ROUTING_OUTPUT_TOKENS) / 1000000
+
+
+def call_latency(model):
+    """The seconds a call takes, for a summary of ROUTING_OUTPUT_TOKENS tokens."""
+    return model["latency"] + ROUTING_OUTPUT_TOKENS / model["output_speed"]
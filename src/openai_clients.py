@@ -0,0 +1,215 @@
+# Description: This file contains the pool of OpenAI clients, one per API key.
+#  Users and servers bring their own keys, so `openai_client` hands out an AsyncOpenAI client per key, each with its
+#  own keep-alive connection pool sized by the OPENAI_* settings in constants.py. Clients are reused across chunks
+#  and commands, so a call only pays for a TLS handshake when its key has been idle. Clients idle for longer than
+#  OPENAI_CLIENT_IDLE_SECONDS, or the least recently used ones beyond OPENAI_CLIENT_POOL_SIZE, are closed.
+#  `create_chat_completion` and `stream_chat_completion` make calls paced by the key's rate limiter and adaptive
+#  concurrency, and retry them. OPENAI_BASE_URL points the clients at another server, e.g. bin/fake_openai_server.py.
+
+import asyncio
+import logging
+import random
+import time
+from collections import OrderedDict
+from contextlib import asynccontextmanager
+
+import httpx
+from openai import AsyncOpenAI, DefaultAsyncHttpxClient, RateLimitError, APIConnectionError, InternalServerError, NOT_GIVEN
+
+from ai_chunking import estimate_tokens, get_encoding_name
+from constants import OPENAI_MAX_CONNECTIONS, OPENAI_MAX_KEEPALIVE_CONNECTIONS, OPENAI_KEEPALIVE_EXPIRY, OPENAI_TIMEOUT, OPENAI_CONNECT_TIMEOUT
+from constants import OPENAI_BASE_URL, OPENAI_CLIENT_POOL_SIZE, OPENAI_CLIENT_IDLE_SECONDS, OPENAI_RETRIES, RETRY_BASE_DELAY, RETRY_MAX_DELAY
+from rate_limiter import get_rate_limiter
+
+MESSAGE_OVERHEAD_TOKENS = 4  # role and separators of each chat message
+# Failures that mean the key or the API is overloaded. APIConnectionError includes timeouts.
+OVERLOAD_ERRORS = (RateLimitError, APIConnectionError, InternalServerError)
+
+
+class PooledClient:
+    def __init__(self, api_key):
+        http_client = DefaultAsyncHttpxClient(
+            limits=httpx.Limits(max_connections=OPENAI_MAX_CONNECTIONS,
+                                max_keepalive_connections=OPENAI_MAX_KEEPALIVE_CONNECTIONS,
+                                keepalive_expiry=OPENAI_KEEPALIVE_EXPIRY),
+            timeout=httpx.Timeout(OPENAI_TIMEOUT, connect=OPENAI_CONNECT_TIMEOUT),
+        )
+        # create_chat_completion retries, so the outcome of every attempt reaches the key's limiter
+        self.client = AsyncOpenAI(api_key=api_key, base_url=OPENAI_BASE_URL, http_client=http_client, max_retries=0)
+        self.in_use = 0
+        self.last_used = time.monotonic()
+
+
+# API key -> PooledClient, least recently used first. Only used from the bot's event loop.
+_clients = OrderedDict()
+
+
+@asynccontextmanager
+async def openai_client(api_key):
+    """
+    Lends the pooled AsyncOpenAI client of an API key, creating it on first use.
+
+    Args:
+        api_key (str): The OpenAI API key the client sends.
+
+    Yields:
+        AsyncOpenAI: The client. It stays open at least until the block exits.
+
+    Example:
+        async with openai_client(api_key) as client:
+            response = await client.chat.completions.create(...)
+    """
+    pooled = _clients.get(api_key)
+    if pooled is None:
+        pooled = _clients[api_key] = PooledClient(api_key)
+        logging.debug(f"Created OpenAI client {len(_clients)} of the pool")
+    _clients.move_to_end(api_key)
+    pooled.in_use += 1
+    try:
+        yield pooled.client
+    finally:
+        pooled.in_use -= 1
+        pooled.last_used = time.monotonic()
+        await evict_clients()
+
+
+async def evict_clients(idle_seconds=OPENAI_CLIENT_IDLE_SECONDS, pool_size=OPENAI_CLIENT_POOL_SIZE):
+    """
+    Closes the clients that are not in use and either idle for too long or beyond the pool size.
+
+    Args:
+        idle_seconds (float): Seconds after which an unused client is closed.
+        pool_size (int): Clients kept open, the least recently used are closed first.
+    """
+    now = time.monotonic()
+    excess = len(_clients) - pool_size
+    for api_key, pooled in list(_clients.items()):
+        if pooled.in_use:
+            continue
+        if excess > 0 or now - pooled.last_used > idle_seconds:
+            del _clients[api_key]
+            excess -= 1
+            await pooled.client.close()
+            logging.debug("Closed an idle OpenAI client")
+
+
+async def close_clients():
+    """Closes every pooled client, e.g. when the bot shuts down."""
+    while _clients:
+        _, pooled = _clients.popitem()
+        await pooled.client.close()
+
+
+async def create_chat_completion(api_key, model, messages, max_tokens=None):
+    """
+    Creates a chat completion with the pooled client of an API key, paced by the key's rate limiter.
+
+    The call waits for a slot of the key's adaptive concurrency and for its rate limits, which are learned
+    from the response headers. After a 429, a timeout or a server error the concurrency is cut and only this
+    call is retried, after a jittered exponential delay, up to OPENAI_RETRIES times.
+
+    Args:
+        api_key (str): The OpenAI API key.
+        model (str): The model name.
+        messages (list): The chat messages.
+        max_tokens (int, optional): The output tokens allowed, see output_budget.py.
+
+    Returns:
+        ChatCompletion: The completion. Its finish_reason is "length" if max_tokens cut it.
+
+    Raises:
+        openai.APIError: If the call still fails after the retries, or fails for another reason.
+    """
+    async def request(client):
+        raw_response = await client.chat.completions.with_raw_response.create(model=model, messages=messages,
+                                                                              max_tokens=max_tokens or NOT_GIVEN)
+        return raw_response.headers, raw_response.parse()
+
+    return await paced_call(api_key, model, messages, request)
+
+
+async def stream_chat_completion(api_key, model, messages, on_text, max_tokens=None):
+    """
+    Streams a chat completion, paced and retried like `create_chat_completion`.
+
+    Args:
+        api_key (str): The OpenAI API key.
+        model (str): The model name.
+        messages (list): The chat messages.
+        on_text (coroutine function): Called with the text received so far, as it grows.
+            If the call is retried the text starts over.
+        max_tokens (int, optional): The output tokens allowed, see output_budget.py.
+
+    Returns:
+        tuple: The whole text of the completion and its finish_reason, "length" if max_tokens cut it.
+    """
+    async def request(client):
+        raw_response = await client.chat.completions.with_raw_response.create(model=model, messages=messages, stream=True,
+                                                                              max_tokens=max_tokens or NOT_GIVEN)
+        text = ""
+        finish_reason = None
+        async for chunk in raw_response.parse():
+            if chunk.choices and chunk.choices[0].delta.content:
+                text += chunk.choices[0].delta.content
+                await on_text(text)
+            if chunk.choices and chunk.choices[0].finish_reason:
+                finish_reason = chunk.choices[0].finish_reason
+        return raw_response.headers, (text, finish_reason)
+
+    return await paced_call(api_key, model, messages, request)
+
+
+async def paced_call(api_key, model, messages, request):
+    """
+    Makes a request with the pooled client of an API key, within its adaptive concurrency and rate limits, and retries it.
+
+    Args:
+        api_key (str): The OpenAI API key.
+        model (str): The model name.
+        messages (list): The chat messages, whose tokens are taken from the key's token bucket.
+        request (coroutine function): Makes the request with the client, returns the response headers and the result.
+
+    Returns:
+        The result of `request`.
+    """
+    limiter = get_rate_limiter(api_key, model)
+    encoding_name = get_encoding_name(model)
+    tokens = sum(estimate_tokens(message["content"], encoding_name)[2] + MESSAGE_OVERHEAD_TOKENS for message in messages)
+
+    for attempt in range(OPENAI_RETRIES + 1):
+        started = await limiter.concurrency.acquire()
+        try:
+            await limiter.acquire(tokens)
+            async with openai_client(api_key) as client:
+                headers, result = await request(client)
+        except OVERLOAD_ERRORS as e:
+            if is_out_of_quota(e):
+                # No retry succeeds until the account gets credit, and OpenAI isn't overloaded
+                await limiter.concurrency.release(started)
+                raise
+            await limiter.concurrency.release(started, overloaded=True)
+            if isinstance(e, RateLimitError):
+                limiter.pause(e.response.headers)
+            if attempt == OPENAI_RETRIES:
+                raise
+            delay = retry_delay(attempt)
+            logging.warning(f"{type(e).__name__} from OpenAI, retrying in {delay:.1f}s")
+            await asyncio.sleep(delay)
+            continue
+        except BaseException:
+            await limiter.concurrency.release(started)
+            raise
+
+        await limiter.concurrency.release(started)
+        limiter.update(headers)
+        return result
+
+
+def is_out_of_quota(error):
+    """Whether an error is the 429 of a key whose account has run out of credit, rather than a rate limit."""
+    return isinstance(error, RateLimitError) and "insufficient_quota" in (error.code, error.type)
+
+
+def retry_delay(attempt):
+    """Exponential backoff with full jitter, so retried calls don't come back at the same time."""
+    return random.uniform(0, min(RETRY_MAX_DELAY, RETRY_BASE_DELAY * 2 ** attempt))
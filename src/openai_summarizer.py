@@ -1,6 +1,16 @@
-from openai import OpenAI
+from openai import RateLimitError
+import asyncio
 import os
 from async_lru_cache import AsyncLRUCache
+from summary_cache import SummaryCache, cache_key
+from single_flight import SingleFlight
+from openai_clients import create_chat_completion
+from batch_api import batch_requests, pending_summary, is_pending, wait_for_batch
+from ai_chunking import estimate_tokens, get_encoding_name
+from model_routing import route_model
+from output_budget import output_token_cap
+from map_reduce import gather_or_cancel
+from constants import MODELS, WEBHOOK_MODEL, SUMMARY_MEMORY_CACHE_BYTES, SUMMARY_MEMORY_CACHE_COMPRESS, BATCH_POLL_INTERVAL
 import logging
 
 logging.basicConfig(level=logging.DEBUG)
@@ -9,11 +19,16 @@ api_key = os.getenv("OPENAI_API_KEY")
 if not api_key:
     raise ValueError("OPENAI_API_KEY environment variable not set")
 
-client = OpenAI(
-    api_key=api_key,  # This is the default and can be omitted
-)
+cache = AsyncLRUCache(SUMMARY_MEMORY_CACHE_BYTES, SUMMARY_MEMORY_CACHE_COMPRESS)
+summary_cache = SummaryCache()  # persistent, survives deploys and restarts
+in_flight = SingleFlight()  # identical summaries requested at the same time are made once
+
+DEFAULT_AI_PROMPTS = {
+    "formatting_instructions": "FFormat my answer in Markdown.",
+    "context_prompt": "I’d like to ask you for a summary of a chat conversation. First, I will provide you with the context of the conversation so that you can better understand what it’s about, and then I will write the continuation, for which I will ask you to summarize and highlight the most important points. Here is the context:",
+    "recent_messages_prompt": "Now, please summarize the following conversation, highlighting the most important elements in bold. Include the instructions I gave you.",
+}
 
-cache = AsyncLRUCache()
 class OpenAISummarizer:
     def __init__(self):
         """
@@ -23,34 +38,114 @@ class OpenAISummarizer:
         to the DEBUG level.
         """
         self.calls = 0
+        self.truncated = 0
+        self.model = MODELS[WEBHOOK_MODEL]
         logging.basicConfig(level=logging.INFO)
 
-    async def get_cached_summary_from_ai(self, owner_to_messages, channel_messages, ai_prompts):     
+    async def get_cached_summary_from_ai(self, owner_to_messages, channel_messages, ai_prompts, final=True):     
         """
         Asynchronously retrieves a summary for the given messages. If a cached summary exists, it returns the cached result.
         Otherwise, it calls the OpenAI summarization API, caches the result, and returns it.
+        Summaries are cached in memory and on disk, both addressed by a digest of the model and the whole prompt.
+        A request identical to one already in flight, e.g. from a scheduled job and a webhook call, awaits its result.
+        Within `summarize_in_batches`, a missing summary is collected for a batch job and a pending placeholder is returned.
+        Calls that don't give the final summary may be routed to a cheaper model by `route_model`, and their output
+        is capped by `output_token_cap`.
 
         Args:
             owner_of_messages (list): A list of message owners.
             channel_messages (list): A list of messages from the channel.
             ai_prompts (dict): A dictionary of AI prompts to use for summarization.
+            final (bool): Whether the summary is the final one, rather than e.g. that of a chunk to be merged.
 
         Returns:
             str: The summary of the provided messages.
         """
         if ai_prompts is None:
            ai_prompts = {}
-        key = (tuple(owner_to_messages), tuple(channel_messages))
+        prompt = self.build_prompt(owner_to_messages, channel_messages, ai_prompts)
+        encoding_name = get_encoding_name(self.model["name"])
+        prompt_tokens = estimate_tokens(prompt, encoding_name)[1]
+        message_tokens = estimate_tokens(str(channel_messages), encoding_name)[1]
+        model_name = route_model(self.model, prompt_tokens, final)["name"]
+        max_tokens = output_token_cap(self.model, message_tokens, final, prompt_tokens - message_tokens)
+        # A fixed-size digest, not the conversation itself, so the keys don't grow with the messages
+        key = cache_key(model_name, max_tokens, prompt)
         cached_result = await cache.get(key)
         if cached_result is not None:
             return cached_result
-        else:
-            result = await self.call_openai_summarize(owner_to_messages, channel_messages, ai_prompts)
+
+        # A summary being collected for a batch job is a placeholder, which must not be shared with a live request
+        flight_key = key if batch_requests.get() is None else "batch:" + key
+        return await in_flight.do(flight_key, self.get_summary_from_persistent_cache_or_ai, key, model_name, max_tokens, owner_to_messages, channel_messages, ai_prompts)
+
+    async def get_summary_from_persistent_cache_or_ai(self, key, model_name, max_tokens, owner_to_messages, channel_messages, ai_prompts):
+        result = await summary_cache.get(key)
+        logging.debug("Summary cache: %s", summary_cache.stats())
+        if result is None:
+            requests = batch_requests.get()
+            if requests is not None:
+                requests[key] = (model_name, self.build_prompt(owner_to_messages, channel_messages, ai_prompts), max_tokens)
+                return pending_summary(key)
+            result, finish_reason = await self.call_openai_summarize(owner_to_messages, channel_messages, ai_prompts, model_name, max_tokens)
             #await self.debug_summary_to_file(result, owner_of_messages, channel_messages)
-            await cache.set(key, result)
-            return result
+            if finish_reason != "stop":
+                # Cut or refused summaries aren't cached, so a later identical request makes the summary again
+                return result
+            await summary_cache.set(key, result)
+        await cache.set(key, result)
+        return result
+
+    async def summarize_in_batches(self, jobs, backend, poll_interval=BATCH_POLL_INTERVAL):
+        """
+        Runs summary jobs with batch jobs instead of one call per summary, for work that is not latency-sensitive.
+        The jobs are run while collecting the summaries missing from the caches, then the collected requests that
+        don't depend on a pending summary are submitted as one batch job per model and their results cached. This is
+        repeated for each level of the summaries (context briefs, chunks, merges), until the jobs run from the cache.
+
+        Args:
+            jobs (list): Coroutine functions without arguments, each making a summary, e.g. of a period.
+            backend (OpenAIBatchBackend | LocalBatchBackend): Where the batch jobs are submitted.
+            poll_interval (float): Seconds between two checks of a batch job.
+
+        Returns:
+            list: The result of each job.
+        """
+        while True:
+            requests = {}
+            token = batch_requests.set(requests)
+            try:
+                results = await gather_or_cancel(*(job() for job in jobs))
+            finally:
+                batch_requests.reset(token)
+            if not requests:
+                return results
+
+            # Requests built on a pending summary wait for a later batch job
+            ready = {key: request for key, request in requests.items() if not is_pending(request[1])}
+            if not ready:
+                raise RuntimeError(f"The {len(requests)} requests collected for a batch job all depend on pending summaries")
+            logging.info(f"Submitting {len(ready)} of {len(requests)} collected requests as batch jobs")
+
+            # A batch job is for one model, calls routed to different models go in different jobs
+            by_model = {}
+            caps = {}
+            for key, (model_name, prompt, max_tokens) in ready.items():
+                by_model.setdefault(model_name, {})[key] = prompt
+                caps.setdefault(model_name, {})[key] = max_tokens
+            batch_ids = [await backend.submit(prompts, model_name, caps[model_name]) for model_name, prompts in by_model.items()]
+            summaries = {}
+            for result in await asyncio.gather(*(wait_for_batch(backend, batch_id, poll_interval) for batch_id in batch_ids)):
+                summaries.update(result)
+            missing = len(ready.keys() - summaries.keys())
+            if missing:
+                # The summaries made so far are cached, a new run carries on from there
+                raise RuntimeError(f"{missing} requests of batches {batch_ids} failed")
+            for key, summary in summaries.items():
+                await summary_cache.set(key, summary)
+                await cache.set(key, summary)
 
-    async def call_openai_summarize(self, owner_to_messages, messages_in_channel, ai_prompts):
+    async def call_openai_summarize(self, owner_to_messages, messages_in_channel, ai_prompts, model_name=None, max_tokens=None):
         """
         :param owner_to_messages: The context of the conversation to provide background information.
         :type owner_to_messages: str
@@ -58,8 +153,12 @@ class OpenAISummarizer:
         :type messages_in_channel: str
         :param ai_prompts: Dictionary containing various AI prompts for formatting and context.
         :type ai_prompts: dict
-        :return: The summarized conversation, formatted in HTML if specified.
-        :rtype: str
+        :param model_name: The OpenAI model to use, by default that of the summarizer.
+        :type model_name: str
+        :param max_tokens: The output tokens allowed to the call, unlimited if None.
+        :type max_tokens: int
+        :return: The summarized conversation, formatted in HTML if specified, and the finish reason of the call.
+        :rtype: tuple
         :raises Exception: If there is an issue with the OpenAI API call.
         .. note::
         Asynchronously calls the OpenAI API to summarize a chat conversation.
@@ -74,19 +173,7 @@ class OpenAISummarizer:
         logging.debug("Owners:messages: %s", owner_to_messages)
         #logging.debug("Messages in channel: %s", messages_in_channel)
 
-        prompt0 = ai_prompts.get("formatting_instructions", "FFormat my answer in Markdown.")
-        prompt1 = ai_prompts.get("context_prompt", "I’d like to ask you for a summary of a chat conversation. First, I will provide you with the context of the conversation so that you can better understand what it’s about, and then I will write the continuation, for which I will ask you to summarize and highlight the most important points. Here is the context:")
-        prompt2 = ai_prompts.get("recent_messages_prompt","Now, please summarize the following conversation, highlighting the most important elements in bold. Include the instructions I gave you.")
-        
-        ai_prompt = f"{prompt0}: \n\n"+ \
-                    f"{prompt1}: \n\n"+ \
-                    f"{'-' * 10}\n"+ \
-                    f"{owner_to_messages}\n"+ \
-                    f"{'-' * 10}\n\n"+ \
-                     ">>>"+ \
-                    f"{prompt0}: \n\n"+ \
-                    f"{prompt2}:\n\n\n"+ \
-                    f"{messages_in_channel}"
+        ai_prompt = self.build_prompt(owner_to_messages, messages_in_channel, ai_prompts)
         
         # TODO: implement MODES and INTRO_MESSAGE
         #mode = "standard"
@@ -98,32 +185,66 @@ class OpenAISummarizer:
         #logging.debug(ai_prompt)
 
         try:
-            chat_completion = client.chat.completions.create(
-                messages=[
-                    {
-                        "role": "assistant",
-                        "content": ai_prompt
-                    }
-                ],
-                model="gpt-4o",
-            )
-
-            response = chat_completion.choices[0].message.content
-            
-        # TODO: decide whether to use httpx instead of the OpenAI Python client library to capture the headers
-        #    await self.debug_openai_response_headers(headers)
-
-            return response
-        except OpenAI.error.RateLimitError as e:
-            logging.error(f"Rate limit exceeded. Retry after {e.headers.get('retry-after', 'unknown')} seconds.")
+            # Async, so a completion doesn't block the bot's event loop, and paced by the key's rate limiter,
+            # which reads the headers shown by debug_openai_response_headers
+            chat_completion = await create_chat_completion(api_key,
+                                                           model_name or self.model["name"],
+                                                           [
+                                                               {
+                                                                   "role": "assistant",
+                                                                   "content": ai_prompt
+                                                               }
+                                                           ],
+                                                           max_tokens)
+
+            choice = chat_completion.choices[0]
+            if choice.finish_reason == "length":
+                # Cut short at max_tokens, the summary is kept but reported
+                self.truncated += 1
+                logging.warning(f"Call number {self.calls} reached its limit of {max_tokens} output tokens")
+            response = choice.message.content
+            if response is None:
+                # A refusal or a content filter stop has no text
+                logging.warning(f"Call number {self.calls} gave no summary, finish reason {choice.finish_reason}")
+                response = ""
+
+            return response, choice.finish_reason
+        except RateLimitError as e:
+            logging.error(f"Rate limit exceeded. Retry after {e.response.headers.get('retry-after', 'unknown')} seconds.")
 
             raise
 
 
+    def build_prompt(self, owner_to_messages, messages_in_channel, ai_prompts):
+        """
+        Builds the prompt sent to OpenAI for one chunk of a conversation.
+
+        Args:
+            owner_to_messages (str): The context of the conversation.
+            messages_in_channel (str): The conversation messages to summarize.
+            ai_prompts (dict): Dictionary containing various AI prompts for formatting and context.
+
+        Returns:
+            str: The prompt. Called with empty messages it gives the fixed part the chunk planner budgets for.
+        """
+        prompt0 = ai_prompts.get("formatting_instructions", DEFAULT_AI_PROMPTS["formatting_instructions"])
+        prompt1 = ai_prompts.get("context_prompt", DEFAULT_AI_PROMPTS["context_prompt"])
+        prompt2 = ai_prompts.get("recent_messages_prompt", DEFAULT_AI_PROMPTS["recent_messages_prompt"])
+        
+        return f"{prompt0}: \n\n"+ \
+               f"{prompt1}: \n\n"+ \
+               f"{'-' * 10}\n"+ \
+               f"{owner_to_messages}\n"+ \
+               f"{'-' * 10}\n\n"+ \
+                ">>>"+ \
+               f"{prompt0}: \n\n"+ \
+               f"{prompt2}:\n\n\n"+ \
+               f"{messages_in_channel}"
+
     async def debug_openai_response_headers(self, headers):
         """
-        To get the response headers from the chat_completion call in the call_openai_summarize method, you would need to access the headers from the response object. 
-        However, the OpenAI Python client library does not directly expose response headers. You would need to modify the library or use a lower-level HTTP client like requests or httpx to capture the headers.
+        Prints the rate limit headers of an OpenAI response.
+        create_chat_completion reads the same headers with `with_raw_response` to feed the key's rate limiter.
         """
         print("Rate Limit Info:")
         print(f"Requests Allowed: {headers.get('x-ratelimit-limit-requests')}")
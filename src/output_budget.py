@@ -0,0 +1,34 @@
+# Description: This file contains the output token caps of the calls to OpenAI.
+#  Without a cap, one verbose chunk summary can run for a minute and hold up the whole summary. A summary that will
+#  be merged gets a share of what it summarizes, scaled by the summary mode and bounded by its share of the next
+#  merge's input budget. The final summary gets the output reserve the chunk planner keeps free. A call that reaches
+#  its cap ends with finish_reason "length", which the callers report.
+
+from ai_chunking import input_token_budget
+from constants import OUTPUT_TOKEN_RESERVE, OUTPUT_TOKEN_SHARE, OUTPUT_TOKEN_MIN, MODE_OUTPUT_FACTORS, REDUCE_FAN_IN
+
+
+def output_token_cap(model, input_tokens, final=False, merge_tokens=0, mode=None, fan_in=REDUCE_FAN_IN):
+    """
+    Computes the output tokens allowed to one call.
+
+    Args:
+        model (dict): Model information containing the name and context length.
+        input_tokens (int): The tokens of the text the call summarizes, without the prompt.
+        final (bool): Whether the call gives the final summary.
+        merge_tokens (int): Tokens sent with every merge besides the summaries.
+        mode (str, optional): The summary mode, e.g. "brief" or "descriptive".
+        fan_in (int): Summaries merged by one call at most.
+
+    Returns:
+        int: The max_tokens of the call.
+    """
+    factor = MODE_OUTPUT_FACTORS.get(mode, 1.0)
+    reserve = min(OUTPUT_TOKEN_RESERVE, model["context_length"] // 4)
+    if final:
+        return min(reserve, int(reserve * factor))
+
+    cap = max(OUTPUT_TOKEN_MIN, int(input_tokens * OUTPUT_TOKEN_SHARE * factor))
+    # Up to fan_in summaries are merged by one call, together they must fit its input
+    merge_share = input_token_budget(model, merge_tokens) // fan_in
+    return max(1, min(cap, merge_share, reserve))
@@ -0,0 +1,220 @@
+# Description: This file contains the per API key rate limiter that paces calls to OpenAI.
+#  Each key has a request bucket and a token bucket. Their capacity and content are learned from the
+#  x-ratelimit-* headers of OpenAI's responses and they refill at the per-minute limit in between, so calls wait
+#  for capacity instead of running into 429 errors. Until a key's first response, calls are not paced.
+#  Each key also has an adaptive concurrency limit: it grows additively while calls succeed and is cut
+#  multiplicatively after a 429, a timeout or a server error, so every key settles near the parallelism it can take.
+
+import asyncio
+import logging
+import re
+import time
+
+from cachetools import LRUCache
+
+from constants import RATE_LIMITER_CACHE_SIZE, AIMD_INITIAL_CONCURRENCY, AIMD_MAX_CONCURRENCY, AIMD_INCREASE, AIMD_DECREASE
+
+DURATION = re.compile(r"(\d+(?:\.\d+)?)(ms|s|m|h)")
+DURATION_UNITS = {"ms": 0.001, "s": 1, "m": 60, "h": 3600}
+
+
+def parse_duration(value):
+    """
+    Parses an OpenAI reset duration such as '1s', '6m0s' or '20ms'.
+
+    Args:
+        value (str): The header value.
+
+    Returns:
+        float: The duration in seconds, or None if it can't be parsed.
+    """
+    if not value:
+        return None
+    parts = DURATION.findall(value)
+    if not parts:
+        return None
+    return sum(float(amount) * DURATION_UNITS[unit] for amount, unit in parts)
+
+
+class TokenBucket:
+    """
+    A bucket of capacity `limit`, refilled at `limit` per minute, as OpenAI's limits are.
+    """
+
+    def __init__(self):
+        self.limit = None       # unknown until the first response, not paced meanwhile
+        self.available = 0.0
+        self.updated = time.monotonic()
+
+    def refill(self, now):
+        if self.limit:
+            self.available = min(self.limit, self.available + (now - self.updated) * self.limit / 60)
+        self.updated = now
+
+    def wait_time(self, amount, now):
+        """Seconds until `amount` is available, 0 if it is now."""
+        if not self.limit:
+            return 0
+        self.refill(now)
+        amount = min(amount, self.limit)
+        if self.available >= amount:
+            return 0
+        return (amount - self.available) * 60 / self.limit
+
+    def take(self, amount):
+        if self.limit:
+            self.available -= min(amount, self.limit)
+
+    def update(self, limit, remaining, now):
+        if limit is None or remaining is None:
+            return
+        self.limit = limit
+        self.available = remaining
+        self.updated = now
+
+
+class AdaptiveConcurrency:
+    """
+    Limits the calls in flight, adapting the limit by additive increase / multiplicative decrease.
+    """
+
+    def __init__(self, initial=AIMD_INITIAL_CONCURRENCY, maximum=AIMD_MAX_CONCURRENCY):
+        self.limit = float(initial)
+        self.maximum = maximum
+        self.in_flight = 0
+        self.last_decrease = 0.0
+        self.last_saturated = -1.0
+        self.condition = asyncio.Condition()
+
+    async def acquire(self):
+        """
+        Waits for a free slot and takes it.
+
+        Returns:
+            float: The time the call started, to pass to `release`.
+        """
+        async with self.condition:
+            await self.condition.wait_for(lambda: self.in_flight < int(self.limit))
+            self.in_flight += 1
+            started = time.monotonic()
+            if self.in_flight >= int(self.limit):
+                self.last_saturated = started
+        return started
+
+    async def release(self, started, overloaded=False):
+        """
+        Frees a slot and adapts the limit to the outcome of its call.
+
+        Args:
+            started (float): The time returned by `acquire`.
+            overloaded (bool): Whether the call failed with a 429, a timeout or a server error.
+        """
+        async with self.condition:
+            self.in_flight -= 1
+            if overloaded:
+                # Calls started before the last decrease saw the same overload, cut once for all of them
+                if started >= self.last_decrease:
+                    self.limit = max(1.0, self.limit * AIMD_DECREASE)
+                    self.last_decrease = time.monotonic()
+                    logging.info(f"Concurrency cut to {int(self.limit)} after an overload")
+            elif self.last_saturated >= started:
+                # Only grow when the limit was reached while the call was in flight, not while there is little to do
+                self.limit = min(self.maximum, self.limit + AIMD_INCREASE / self.limit)
+            self.condition.notify_all()
+
+
+class RateLimiter:
+    """
+    Paces the calls made with one API key. Waiting calls are served in order.
+    """
+
+    def __init__(self):
+        self.requests = TokenBucket()
+        self.tokens = TokenBucket()
+        self.concurrency = AdaptiveConcurrency()
+        self.paused_until = 0.0
+        self.lock = asyncio.Lock()
+
+    async def acquire(self, tokens):
+        """
+        Waits until the key can make one more request of `tokens` tokens, and takes them.
+
+        Args:
+            tokens (int): The tokens the request is expected to use.
+        """
+        async with self.lock:
+            while True:
+                now = time.monotonic()
+                wait = max(self.paused_until - now,
+                           self.requests.wait_time(1, now),
+                           self.tokens.wait_time(tokens, now))
+                if wait <= 0:
+                    break
+                logging.debug(f"Rate limiter waiting {wait:.2f}s for {tokens} tokens")
+                await asyncio.sleep(wait)
+            self.requests.take(1)
+            self.tokens.take(tokens)
+
+    def update(self, headers):
+        """
+        Updates the buckets from the x-ratelimit-* headers of an OpenAI response.
+
+        Args:
+            headers (Mapping): The response headers.
+        """
+        now = time.monotonic()
+        self.requests.update(header_number(headers, "x-ratelimit-limit-requests"),
+                             header_number(headers, "x-ratelimit-remaining-requests"), now)
+        self.tokens.update(header_number(headers, "x-ratelimit-limit-tokens"),
+                           header_number(headers, "x-ratelimit-remaining-tokens"), now)
+
+    def pause(self, headers):
+        """
+        Stops all calls with the key after a 429, until the limit resets.
+
+        Args:
+            headers (Mapping): The headers of the 429 response.
+
+        Returns:
+            float: The seconds paused.
+        """
+        self.update(headers)
+        retry_after_ms = header_number(headers, "retry-after-ms")
+        if retry_after_ms is not None:
+            delay = retry_after_ms / 1000
+        else:
+            delay = header_number(headers, "retry-after") \
+                or max(parse_duration(headers.get("x-ratelimit-reset-requests")) or 0,
+                       parse_duration(headers.get("x-ratelimit-reset-tokens")) or 0) \
+                or 1.0
+        self.paused_until = max(self.paused_until, time.monotonic() + delay)
+        return delay
+
+
+def header_number(headers, name):
+    try:
+        return float(headers.get(name))
+    except (TypeError, ValueError):
+        return None
+
+
+# API key -> RateLimiter
+_limiters = LRUCache(maxsize=RATE_LIMITER_CACHE_SIZE)
+
+
+def get_rate_limiter(api_key, model=None):
+    """
+    Returns the rate limiter of an API key, creating it on first use.
+    OpenAI limits each model separately, so calls routed to different models are paced separately.
+
+    Args:
+        api_key (str): The OpenAI API key.
+        model (str, optional): The OpenAI model name.
+
+    Returns:
+        RateLimiter: The limiter of the key and model.
+    """
+    limiter = _limiters.get((api_key, model))
+    if limiter is None:
+        limiter = _limiters[(api_key, model)] = RateLimiter()
+    return limiter
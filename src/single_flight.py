@@ -0,0 +1,53 @@
+# Description: This file contains `SingleFlight`, which coalesces identical calls that are in flight at the same time.
+#  The first caller for a key starts the call, later callers for the same key await its result instead of
+#  repeating it. Once the call is done the key is forgotten, so later calls go through the caches as usual.
+#  A call nobody waits for anymore, e.g. because every summary it was for was abandoned, is cancelled.
+
+import asyncio
+import logging
+
+
+class SingleFlight:
+    def __init__(self):
+        self.calls = {}     # key -> task of the call in flight
+        self.waiters = {}   # task -> callers awaiting it
+        self.coalesced = 0
+
+    async def do(self, key, func, *args):
+        """
+        Runs `func(*args)`, unless a call for the same key is already in flight, whose result is then shared.
+
+        The call runs as its own task: a caller that is cancelled stops waiting for it but
+        doesn't cancel it for the other callers. The call is cancelled with its last caller.
+
+        Args:
+            key (Hashable): Identifies identical calls, e.g. the cache key of a summary.
+            func (coroutine function): Makes the call.
+            *args: The arguments of `func`.
+
+        Returns:
+            The result of the call. Its exception, if it fails, is raised to every caller.
+        """
+        task = self.calls.get(key)
+        if task is None:
+            task = asyncio.ensure_future(func(*args))
+            self.calls[key] = task
+            task.add_done_callback(lambda done: self.forget(key, done))
+        else:
+            self.coalesced += 1
+            logging.debug(f"Joined an identical call already in flight ({self.coalesced} so far)")
+        self.waiters[task] = self.waiters.get(task, 0) + 1
+        try:
+            return await asyncio.shield(task)
+        finally:
+            self.waiters[task] -= 1
+            if not self.waiters[task]:
+                del self.waiters[task]
+                if not task.done():
+                    logging.debug("Cancelling a call nobody waits for anymore")
+                    self.forget(key, task)
+                    task.cancel()
+
+    def forget(self, key, task):
+        if self.calls.get(key) is task:
+            del self.calls[key]
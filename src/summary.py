@@ -2,24 +2,31 @@
 # import json
 import datetime
 import os
-import textwrap
+from contextlib import aclosing
 from io import BytesIO
-from multiprocessing.pool import ThreadPool
 
 import discord
 import pytz
 from discord.commands import Option
 from discord.utils import basic_autocomplete
 from gtts import gTTS
-from openai import OpenAI
 from parsedatetime import Calendar
-from ai_chunking import chunk_messages_by_model_token_limit, get_tokens
+from openai_clients import create_chat_completion, stream_chat_completion
+from live_message import LiveMessage
+from ai_chunking import plan_chunks, get_tokens, off_event_loop, estimate_tokens, get_encoding_name
+from message_compaction import MessageCompactor
+from map_reduce import map_reduce_summaries, join_summaries, MERGE_INSTRUCTIONS
+from model_routing import route_model
+from output_budget import output_token_cap
+from summary_runs import run_cancellable
+from message_store import message_store
 
 from history import time_for_dating_back, summarize_contents_of_channel_between_dates
+from channel_packing import summarize_channels_between_dates
 from tagged_channels import get_tagged_channels
 
 from constants import CONTEXT_LOOKBACK_DAYS, MESSAGE_CHUNK_SIZE, INTRO_MESSAGE, ERROR, MESSAGE_LINK, LESS_MESSAGES
-from constants import setup_user, set_user, set_server, TIMEZONES, MODELS
+from constants import setup_user, set_user, set_server, TIMEZONES, MODELS, COMPACT_MESSAGES
 import logging
 
 calendar = Calendar()
@@ -27,30 +34,47 @@ calendar = Calendar()
 
 
 class Summary:
-    def __init__(self, message):
+    def __init__(self, message, compactor=None, mode=None):
+        self.system_prompt = message
+        self.mode = mode
         self.messages = lambda prompt: [
             {"role": "system", "content": message},
             {"role": "user", "content": prompt},
         ]
+        self.compactor = compactor
         self.full_summary = ""
+        self.outputs = []  # (model, summary) of each call, counted with the tokenizer of the model that made it
+        self.truncated = 0  # summaries cut by their max_tokens
 
-    def summarize(self, prompt, key, model):
+    async def summarize(self, prompt, key, model, on_text=None, max_tokens=None):
         if key == "pok its confusing because i dont have diZ context":
             key = os.getenv("CHATGPT_TOKEN")
 
-        client = OpenAI(api_key=key)
-        response = client.chat.completions.create(
-            model=model,
-            messages=self.messages(prompt)
-        )
+        # The key's pooled client, paced by its rate limiter. Streamed when someone is watching the text grow.
+        if on_text:
+            summary, finish_reason = await stream_chat_completion(key, model, self.messages(prompt), on_text, max_tokens)
+        else:
+            response = await create_chat_completion(key, model, self.messages(prompt), max_tokens)
+
+            assert isinstance(
+                response.choices[0].message.content, str
+            ), "API response is not a string"
+
+            summary = response.choices[0].message.content
+            finish_reason = response.choices[0].finish_reason
+        self.outputs.append((model, summary))
+        if finish_reason == "length":
+            self.truncated += 1
+            logging.warning(f"A summary reached its limit of {max_tokens} tokens and was cut")
+
+        return summary
 
-        assert isinstance(
-            response.choices[0].message.content, str
-        ), "API response is not a string"
+    async def merge(self, summaries, key, model, on_text=None, max_tokens=None):
+        return await self.summarize(MERGE_INSTRUCTIONS + "\n\n" + join_summaries(summaries), key, model, on_text, max_tokens)
 
-        summary = response.choices[0].message.content
-        self.full_summary += summary + "\n"
-        
+    def expand(self, summary):
+        if self.compactor:
+            summary = self.compactor.expand(summary)
         return summary
 
     def tts(self, username):
@@ -90,15 +114,17 @@ async def summary(
     history = []
     first = True
 
-    async for message in channel.history(limit=None):
-        if first:
-            first = False
-            continue
+    # The recent messages come from the message store when it holds them
+    async with aclosing(message_store.history(channel)) as channel_history:
+        async for message in channel_history:
+            if first:
+                first = False
+                continue
 
-        history.append(message)
+            history.append(message)
 
-        if len(history) == messages:
-            break
+            if len(history) == messages:
+                break
 
     if not history:
         await ctx.followup.send(LESS_MESSAGES)
@@ -172,14 +198,15 @@ async def fromtosummary(
 
     history = []
     first = True
-    async for message in channel.history(limit=None):
-        if first:
-            first = False
-            continue
-        if message.created_at < utc_to_time and message.created_at > utc_from_time:
-            history.append(message)
-        if message.created_at < utc_from_time:
-            break
+    async with aclosing(message_store.history(channel)) as channel_history:
+        async for message in channel_history:
+            if first:
+                first = False
+                continue
+            if message.created_at < utc_to_time and message.created_at > utc_from_time:
+                history.append(message)
+            if message.created_at < utc_from_time:
+                break
 
     if not history:
         await ctx.followup.send(
@@ -210,15 +237,16 @@ async def unreadsummary(
     history = []
     first = True
 
-    async for message in ctx.channel.history(limit=None):
-        if first:
-            first = False
-            continue
+    async with aclosing(message_store.history(ctx.channel)) as channel_history:
+        async for message in channel_history:
+            if first:
+                first = False
+                continue
 
-        history.append(message)
+            history.append(message)
 
-        if message.author.id == ctx.author.id:
-            break
+            if message.author.id == ctx.author.id:
+                break
 
     if not history:
         await ctx.followup.send(LESS_MESSAGES)
@@ -249,29 +277,43 @@ async def send_summary(ctx, messages, mode, channel=None, secret_mode=False):
         - Processes grouped messages to generate and send the final summary.
     """
 
-    if not validate_message_count(ctx, messages):
+    if not await validate_message_count(ctx, messages):
         logging.info(f"Message count exceeds limit: {len(messages)}")
         return
 
     user, server = setup_user(str(ctx.author), ctx.guild.name, ctx.guild.id)
-    if not validate_mode(ctx, mode, user):
+    if not await validate_mode(ctx, mode, user):
         logging.info(f"Invalid mode: {mode}")
         return
 
-    use_a_thread = use_a_thread(ctx, user, secret_mode)
-    api_key = get_api_key(ctx, user, server)
+    thread = await use_a_thread(ctx, user, secret_mode)
+    api_key = await get_api_key(ctx, user, server)
     if not api_key:
         return
 
     model = MODELS[user["model"]]
-    chunks, chunk_counts, starts, in_token_count = chunk_messages_by_model_token_limit(messages, model)
-    update_token_counts(user, server, ctx, in_token_count)
+    system_prompt = INTRO_MESSAGE.format(ctx.guild.name, user["modes"][mode], user["language"])
+    compactor = None
+    lines = None
+    if COMPACT_MESSAGES:
+        compactor = MessageCompactor(model["name"])
+        lines = compactor.compact(messages)
+        system_prompt += "\n\n" + compactor.legend()
+    fixed_tokens = await off_event_loop(get_tokens, system_prompt, model["name"])
+    chunks, chunk_counts, starts, in_token_count = await off_event_loop(plan_chunks, messages, model, fixed_tokens, lines=lines)
+    if not chunks:
+        # Only messages without text, e.g. attachments
+        await ctx.followup.send(LESS_MESSAGES)
+        return
+    await update_token_counts(user, server, ctx, in_token_count)
 
-    headings = generate_headings(ctx, channel, starts, chunk_counts)
-    await send_summary_embed(ctx, len(messages), mode, user, use_a_thread, in_token_count, model, chunks, secret_mode)
+    # The chunks are merged into one summary of the whole range
+    headings = generate_headings(ctx, channel, [starts[0], starts[-1]], [sum(chunk_counts)])
+    embed_message = await send_summary_embed(ctx, len(messages), mode, user, thread, in_token_count, model, chunks, secret_mode)
+    send_message_function, send_tts_function = await functions_for_sending_message_and_tts(ctx, thread, embed_message, messages, secret_mode)
 
-    summary = Summary(INTRO_MESSAGE.format(ctx.guild.name, user["modes"][mode], user["language"]))
-    await process_summary_groups(ctx, chunks, headings, summary, api_key, model, user, server, use_a_thread)
+    summary = Summary(system_prompt, compactor, mode)
+    await process_summary_groups(ctx, chunks, headings, summary, api_key, model, user, server, send_message_function, send_tts_function)
 
 
 async def validate_message_count(ctx, messages):
@@ -406,7 +448,7 @@ async def send_summary_embed(ctx, message_count, mode, user, thread, in_token_co
         groups (list): A list of message groups being summarized.
         ephemeral (bool): Whether the embed message should be ephemeral (visible only to the user).
     Returns:
-        None
+        discord.WebhookMessage: The embed message.
     """
 
     info_str = (
@@ -421,10 +463,10 @@ async def send_summary_embed(ctx, message_count, mode, user, thread, in_token_co
     embed = discord.Embed(title="Generated summary")
     embed.description = f"A `{len(chunks)}-message` summary is being prepared..."
     embed.add_field(name="Command Arguments:", value=info_str)
-    await ctx.followup.send(embed=embed, ephemeral=ephemeral)
+    return await ctx.followup.send(embed=embed, ephemeral=ephemeral)
 
 
-async def process_summary_groups(ctx, chunks, headings, summary, api_key, model, user, server, thread):
+async def process_summary_groups(ctx, chunks, headings, summary, api_key, model, user, server, send_message_function, send_tts_function):
     """
     Asynchronously processes and sends summaries for a given set of groups.
     This function generates summaries for the provided groups using the specified
@@ -440,7 +482,8 @@ async def process_summary_groups(ctx, chunks, headings, summary, api_key, model,
         model (str): The model identifier to be used for generating summaries.
         user (User): The user object representing the current user.
         server (Server): The server object representing the current server.
-        thread (Thread): The thread object where summaries will be sent.
+        send_message_function (function): Sends a text message and returns it, in the thread or as a follow-up.
+        send_tts_function (function): Sends a file, in the thread or as a follow-up.
     Raises:
         Exception: If an error occurs during summary processing, it is caught and
                    passed to the error handler.
@@ -449,26 +492,37 @@ async def process_summary_groups(ctx, chunks, headings, summary, api_key, model,
     """
 
     try:
-        send_message_function, send_tts_function = functions_for_sending_message_and_tts(ctx, thread)
-        responses = generate_a_summary_for_all_chunks(chunks, api_key, model, summary)
+        # The final summary is streamed into messages edited as it grows
+        live_message = LiveMessage(send_message_function)
+        if len(chunks) > 1:
+            await live_message.update(headings[0] + f"_Summarizing {len(chunks)} parts of the conversation..._")
+
+        async def show_text(text):
+            await live_message.update(headings[0] + summary.expand(text))
+
+        # Running the command again in the channel, or running out of time, cancels the calls still to be made
+        response = summary.expand(await run_cancellable((ctx.author.id, ctx.channel.id),
+                                                        generate_a_summary_for_all_chunks(chunks, api_key, model, summary, show_text)))
+        summary.full_summary += response + "\n"
+        if summary.truncated:
+            response += f"\n\n_{summary.truncated} of the summaries reached their length limit and were cut short._"
 
-        for i, response in enumerate(responses):
-            await send_group_summary(ctx, headings[i], response, send_message_function)
-            update_output_token_counts(response, user, server, ctx)
+        await live_message.finish(headings[0] + response)
+        update_output_token_counts(summary.outputs, user, server, ctx)
 
         await send_tts_summary(ctx, summary, send_tts_function, send_message_function)
     except Exception as e:
         await handle_summary_error(ctx, e)
 
 
-async def functions_for_sending_message_and_tts(ctx, thread, embed, messages, secret_mode):
+async def functions_for_sending_message_and_tts(ctx, thread, message, messages, secret_mode):
     """
     Asynchronously sets up message sending functions for a Discord bot, allowing messages
     and files to be sent either in a thread or as follow-up messages.
     Args:
         ctx (discord.ext.commands.Context): The context of the command invocation.
         thread (bool): Whether to create and use a thread for sending messages.
-        embed (discord.Embed): The embed to send as the initial message.
+        message (discord.Message): The message already sent, which the thread starts from.
         messages (list): A list of messages to summarize, used for naming the thread in the channel.
         secret_mode (bool): If True, messages will be sent ephemerally (visible only to the user).
     Returns:
@@ -478,7 +532,6 @@ async def functions_for_sending_message_and_tts(ctx, thread, embed, messages, se
     """
 
     if thread:
-        message = await ctx.followup.send(embed=embed)
         thread = await ctx.channel.create_thread(
             name=f"Summary by {ctx.author.display_name}, {len(messages)} messages",
             message=message,
@@ -491,50 +544,62 @@ async def functions_for_sending_message_and_tts(ctx, thread, embed, messages, se
     return send_message, send_tts
 
 
-def generate_a_summary_for_all_chunks(chunk, api_key, model, summary):
+async def generate_a_summary_for_all_chunks(chunk, api_key, model, summary, on_text=None):
     """
-    Generates summaries for a list of chunks using a specified model and API key.
+    Generates one summary of a list of chunks using a specified model and API key.
+    The chunks are summarized in parallel and their summaries merged by map_reduce_summaries.
+    The calls before the final one may be routed to a cheaper, faster model than the user's by `route_model`.
+    Each call's output is capped by `output_token_cap`, from the size of what it summarizes and the summary's mode.
     Args:
         chunks (list): A list of chunks to generate summaries for.
         api_key (str): The API key required for authentication with the summarization service.
         model (dict): A dictionary containing model details, including the model name.
-        summary (object): An object with a `summarize` method that performs the summarization.
+        summary (Summary): The Summary whose `summarize` and `merge` methods perform the summarization.
+        on_text (coroutine function, optional): Streams the final summary, called with its text so far.
     Returns:
-        list: A list of summaries generated for each chunk.
+        str: The summary of all the chunks, still compacted.
     """
 
-    to_generate = [(chunk[i], api_key, model["name"]) for i in range(len(chunk))]
-    with ThreadPool(len(chunk)) as pool:
-        return pool.starmap(summary.summarize, to_generate)
+    # The calls in flight are limited by the adaptive concurrency of the API key
+    merge_tokens = await off_event_loop(get_tokens, summary.system_prompt + MERGE_INSTRUCTIONS, model["name"])
+    encoding_name = get_encoding_name(model["name"])
 
+    def model_for(text, final):
+        return route_model(model, merge_tokens + estimate_tokens(text, encoding_name)[1], final)["name"]
 
-async def send_group_summary(ctx, heading, response, send_message_function):
+    def max_tokens_for(text, final):
+        return output_token_cap(model, estimate_tokens(text, encoding_name)[1], final, merge_tokens, summary.mode)
+
+    async def summarize_chunk(prompt, final):
+        return await summary.summarize(prompt, api_key, model_for(prompt, final), on_text if final else None,
+                                       max_tokens_for(prompt, final))
+
+    async def merge_summaries(summaries, final):
+        text = join_summaries(summaries)
+        return await summary.merge(summaries, api_key, model_for(text, final), on_text if final else None,
+                                   max_tokens_for(text, final))
+
+    return await map_reduce_summaries(chunk, summarize_chunk, merge_summaries, model, merge_tokens)
+
+
+def update_output_token_counts(outputs, user, server, ctx):
     """
-    Asynchronously sends a summarized message to a Discord channel.
-    This function takes a heading and a response, combines them into a single
-    block of text, and sends the text in chunks of a specified size to avoid
-    exceeding message size limits.
+    Adds the output tokens of a summary's calls to the user's and the server's token counts.
+    The calls may have been routed to another model than the user's, so each output is counted with the
+    tokenizer of the model that made it, and the counts are also kept by model in "out_token_counts".
     Args:
-        ctx: The context in which the function is called. Typically includes
-             metadata about the command invocation.
-        heading (str): The heading or title of the summary.
-        response (str): The body of the summary to be sent.
-        send_message (Callable[[str], Awaitable[None]]): An asynchronous function
-            used to send a message. It is called with each chunk of the summary.
-    Returns:
-        None
+        outputs (list): The (model name, output) of each call, as in `Summary.outputs`.
+        user (dict): A dictionary containing user data, including the current token count.
+        server (dict): A dictionary containing server data, including the current token count.
+        ctx (Context): The context of the command invocation, used to identify the user and server.
     """
-    
-    block = heading + response
-    for chunk in textwrap.wrap(block, MESSAGE_CHUNK_SIZE, replace_whitespace=False):
-        await send_message_function(chunk)
-
-
-def update_output_token_counts(response, user, server, ctx):
-    tokens = get_tokens(response)
-    user["out_token_count"] += tokens
+    for model_name, output in outputs:
+        tokens = get_tokens(output, model_name)
+        for record in (user, server):
+            record["out_token_count"] += tokens
+            by_model = record["out_token_counts"]
+            by_model[model_name] = by_model.get(model_name, 0) + tokens
     set_user(str(ctx.author), user)
-    server["out_token_count"] += tokens
     set_server(ctx.guild.name, ctx.guild.id, server)
 
 
@@ -561,9 +626,10 @@ async def discord_command_summarize_all(ctx,
                                         tag:         str = Option(str, "Tag to filter channels", required=False, default=None),
                                         category:    str = Option(str, "Category to filter channels", required=False, default=None)
                                         ):
-    now = datetime.now()
-    time_to_look_back = time_for_dating_back(now, time_period)
-    time_to_look_back_for_context = now - timedelta(days=CONTEXT_LOOKBACK_DAYS)
+    # Same time frame as summarize_to_named_channel, shared by all channels so quiet ones can be packed together
+    endtime_to_summarize = datetime.datetime.now()
+    starttime_to_summarize = time_for_dating_back(endtime_to_summarize, time_period)
+    prior_timeframe_for_context = time_for_dating_back(starttime_to_summarize, "2d")
 
     # "standard": INTRO_MESSAGE.format(ctx.guild.name, "standard", "english"),
     ai_prompts = {
@@ -591,6 +657,7 @@ async def discord_command_summarize_all(ctx,
     await target_channel.send(f"\n\nSummarizing all channels (criteria={criteria}) in {ctx.guild.name}...\n")
 
 
+    channels_to_summarize = []
     for channel in channels:
         if isinstance(channel, discord.VoiceChannel):
             logging.info(f"Skipping voice channel {channel.name}")
@@ -605,8 +672,13 @@ async def discord_command_summarize_all(ctx,
             ctx.respond(f"Skipping forum channel {channel.name}")
             continue
         if channel.permissions_for(ctx.guild.me).read_messages and channel.name != "summary":
-            await target_channel.send(content=f"Summarizing {channel.name}... {time_to_look_back}")
-            await summarize_to_named_channel(target_channel, channel, ctx, ai_prompts, time_period)
+            channels_to_summarize.append(channel)
+
+    await target_channel.send(f"Summarizing {len(channels_to_summarize)} channels between {starttime_to_summarize.date()} and {endtime_to_summarize.date()}")
+    summaries = await summarize_channels_between_dates(channels_to_summarize, starttime_to_summarize, endtime_to_summarize,
+                                                       prior_timeframe_for_context, ai_prompts)
+    for channel, summary in zip(channels_to_summarize, summaries):
+        await send_channel_summary(target_channel, channel, summary)
 
 
 async def summarize_to_named_channel(target_channel, source_channel, ctx, ai_prompts, time_period="1d", context_lookback_days=2):
@@ -629,9 +701,12 @@ async def summarize_to_named_channel(target_channel, source_channel, ctx, ai_pro
     logging.info(f"Summarizing messages from {source_channel} between {starttime_to_summarize.date()} and {endtime_to_summarize.date()}")
     await target_channel.send(f"Summarizing messages from {source_channel} between {starttime_to_summarize.date()} and {endtime_to_summarize.date()}")
     summary = await summarize_contents_of_channel_between_dates(source_channel, starttime_to_summarize, endtime_to_summarize, prior_timeframe_for_context, ai_prompts)
+    await send_channel_summary(target_channel, source_channel, summary)
+
 
+async def send_channel_summary(target_channel, source_channel, summary):
     response = f"**<#{source_channel.id}>**\n"  + summary
 
     response_chunks = [response[i:i + MESSAGE_CHUNK_SIZE] for i in range(0, len(response), MESSAGE_CHUNK_SIZE)]
     for chunk in response_chunks:
-        await target_channel.send(chunk)
\ No newline at end of file
+        await target_channel.send(chunk)
@@ -0,0 +1,127 @@
+# Description: This file contains the persistent summary cache, a SQLite database on the app's volume.
+#  Summaries are stored under a SHA-256 digest of everything that was sent to OpenAI, so identical scheduled or
+#  webhook summaries are answered from disk, even after a deploy or restart. Entries expire after SUMMARY_CACHE_TTL
+#  seconds and the least recently used ones are evicted beyond SUMMARY_CACHE_MAX_ENTRIES. The database is shared by
+#  the bot's event loop and the webhook thread through one connection guarded by a lock, its queries run in worker
+#  threads. A cache that fails only logs a warning: the summary is then made as if it were missing.
+
+import asyncio
+import hashlib
+import json
+import logging
+import os
+import sqlite3
+import threading
+import time
+
+from constants import SUMMARY_CACHE_PATH, SUMMARY_CACHE_TTL, SUMMARY_CACHE_MAX_ENTRIES, SUMMARY_CACHE_EVICT_EVERY
+
+
+def cache_key(*parts):
+    """
+    Computes the content address of a summary.
+
+    Args:
+        *parts (str): Everything the summary depends on, e.g. the model and the prompt.
+
+    Returns:
+        str: The hex SHA-256 digest of the parts.
+    """
+    return hashlib.sha256(json.dumps(parts, ensure_ascii=False).encode("utf-8")).hexdigest()
+
+
+class SummaryCache:
+    def __init__(self, path=SUMMARY_CACHE_PATH, ttl=SUMMARY_CACHE_TTL, max_entries=SUMMARY_CACHE_MAX_ENTRIES):
+        self.path = path
+        self.ttl = ttl
+        self.max_entries = max_entries
+        self.hits = 0
+        self.misses = 0
+        self.sets = 0
+        self.connection = None
+        self.lock = threading.Lock()
+
+    async def get(self, key):
+        """
+        Returns the cached summary for a key, or None.
+
+        Args:
+            key (str): The key from `cache_key`.
+        """
+        value = await asyncio.to_thread(self._get, key)
+        if value is None:
+            self.misses += 1
+        else:
+            self.hits += 1
+        return value
+
+    async def set(self, key, value):
+        """
+        Caches a summary.
+
+        Args:
+            key (str): The key from `cache_key`.
+            value (str): The summary.
+        """
+        await asyncio.to_thread(self._set, key, value)
+
+    def stats(self):
+        return {"hits": self.hits, "misses": self.misses}
+
+    def _connect(self):
+        if self.connection is None:
+            directory = os.path.dirname(self.path)
+            if directory:
+                os.makedirs(directory, exist_ok=True)
+            connection = sqlite3.connect(self.path, check_same_thread=False)
+            connection.execute("PRAGMA journal_mode=WAL")
+            connection.execute("CREATE TABLE IF NOT EXISTS summaries "
+                               "(key TEXT PRIMARY KEY, value TEXT NOT NULL, created REAL NOT NULL, accessed REAL NOT NULL)")
+            connection.execute("CREATE INDEX IF NOT EXISTS summaries_accessed ON summaries (accessed)")
+            connection.commit()
+            self.connection = connection
+            logging.info(f"Summary cache opened at {self.path}")
+        return self.connection
+
+    def _get(self, key):
+        now = time.time()
+        try:
+            with self.lock:
+                connection = self._connect()
+                row = connection.execute("SELECT value, created FROM summaries WHERE key = ?", (key,)).fetchone()
+                if row is None:
+                    return None
+                if now - row[1] > self.ttl:
+                    connection.execute("DELETE FROM summaries WHERE key = ?", (key,))
+                    connection.commit()
+                    return None
+                connection.execute("UPDATE summaries SET accessed = ? WHERE key = ?", (now, key))
+                connection.commit()
+                return row[0]
+        except sqlite3.Error as e:
+            logging.warning(f"Summary cache read failed: {e}")
+            return None
+
+    def _set(self, key, value):
+        now = time.time()
+        try:
+            with self.lock:
+                connection = self._connect()
+                connection.execute("INSERT OR REPLACE INTO summaries (key, value, created, accessed) VALUES (?, ?, ?, ?)",
+                                   (key, value, now, now))
+                self.sets += 1
+                if self.sets % SUMMARY_CACHE_EVICT_EVERY == 1:
+                    self._evict(connection, now)
+                connection.commit()
+        except sqlite3.Error as e:
+            logging.warning(f"Summary cache write failed: {e}")
+
+    def _evict(self, connection, now):
+        expired = connection.execute("DELETE FROM summaries WHERE created < ?", (now - self.ttl,)).rowcount
+        count = connection.execute("SELECT COUNT(*) FROM summaries").fetchone()[0]
+        excess = max(0, count - self.max_entries)
+        if excess:
+            connection.execute("DELETE FROM summaries WHERE key IN "
+                               "(SELECT key FROM summaries ORDER BY accessed LIMIT ?)", (excess,))
+        if expired or excess:
+            logging.debug(f"Summary cache evicted {expired} expired and {excess} least recently used entries")
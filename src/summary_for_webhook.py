@@ -8,11 +8,11 @@ import logging
 import discord
 
 from flask import request
-from history import summarize_contents_of_channel_between_dates
+from bucketed_summary import summarize_channels_in_buckets
 from webhook import app
 from webhook import log_diagnostic_message
-from history import time_for_dating_back
-from constants import CONTEXT_LOOKBACK_DAYS
+from history import time_for_dating_back, parse_time_period
+from constants import CONTEXT_LOOKBACK_DAYS, SUMMARY_BUCKET
 import asyncio
 
 #When called from the internal function, the timeout is handled by the asyncio.timeout context manager.
@@ -50,6 +50,7 @@ async def summary_from_payload(diagnostic_channel_id, payload):
     - `time_period`: The duration of the time period to summarize (default is 1 day).
     - `ai_prompts`: AI prompts for generating the summary.
     - `context_lookback_days`: Number of days to look back for context (default is 5 days).
+    - `summary_bucket`: The time buckets whose channel summaries are cached, e.g. "1d" (default SUMMARY_BUCKET, "" to pack quiet channels instead).
     - `diagnostic_channel_id`: The ID or name of the diagnostic channel.
     - `guild_ids`: List of guild IDs or names to include in the summary.
     - `channels_to_include`: List of channel IDs or names to include in the summary.
@@ -84,6 +85,7 @@ async def summary_from_payload(diagnostic_channel_id, payload):
 
     ai_prompts = payload.get("ai_prompts", {})
     context_lookback_days = payload.get("context_lookback_days", CONTEXT_LOOKBACK_DAYS)
+    summary_bucket = payload.get("summary_bucket", SUMMARY_BUCKET)
 
     logging.info("Received webhook payload: %s", json.dumps(payload, indent=4))
     logging.debug(f"ai_prompts: {ai_prompts}")
@@ -147,6 +149,8 @@ async def summary_from_payload(diagnostic_channel_id, payload):
             logging.info(f"No channels to summarize in {guild}")
 
         response += (f"# GUILD {guild}") 
+        readable_channels = []
+        parts = []
         for channel in text_channels:
             await log_diagnostic_message(f"CHANNEL {channel}")
             if channel.id == diagnostic_channel_id:
@@ -156,13 +160,19 @@ async def summary_from_payload(diagnostic_channel_id, payload):
                 await log_diagnostic_message("skipping of processing the summary channel")
                 continue
             if channel.permissions_for(channel.guild.me).read_messages:
-                response += await summarize_contents_of_channel_between_dates(channel, 
-                                                    starttime_to_summarize,
-                                                    endtime_to_summarize,
-                                                    prior_starttime_for_context,
-                                                    ai_prompts)
+                readable_channels.append(channel)
+                parts.append(None)  # filled in with the channel's summary below
             else:
-                response += f"Skipping channel {channel.name} due to lack of permissions\n"
+                parts.append(f"Skipping channel {channel.name} due to lack of permissions\n")
+
+        summaries = await summarize_channels_in_buckets(readable_channels,
+                                                        starttime_to_summarize,
+                                                        endtime_to_summarize,
+                                                        prior_starttime_for_context,
+                                                        ai_prompts,
+                                                        parse_time_period(summary_bucket) if summary_bucket else None)
+        summaries = iter(summaries)
+        response += "".join(part if part is not None else next(summaries) for part in parts)
 
     logging.info("Summaries done")
     return response
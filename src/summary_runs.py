@@ -0,0 +1,51 @@
+# Description: This file contains `run_cancellable`, which makes a summarization run a unit that can be cancelled.
+#  A run is its own task. It is cancelled when it times out, when the same user starts another run in the same
+#  channel, or when its caller is cancelled, and its pending and in-flight OpenAI calls are cancelled with it
+#  (see map_reduce.gather_or_cancel and SingleFlight), freeing quota and concurrency slots right away.
+
+import asyncio
+import logging
+
+from constants import SUMMARY_RUN_TIMEOUT
+
+_runs = {}  # run key -> task of the run in flight
+
+
+class SummaryCancelled(Exception):
+    """Raised to the caller of a run that was superseded or timed out."""
+
+
+async def run_cancellable(key, coroutine, timeout=SUMMARY_RUN_TIMEOUT):
+    """
+    Runs a summarization, cancelling the run of the same key still in flight.
+
+    Args:
+        key (Hashable): Identifies runs that replace each other, e.g. the user and channel of a command.
+        coroutine (coroutine): The run.
+        timeout (float): Seconds after which the run is cancelled.
+
+    Returns:
+        The result of the run.
+
+    Raises:
+        SummaryCancelled: If the run was superseded by a newer one or timed out.
+    """
+    previous = _runs.get(key)
+    if previous is not None and not previous.done():
+        logging.info(f"Cancelling the summary run of {key} superseded by a new one")
+        previous.cancel()
+
+    task = asyncio.ensure_future(asyncio.wait_for(coroutine, timeout))
+    _runs[key] = task
+    try:
+        return await task
+    except asyncio.TimeoutError:
+        raise SummaryCancelled(f"The summary took longer than {timeout} seconds and was cancelled") from None
+    except asyncio.CancelledError:
+        # Cancelled through the caller, or superseded
+        if asyncio.current_task().cancelling():
+            raise
+        raise SummaryCancelled("The summary was cancelled by a newer one") from None
+    finally:
+        if _runs.get(key) is task:
+            del _runs[key]
@@ -1,3 +1,4 @@
+import asyncio
 import json
 import requests
 import logging
@@ -5,7 +6,10 @@ import logging
 from apscheduler.schedulers.asyncio import AsyncIOScheduler
 from apscheduler.triggers.cron import CronTrigger
 from datetime import datetime
-from summary_for_webhook import summary_for_internal_call
+from summary_for_webhook import summary_for_internal_call, summary_from_payload
+from webhook import deliver_summary
+from history import fetched_histories
+from openai_summarizer import summarizer
 from constants import FILE_FORMAT
 
 import os
@@ -43,6 +47,36 @@ class TaskList:
         result = await(summary_for_internal_call(diagnostic_channel_id, payload))
         self.store_job_result(payload, result)
 
+    async def perform_jobs_in_batches(self, payloads, backend):
+        """
+        Performs several jobs at once with batch jobs (see batch_api.py), delivering and storing each job's result
+        like the webhook does for the jobs performed one at a time.
+        The jobs are run again for each level of summaries, the channel histories are fetched once for all of them.
+
+        Args:
+            payloads (list): The payloads of the jobs.
+            backend (OpenAIBatchBackend | LocalBatchBackend): Where the batch jobs are submitted.
+        """
+        jobs = []
+        for payload in payloads:
+            diagnostic_channel_id = payload.get("diagnostic_channel_id", 0)
+            if diagnostic_channel_id != 0:
+                diagnostic_channel_id = int(diagnostic_channel_id)
+            jobs.append(lambda diagnostic_channel_id=diagnostic_channel_id, payload=payload:
+                        summary_from_payload(diagnostic_channel_id, payload))
+
+        token = fetched_histories.set({})
+        try:
+            results = await summarizer.summarize_in_batches(jobs, backend)
+        finally:
+            fetched_histories.reset(token)
+
+        for payload, result in zip(payloads, results):
+            payload = dict(payload)
+            payload.pop('bot_webhook_server', None)  # as the webhook does
+            message = await asyncio.to_thread(deliver_summary, result, payload)
+            self.store_job_result(payload, message)
+
     """
         This function is called by the scheduler to perform the job. 
         The method returns the result of the job.
@@ -167,6 +201,14 @@ class TaskList:
                 
         logging.debug("Shouldn't reach here")
 
+    def get_catchup_jobs(self):
+        """
+        Returns all the jobs from the past that are not done yet.
+        """
+        now = datetime.now()
+        return [{"start": start, "end": end} for start, end in self.periods
+                if now > end and not self.job_is_done(start, end)]
+
     def get_future_jobs(self):
         now = datetime.now()
         future_jobs = []
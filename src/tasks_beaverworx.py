@@ -27,6 +27,7 @@ the appropriate functions from this module to manage job scheduling and executio
 ## Functions:
 - `generate_job_periods(start_date, end_date)`: Generates job periods based on weekday rules.
 - `perform_catchup_and_queue_future_jobs()`: Manages catchup jobs and schedules future jobs.
+- `perform_catchup_in_batches()`: Does all the catchup jobs at once with batch jobs, when BATCH_CATCHUP is set.
 - `print_jobs(ctx)`: Prints details of catchup, future, and scheduled jobs.
 - `schedule_programming_general_summary()`: Schedules a recurring job for the "programming-general" channel.
 ## Notes:
@@ -48,6 +49,7 @@ Returns:
           the start and end of a job period.
 """ 
 
+import asyncio
 import logging
 from time import sleep
 from task_list import TaskList
@@ -56,6 +58,10 @@ from calendar import THURSDAY, SUNDAY, WEDNESDAY
 import json
 
 from apscheduler.triggers.cron import CronTrigger
+from batch_api import get_batch_backend
+from constants import BATCH_CATCHUP, BATCH_BACKEND
+from openai_summarizer import api_key
+from webhook import app
 
 # Configure logging
 logging.basicConfig(level=logging.DEBUG, format='%(asctime)s - %(levelname)s - %(message)s')
@@ -112,16 +118,17 @@ def perform_catchup_and_queue_future_jobs():
         generate_job_periods(start_date, end_date)
     )
 
+    if BATCH_CATCHUP:
+        # Whatever the batch jobs didn't do is done one job at a time below
+        perform_catchup_in_batches()
+
     next_catchup_job = task_list.get_next_catchup_job()
 
     while next_catchup_job:
         start, end = next_catchup_job["start"], next_catchup_job["end"]
         logging.info(f"Next job period: {start.strftime('%Y-%m-%d %H:%M:%S')} to {end.strftime('%Y-%m-%d %H:%M:%S')}")
 
-        payload = task_list.default_payload.copy()
-        payload['starttime_to_summarize'] = start.strftime('%Y-%m-%d %H:%M:%S')
-        payload['endtime_to_summarize'] = end.strftime('%Y-%m-%d %H:%M:%S')
-        payload['document_id'] = f"{start.strftime('%Y-%m-%d')}_to_{end.strftime('%Y-%m-%d')}"
+        payload = payload_for_period(start, end)
         
         result = task_list.perform_job(payload)
         logging.debug(f"Result: {result}")
@@ -141,10 +148,7 @@ def perform_catchup_and_queue_future_jobs():
 
     for job in future_jobs:
         start, end = job["start"], job["end"]
-        payload = task_list.default_payload.copy()
-        payload['starttime_to_summarize'] = start.strftime('%Y-%m-%d %H:%M:%S')
-        payload['endtime_to_summarize'] = end.strftime('%Y-%m-%d %H:%M:%S')
-        payload['document_id'] = f"{start.strftime('%Y-%m-%d')}_to_{end.strftime('%Y-%m-%d')}"
+        payload = payload_for_period(start, end)
         
         logging.info(f"Scheduling for {end} the future job running from {start} to {end}")
         task_list.scheduler.add_job(
@@ -159,6 +163,37 @@ def perform_catchup_and_queue_future_jobs():
     for job in jobs:
         logging.debug(f"Job id: {job.id}, name: {job.name}, trigger: {job.trigger}")
 
+def payload_for_period(start, end):
+    payload = task_list.default_payload.copy()
+    payload['starttime_to_summarize'] = start.strftime('%Y-%m-%d %H:%M:%S')
+    payload['endtime_to_summarize'] = end.strftime('%Y-%m-%d %H:%M:%S')
+    payload['document_id'] = f"{start.strftime('%Y-%m-%d')}_to_{end.strftime('%Y-%m-%d')}"
+    return payload
+
+
+def perform_catchup_in_batches(poll_seconds=5):
+    """
+    Does all the past jobs at once. Their summaries are made by batch jobs (see batch_api.py), cheaper and
+    without the rate limits of live calls, but they may take up to BATCH_COMPLETION_WINDOW.
+    """
+    jobs = task_list.get_catchup_jobs()
+    if not jobs:
+        return
+    payloads = [payload_for_period(job["start"], job["end"]) for job in jobs]
+
+    # The summaries are made on the bot's event loop, like the webhook's
+    while getattr(app, "bot", None) is None or not app.bot.is_ready():
+        sleep(poll_seconds)
+
+    logging.info(f"Performing {len(payloads)} catchup jobs with batch jobs through the {BATCH_BACKEND} backend")
+    backend = get_batch_backend(BATCH_BACKEND, api_key)
+    future = asyncio.run_coroutine_threadsafe(task_list.perform_jobs_in_batches(payloads, backend), app.bot.loop)
+    try:
+        future.result()
+    except Exception as e:
+        logging.error(f"Batch catchup failed: {e}")
+
+
 # TODO consider if this bot method should be in the task_list class or elsewhere.
 async def print_jobs(ctx):
     try:
@@ -58,7 +58,6 @@ def webhook():
         diagnostic_channel_id = request_payload.get("diagnostic_channel_id", 0)
         if diagnostic_channel_id == 0:
             diagnostic_channel_id = int(diagnostic_channel_id)
-        target_webhook = request_payload.get("target_webhook", 0)
 
         # Using the bot's loop to run the coroutine
         future = asyncio.run_coroutine_threadsafe(
@@ -66,34 +65,7 @@ def webhook():
             app.bot.loop
             )
 
-        result = future.result()
-
-        document_id = request_payload.get("document_id", 0)
-        if document_id == 0:
-            document_id = request_payload.get("starttime_to_summarize", "") + "-" + request_payload.get("endtime_to_summarize", "")
-            
-        if document_id:
-            result = f"Summary for document {document_id}:\n{result}"
-            request_payload["document_id"] = document_id
-        else:
-            logging.info("No document ID provided or constructable.")
-
-        #log_diagnostic_message(result)
-
-        if request_payload.get("google_folder_id", False):
-            write_file_to_google_drive(result, request_payload),
-        else:
-            logging.info("No Google Folder ID provided.")
-
-            
-        if target_webhook:
-            result = asyncio.run_coroutine_threadsafe(
-                send_message_to_webhook(result, target_webhook, request_payload),
-                app.bot.loop
-            )
-            logging.info(f"Sent message to target webhook {result}")
-        else:  
-            logging.info("No target webhook provided.")
+        result = deliver_summary(future.result(), request_payload)
 
         result = {
             "message": result,
@@ -104,6 +76,50 @@ def webhook():
         return result
 
 
+def deliver_summary(result, request_payload):
+    """
+    Delivers the summary made for a payload, as asked by the payload.
+    Used by the webhook and by the catch-up jobs done with batch jobs, so both deliver their summaries alike.
+    Args:
+        result (str): The summary.
+        request_payload (dict): The payload, whose document_id is filled in when it can be constructed.
+    Returns:
+        str: The summary, prefixed with its document ID.
+    Uploads the summary to Google Drive when the payload has a google_folder_id, and sends it to the target webhook
+    when it has a target_webhook. Blocking, call it from a thread other than the bot's event loop.
+    """
+    target_webhook = request_payload.get("target_webhook", 0)
+
+    document_id = request_payload.get("document_id", 0)
+    if document_id == 0:
+        document_id = request_payload.get("starttime_to_summarize", "") + "-" + request_payload.get("endtime_to_summarize", "")
+        
+    if document_id:
+        result = f"Summary for document {document_id}:\n{result}"
+        request_payload["document_id"] = document_id
+    else:
+        logging.info("No document ID provided or constructable.")
+
+    #log_diagnostic_message(result)
+
+    if request_payload.get("google_folder_id", False):
+        write_file_to_google_drive(result, request_payload),
+    else:
+        logging.info("No Google Folder ID provided.")
+
+        
+    if target_webhook:
+        sent = asyncio.run_coroutine_threadsafe(
+            send_message_to_webhook(result, target_webhook, request_payload),
+            app.bot.loop
+        )
+        logging.info(f"Sent message to target webhook {sent}")
+    else:  
+        logging.info("No target webhook provided.")
+
+    return result
+
+
 async def send_message_to_webhook(message, target_webhook, incoming_payload):
     """
     Send a message to a specified webhook URL.
@@ -0,0 +1,91 @@
+import asyncio
+import os
+import sys
+from types import SimpleNamespace
+
+import pytest
+
+os.environ['OPENAI_API_KEY'] = "NOT GOING TO BE USED ANYWAY AS WE STUB THE CALL"
+
+# Add the src directory to the Python path
+folder = os.path.abspath(os.path.join(os.path.dirname(__file__), '..', 'src'))
+sys.path.append(folder)
+
+from ai_chunking import plan_chunks, get_message_tokens, get_message_tokens_batch, get_tokenizer, get_tokens, trim_to_token_budget, off_event_loop
+from ai_chunking import estimate_tokens
+
+
+def make_message(id, author, content):
+    return SimpleNamespace(id=id, author=SimpleNamespace(display_name=author), content=content)
+
+
+def test_planner_packs_chunks_within_budget_and_counts_every_line_once():
+    messages = [make_message(i, "alice", "word " * 40) for i in range(30)]
+    line_tokens = get_tokens(f"alice: {'word ' * 40}\n", "gpt-4o")
+    fixed_tokens = 100
+    # Room for 10 and a half lines per chunk once the prompt and output reserve are taken off
+    model = {"name": "gpt-4o", "context_length": 1000 + fixed_tokens + int(line_tokens * 10.5)}
+
+    groups, group_counts, starts, in_token_count = plan_chunks(messages, model, fixed_tokens,
+                                                               reserved_output_tokens=1000, exact_counts=True)
+
+    assert group_counts == [10, 10, 10]
+    assert in_token_count == sum(get_tokens(group, "gpt-4o") for group in groups) + fixed_tokens * 3
+    assert [start.id for start in starts] == [0, 10, 20, 29]
+
+    # Estimated counts give the same chunks, tokenizing only near the chunk boundaries
+    estimated_groups, _, _, _ = plan_chunks(messages, model, fixed_tokens, reserved_output_tokens=1000)
+    assert estimated_groups == groups
+
+
+def test_chunking_skips_incomplete_messages():
+    messages = [make_message(1, "alice", "hi"), make_message(2, "bob", ""), make_message(3, None, "lost")]
+
+    groups, group_counts, _, _ = plan_chunks(messages, {"name": "gpt-4o", "context_length": 128000})
+
+    assert groups == ["alice: hi\n"]
+    assert group_counts == [1]
+
+
+def test_planner_accepts_formatted_lines_and_rejects_oversized_prompts():
+    groups, group_counts, _, _ = plan_chunks(["alice: hi", "bob: hello"], {"name": "gpt-4o", "context_length": 128000})
+    assert groups == ["alice: hi\nbob: hello\n"]
+    assert group_counts == [2]
+
+    with pytest.raises(ValueError):
+        plan_chunks(["alice: hi"], {"name": "gpt-4o", "context_length": 8192}, fixed_tokens=8192)
+
+
+def test_trim_keeps_most_recent_lines():
+    lines = [f"alice: message number {i}" for i in range(100)]
+    budget = get_tokens("alice: message number 99\n", "gpt-4o") * 3
+
+    assert trim_to_token_budget(lines, budget, "gpt-4o") == lines[-3:]
+
+
+def test_tokenizer_is_loaded_once_per_model_and_message_counts_match():
+    assert get_tokenizer("gpt-4o-mini") is get_tokenizer("gpt-4o-mini")
+
+    text = "carol: the intake needs new belts\n"
+    assert get_message_tokens(text, "gpt-4o-mini") == get_tokens(text, "gpt-4o-mini")
+    assert get_message_tokens(text, "gpt-4o-mini") == get_tokens(text, "gpt-4o-mini")
+
+
+def test_batch_counts_match_single_counts_off_the_event_loop():
+    texts = [f"dave: batch message {i} {'x' * i}\n" for i in range(50)]
+
+    counts = asyncio.run(off_event_loop(get_message_tokens_batch, texts, "gpt-4o"))
+
+    assert counts == [get_tokens(text, "gpt-4o") for text in texts]
+
+
+@pytest.mark.parametrize("encoding_name, model_name", [("cl100k_base", "gpt-4"), ("o200k_base", "gpt-4o")])
+def test_estimate_bounds_contain_exact_count(encoding_name, model_name):
+    lines = ["alice: hi\n",
+             "Bob the Builder: can someone check https://tenor.com/view/happy-dance-gif-12345 :thumbsup:\n",
+             "carol: <@123456789012345678> l'encodeur est cassé 😅 on le remplace vendredi?\n",
+             "dave: " + "the intake needs new belts before friday. " * 20 + "\n"]
+
+    for line in lines:
+        low, _, high = estimate_tokens(line, encoding_name)
+        assert low <= get_tokens(line, model_name) <= high
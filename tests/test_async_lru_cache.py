@@ -0,0 +1,42 @@
+import asyncio
+import os
+import sys
+
+# Add the src directory to the Python path
+folder = os.path.abspath(os.path.join(os.path.dirname(__file__), '..', 'src'))
+sys.path.append(folder)
+
+from async_lru_cache import AsyncLRUCache, ENTRY_OVERHEAD_BYTES
+
+
+def test_cache_is_bounded_in_bytes_and_evicts_least_recently_used():
+    async def scenario():
+        cache = AsyncLRUCache(max_bytes=3 * (1000 + ENTRY_OVERHEAD_BYTES))
+        for key in ["a", "b", "c"]:
+            await cache.set(key, key * 1000)
+        await cache.get("a")
+        await cache.set("d", "d" * 1000)
+
+        assert await cache.get("b") is None
+        assert await cache.get("a") == "a" * 1000
+        assert cache.currsize <= 3 * (1000 + ENTRY_OVERHEAD_BYTES)
+
+        await cache.set("huge", "x" * 10000)
+        assert await cache.get("huge") is None
+
+        await cache.set("refused", None)
+        assert await cache.get("refused") is None
+
+    asyncio.run(scenario())
+
+
+def test_compressed_cache_round_trips_and_stores_less():
+    async def scenario():
+        cache = AsyncLRUCache(compress=True)
+        summary = "- **Robot** intake design reviewed ✅\n" * 100
+        await cache.set("k", summary)
+
+        assert await cache.get("k") == summary
+        assert cache.currsize < len(summary.encode("utf-8"))
+
+    asyncio.run(scenario())
@@ -0,0 +1,85 @@
+import asyncio
+import os
+import sys
+from types import SimpleNamespace
+
+# Add the src directory to the Python path
+folder = os.path.abspath(os.path.join(os.path.dirname(__file__), '..', 'src'))
+sys.path.append(folder)
+
+import openai_summarizer
+from batch_api import LocalBatchBackend, batch_input, batch_output, is_pending, pending_summary
+from openai_summarizer import summarizer
+from summary_cache import SummaryCache
+
+
+def test_local_backend_answers_in_the_batch_api_format(tmp_path):
+    backend = LocalBatchBackend(str(tmp_path), respond=lambda prompt: prompt.upper())
+
+    async def scenario():
+        batch_id = await backend.submit({"k1": "one", "k2": "two"}, "gpt-4o")
+        assert await backend.status(batch_id) == "completed"
+        return await backend.results(batch_id)
+
+    assert asyncio.run(scenario()) == {"k1": "ONE", "k2": "TWO"}
+    assert batch_output(batch_input({"k": "x"}, "gpt-4o")) == {}  # requests are not results
+
+
+def test_summaries_are_made_level_by_level_in_batch_jobs(tmp_path, monkeypatch):
+    monkeypatch.setattr(openai_summarizer, "summary_cache", SummaryCache(str(tmp_path / "cache.sqlite3")))
+    submitted = []
+
+    class RecordingBackend(LocalBatchBackend):
+        async def submit(self, requests, model, max_tokens=None):
+            submitted.append(len(requests))
+            return await super().submit(requests, model, max_tokens)
+
+    backend = RecordingBackend(str(tmp_path / "batches"), respond=lambda prompt: prompt.splitlines()[-1].upper())
+
+    async def job(part):
+        first = await summarizer.get_cached_summary_from_ai("", f"batch test {part} first", {})
+        second = await summarizer.get_cached_summary_from_ai("", f"batch test {part} second", {})
+        return await summarizer.get_cached_summary_from_ai("", first + " + " + second, {})
+
+    jobs = [lambda: job("a"), lambda: job("b")]
+    results = asyncio.run(summarizer.summarize_in_batches(jobs, backend, poll_interval=0))
+
+    # The chunk summaries first, then the merges built on them
+    assert submitted == [4, 2]
+    assert results == ["BATCH TEST A FIRST + BATCH TEST A SECOND", "BATCH TEST B FIRST + BATCH TEST B SECOND"]
+    assert is_pending(pending_summary("k")) and not any(is_pending(result) for result in results)
+
+
+def test_summaries_cut_at_their_limit_are_not_cached(tmp_path, monkeypatch):
+    monkeypatch.setattr(openai_summarizer, "summary_cache", SummaryCache(str(tmp_path / "cache.sqlite3")))
+    calls = []
+
+    async def create_chat_completion(key, model, messages, max_tokens=None):
+        calls.append(model)
+        finish_reason = "length" if len(calls) == 1 else "stop"
+        return SimpleNamespace(choices=[SimpleNamespace(finish_reason=finish_reason, message=SimpleNamespace(content=f"summary {len(calls)}"))])
+
+    monkeypatch.setattr(openai_summarizer, "create_chat_completion", create_chat_completion)
+
+    async def scenario():
+        return [await summarizer.get_cached_summary_from_ai("", "truncation test", {}) for _ in range(3)]
+
+    assert asyncio.run(scenario()) == ["summary 1", "summary 2", "summary 2"]
+    assert len(calls) == 2
+
+
+def test_a_refused_summary_is_empty_and_not_cached(tmp_path, monkeypatch):
+    monkeypatch.setattr(openai_summarizer, "summary_cache", SummaryCache(str(tmp_path / "cache.sqlite3")))
+    calls = []
+
+    async def create_chat_completion(key, model, messages, max_tokens=None):
+        calls.append(model)
+        return SimpleNamespace(choices=[SimpleNamespace(finish_reason="content_filter", message=SimpleNamespace(content=None))])
+
+    monkeypatch.setattr(openai_summarizer, "create_chat_completion", create_chat_completion)
+
+    async def scenario():
+        return [await summarizer.get_cached_summary_from_ai("", "refusal test", {}) for _ in range(2)]
+
+    assert asyncio.run(scenario()) == ["", ""]
+    assert len(calls) == 2
@@ -0,0 +1,79 @@
+import asyncio
+import os
+import sys
+from datetime import datetime, timedelta
+from types import SimpleNamespace
+
+# Add the src directory to the Python path
+folder = os.path.abspath(os.path.join(os.path.dirname(__file__), '..', 'src'))
+sys.path.append(folder)
+
+import bucketed_summary
+import channel_packing
+from bucketed_summary import summarize_bucket, time_buckets
+from summary_cache import SummaryCache
+
+
+def test_time_buckets_are_aligned_and_cut_to_the_range():
+    start = datetime(2025, 3, 1, 15, 30)
+    end = datetime(2025, 3, 4, 9, 0)
+
+    buckets = time_buckets(start, end, timedelta(days=1), now=end)
+
+    assert buckets == [(start, datetime(2025, 3, 2), False),
+                       (datetime(2025, 3, 2), datetime(2025, 3, 3), True),
+                       (datetime(2025, 3, 3), datetime(2025, 3, 4), True),
+                       (datetime(2025, 3, 4), end, False)]
+
+
+def test_time_buckets_not_over_are_not_complete():
+    start = datetime(2025, 3, 1)
+
+    buckets = time_buckets(start, datetime(2025, 3, 3), timedelta(days=1), now=datetime(2025, 3, 1, 12))
+
+    assert [complete for _, _, complete in buckets] == [False, False]
+
+
+def test_complete_buckets_are_summarized_once(tmp_path, monkeypatch):
+    calls = []
+
+    async def summarize_channel_messages(channel, start, end, prior_start, ai_prompts):
+        calls.append(start)
+        return f"summary of {start.date()}"
+
+    monkeypatch.setattr(bucketed_summary, "summarize_channel_messages", summarize_channel_messages)
+    monkeypatch.setattr(bucketed_summary, "summary_cache", SummaryCache(str(tmp_path / "cache.sqlite3")))
+    channel = SimpleNamespace(id=1, name="general")
+    day = timedelta(days=1)
+
+    async def scenario():
+        for complete in (True, True, False):
+            summary = await summarize_bucket(channel, datetime(2025, 3, 2), datetime(2025, 3, 3), complete, day, day, {})
+            assert summary == "summary of 2025-03-02"
+
+    asyncio.run(scenario())
+    assert len(calls) == 2
+
+
+def test_quiet_channels_are_packed_when_bucketing_is_off(monkeypatch):
+    guild = SimpleNamespace(id=1, name="guild")
+    channels = [SimpleNamespace(id=index, name=f"c{index}", guild=guild) for index in (1, 2, 3)]
+    prompts = []
+
+    async def fetch_channel_messages(channel, start, end):
+        return [SimpleNamespace(id=10 + channel.id, guild=guild, channel=channel, content=f"hello from {channel.name}",
+                                author=SimpleNamespace(id=5, display_name="user"), mentions=[])]
+
+    async def get_cached_summary_from_ai(prior_context, messages, ai_prompts, final=True):
+        prompts.append(messages)
+        return "\n".join(f"=== Channel {number}: #c{number} ===\nsummary {number}" for number in (1, 2, 3))
+
+    monkeypatch.setattr(channel_packing, "fetch_channel_messages", fetch_channel_messages)
+    monkeypatch.setattr(channel_packing.summarizer, "get_cached_summary_from_ai", get_cached_summary_from_ai)
+    start = datetime(2025, 3, 1)
+
+    summaries = asyncio.run(bucketed_summary.summarize_channels_in_buckets(channels, start, start + timedelta(days=7),
+                                                                          start - timedelta(days=2), {}, None))
+
+    assert len(prompts) == 1
+    assert [summary.splitlines()[-1] for summary in summaries] == ["summary 1", "summary 2", "summary 3"]
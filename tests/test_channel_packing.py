@@ -0,0 +1,26 @@
+import os
+import sys
+from types import SimpleNamespace
+
+# Add the src directory to the Python path
+folder = os.path.abspath(os.path.join(os.path.dirname(__file__), '..', 'src'))
+sys.path.append(folder)
+
+from channel_packing import pack_channels, split_sections
+
+
+def test_pack_channels_fills_requests_and_keeps_channel_order():
+    channels = [(index, SimpleNamespace(name=f"c{index}"), [], size)
+                for index, size in enumerate([700, 300, 600, 200, 900])]
+
+    bins = pack_channels(channels, capacity=1000, max_channels=3)
+
+    assert [[item[0] for item in packed] for packed in bins] == [[4], [0, 1], [2, 3]]
+    assert all(sum(item[3] for item in packed) <= 1000 for packed in bins)
+
+
+def test_split_sections_tolerates_markdown_around_markers():
+    response = ("=== Channel 1: #general ===\n- **Robot** drives\n\n"
+                "### === Channel 2: #build ===\nNothing new\n")
+
+    assert split_sections(response) == {1: "- **Robot** drives", 2: "Nothing new"}
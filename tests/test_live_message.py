@@ -0,0 +1,41 @@
+import asyncio
+import os
+import sys
+
+# Add the src directory to the Python path
+folder = os.path.abspath(os.path.join(os.path.dirname(__file__), '..', 'src'))
+sys.path.append(folder)
+
+from live_message import LiveMessage
+
+
+class FakeMessage:
+    def __init__(self, content):
+        self.content = content
+        self.edits = 0
+
+    async def edit(self, content):
+        self.content = content
+        self.edits += 1
+
+
+def test_live_message_edits_at_a_throttled_cadence_and_rolls_over():
+    sent = []
+
+    async def send_message(content):
+        sent.append(FakeMessage(content))
+        return sent[-1]
+
+    async def scenario():
+        live_message = LiveMessage(send_message, interval=3600, size=20)
+        await live_message.update("one")
+        for text in ["one two", "one two three", "one two three four"]:
+            await live_message.update(text)
+        # Throttled: only the first update was shown
+        assert [message.content for message in sent] == ["one"]
+
+        await live_message.finish("one two three four five six")
+        assert [message.content for message in sent] == ["one two three four", "five six"]
+        assert sent[0].edits == 1
+
+    asyncio.run(scenario())
@@ -0,0 +1,39 @@
+import asyncio
+import os
+import sys
+
+# Add the src directory to the Python path
+folder = os.path.abspath(os.path.join(os.path.dirname(__file__), '..', 'src'))
+sys.path.append(folder)
+
+from map_reduce import map_reduce_summaries, group_summaries
+
+MODEL = {"name": "gpt-4o", "context_length": 128000}
+
+
+def test_map_reduce_merges_in_logarithmic_levels_and_keeps_order():
+    merges = []
+    finals = []
+
+    async def summarize_chunk(chunk, final=False):
+        return chunk.upper()
+
+    async def merge_summaries(summaries, final=False):
+        merges.append(len(summaries))
+        finals.append(final)
+        return "(" + " ".join(summaries) + ")"
+
+    chunks = [f"c{i}" for i in range(20)]
+    result = asyncio.run(map_reduce_summaries(chunks, summarize_chunk, merge_summaries, MODEL, fan_in=4))
+
+    # 20 summaries -> 5 -> 2 -> 1, the fifth summary of the second level has no neighbour to merge with
+    assert merges == [4, 4, 4, 4, 4, 4, 2]
+    assert finals == [False] * 6 + [True]
+    assert result.replace("(", "").replace(")", "").split() == [chunk.upper() for chunk in chunks]
+
+
+def test_group_summaries_respects_fan_in_and_budget():
+    summaries = ["a", "b", "c", "d", "e"]
+
+    assert group_summaries(summaries, [1] * 5, budget=100, fan_in=2) == [["a", "b"], ["c", "d"], ["e"]]
+    assert group_summaries(summaries, [50, 40, 90, 1, 1], budget=110, fan_in=8) == [["a", "b"], ["c", "d", "e"]]
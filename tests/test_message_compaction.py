@@ -0,0 +1,75 @@
+import os
+import sys
+from types import SimpleNamespace
+
+# Add the src directory to the Python path
+folder = os.path.abspath(os.path.join(os.path.dirname(__file__), '..', 'src'))
+sys.path.append(folder)
+
+from message_compaction import MessageCompactor
+
+
+def make_message(author, content, mentions=()):
+    return SimpleNamespace(author=SimpleNamespace(display_name=author), content=content, mentions=list(mentions))
+
+
+def test_compaction_aliases_authors_and_shortens_references():
+    carol = SimpleNamespace(id=223456789012345678, display_name="Carol the Robot Intake Mechanic")
+    messages = [
+        make_message("Bob the Builder of Brickton", "see https://docs.example.com/robot/intake/v2/design.pdf <:party:123456789012345678>"),
+        make_message("eve", "ping <@223456789012345678> about https://docs.example.com/robot/intake/v2/design.pdf", [carol]),
+        make_message("Bob the Builder of Brickton", "and <#323456789012345678> too"),
+    ]
+    compactor = MessageCompactor()
+
+    lines = compactor.compact(messages)
+
+    assert lines == ["[U1]: see [L1] :party:",
+                     "eve: ping @[U2] about [L1]",
+                     "[U1]: and [M1] too"]
+    assert "[U1] = Bob the Builder of Brickton" in compactor.legend()
+    assert compactor.expand("[U1] shared [L1] with [U2] in [M1]") == \
+        "Bob the Builder of Brickton shared https://docs.example.com/robot/intake/v2/design.pdf with Carol the Robot Intake Mechanic in <#323456789012345678>"
+
+
+def test_compaction_collapses_consecutive_duplicates():
+    messages = [make_message("eve", "spam"), make_message("eve", "spam"), make_message("eve", "spam"),
+                make_message("dan", "stop"), make_message("eve", "spam")]
+
+    lines = MessageCompactor().compact(messages)
+
+    assert lines == ["eve: spam (x3)", None, None, "dan: stop", "eve: spam"]
+
+
+def test_text_that_looks_like_an_alias_is_left_alone():
+    messages = [make_message("Bob the Builder of Brickton", "the u1 chip beats u2, see [U1]"),
+                make_message("Carol the Robot Intake Mechanic", "u1 it is")]
+    compactor = MessageCompactor()
+
+    lines = compactor.compact(messages)
+
+    assert lines == ["[U1]: the u1 chip beats u2, see [u1]", "[U2]: u1 it is"]
+    assert compactor.expand("[U1] prefers the u1 chip over u2, [U2] agrees on u1") == \
+        "Bob the Builder of Brickton prefers the u1 chip over u2, Carol the Robot Intake Mechanic agrees on u1"
+
+
+def test_text_that_looks_like_a_reference_is_left_alone():
+    messages = [make_message("eve", "see https://docs.example.com/robot/intake/v2/design.pdf"),
+                make_message("eve", "per footnote [L1] and array[M1]")]
+    compactor = MessageCompactor()
+
+    lines = compactor.compact(messages)
+
+    assert lines == ["eve: see [L1]", "eve: per footnote [l1] and array[m1]"]
+    assert compactor.expand("eve cites [L1] and footnote [l1]") == \
+        "eve cites https://docs.example.com/robot/intake/v2/design.pdf and footnote [l1]"
+
+
+def test_names_cheaper_than_an_alias_are_kept():
+    messages = [make_message("Christopher", "hi"), make_message("Bob the Builder of Brickton", "hello")]
+    compactor = MessageCompactor()
+
+    lines = compactor.compact(messages)
+
+    assert lines == ["Christopher: hi", "[U1]: hello"]
+    assert "Christopher" not in compactor.legend()
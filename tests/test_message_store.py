@@ -0,0 +1,127 @@
+import asyncio
+import os
+import sys
+import time
+from contextlib import aclosing
+from datetime import datetime, timedelta, timezone
+from types import SimpleNamespace
+
+# Add the src directory to the Python path
+folder = os.path.abspath(os.path.join(os.path.dirname(__file__), '..', 'src'))
+sys.path.append(folder)
+
+from ai_chunking import plan_chunks
+from constants import MODELS
+from message_store import MessageStore, covered_since, uncovered
+
+
+class FakeChannel:
+    def __init__(self, messages):
+        self.id = 7
+        self.guild = SimpleNamespace(id=1, name="guild")
+        self.messages = messages
+        self.fetches = []
+
+    async def history(self, after=None, before=None, limit=100):
+        self.fetches.append((after, before))
+        messages = [m for m in self.messages if (after is None or m.created_at > after) and (before is None or m.created_at < before)]
+        for message in (messages if after else reversed(messages)):
+            yield message
+
+
+def fake_messages(channel, count, now):
+    return [SimpleNamespace(id=100 + i, channel=channel, guild=channel.guild, author=SimpleNamespace(id=i % 2, display_name=f"user{i % 2}"),
+                            content=f"message {i}", mentions=[], created_at=now - timedelta(hours=count - i - 0.5))
+            for i in range(count)]
+
+
+def test_gaps_and_the_coverage_reaching_now():
+    intervals = [(10, 20), (15, 30), (40, 50)]
+
+    assert uncovered(intervals, 0, 60) == [(0, 10), (30, 40), (50, 60)]
+    assert uncovered(intervals, 12, 28) == []
+    assert covered_since([(10, 20), (20, 50), (60, 70)], 45) == 10
+    assert covered_since(intervals, 55) == 55
+
+
+def test_only_the_gaps_are_fetched_and_messages_come_with_their_tokens(tmp_path):
+    now = datetime.now(timezone.utc)
+    channel = FakeChannel([])
+    channel.messages = fake_messages(channel, 10, now)
+    store = MessageStore(str(tmp_path / "messages.sqlite3"), enabled=True)
+
+    async def scenario():
+        first = await store.fetch(channel, now - timedelta(hours=6), now)
+        again = await store.fetch(channel, now - timedelta(hours=6), now)
+        wider = await store.fetch(channel, now - timedelta(hours=12), now)
+        await store.edited(105, "edited")
+        await store.deleted([106])
+        return first, again, wider, await store.fetch(channel, now - timedelta(hours=12), now)
+
+    first, again, wider, changed = asyncio.run(scenario())
+
+    assert [m.id for m in first] == [m.id for m in again] == [104, 105, 106, 107, 108, 109]
+    assert len(wider) == 10 and len(channel.fetches) == 2  # the second fetch was only the earlier gap
+    assert [m.content for m in changed if m.id in (105, 106)] == ["edited"]
+
+    groups, _, _, in_token_count = plan_chunks(first, MODELS["GPT-4 Turbo (Omni)"])
+    assert in_token_count == sum(m.tokens for m in first) > 0
+
+
+def test_history_reads_the_live_messages_then_pages_back_through_discord(tmp_path):
+    now = datetime.now(timezone.utc)
+    channel = FakeChannel([])
+    channel.messages = fake_messages(channel, 6, now)
+    store = MessageStore(str(tmp_path / "messages.sqlite3"), enabled=True)
+
+    async def read(count):
+        history = []
+        async with aclosing(store.history(channel)) as messages:
+            async for message in messages:
+                history.append(message.id)
+                if len(history) == count:
+                    break
+        return history
+
+    async def scenario():
+        await store.connected([channel.guild])
+        session, _ = store.sessions[channel.guild.id]
+        store.sessions[channel.guild.id] = (session, time.time() - 2.5 * 3600)  # connected before the last two messages
+        for message in channel.messages[-2:]:
+            await store.received(message)
+        first = await read(4)
+        fetches = len(channel.fetches)
+        return first, fetches, await read(4)
+
+    first, fetches, second = asyncio.run(scenario())
+
+    assert first == second == [105, 104, 103, 102]
+    assert fetches == 1 and len(channel.fetches) == 1  # what the first read fetched was stored and covered
+
+
+def test_the_gateway_covers_a_channel_from_its_first_message_received(tmp_path):
+    now = datetime.now(timezone.utc)
+    channel = FakeChannel([])
+    channel.messages = fake_messages(channel, 6, now)
+    joined = FakeChannel([])
+    joined.id, joined.guild = 8, SimpleNamespace(id=2, name="joined later")
+    joined.messages = fake_messages(joined, 2, now)
+    store = MessageStore(str(tmp_path / "messages.sqlite3"), enabled=True)
+
+    async def scenario():
+        await store.connected([channel.guild])
+        session, _ = store.sessions[channel.guild.id]
+        store.sessions[channel.guild.id] = (session, time.time() - 10 * 3600)  # long before the messages
+        # The bot could only read the channel from its last message on
+        await store.received(channel.messages[-1])
+        before_access = await store.fetch(channel, now - timedelta(hours=6), now)
+        since_access = await store.fetch(channel, now - timedelta(hours=0.75), now)
+        await store.guild_joined(joined.guild)
+        return before_access, since_access, await store.fetch(joined, now - timedelta(hours=6), now)
+
+    before_access, since_access, in_joined_guild = asyncio.run(scenario())
+
+    assert [m.id for m in before_access] == [100, 101, 102, 103, 104, 105]
+    assert [m.id for m in since_access] == [105]
+    assert len(channel.fetches) == 1  # the gap before the first message received, not the time after it
+    assert len(in_joined_guild) == 2 and len(joined.fetches) == 1
@@ -0,0 +1,23 @@
+import os
+import sys
+
+# Add the src directory to the Python path
+folder = os.path.abspath(os.path.join(os.path.dirname(__file__), '..', 'src'))
+sys.path.append(folder)
+
+from constants import MODELS, ROUTING_MAX_TOKENS
+from model_routing import route_model
+
+
+def test_small_calls_before_the_final_one_go_to_the_cheaper_model():
+    model = MODELS["GPT-4 Turbo (Omni)"]
+
+    assert route_model(model, 3000)["name"] == "gpt-4o-mini"
+    assert route_model(model, 3000, final=True) is model
+    assert route_model(model, ROUTING_MAX_TOKENS + 1) is model
+
+
+def test_calls_are_not_routed_to_a_pricier_model():
+    model = MODELS["GPT-4o Mini"]
+
+    assert route_model(model, 3000) is model
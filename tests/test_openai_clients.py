@@ -0,0 +1,53 @@
+import asyncio
+import os
+import sys
+
+# Add the src directory to the Python path
+folder = os.path.abspath(os.path.join(os.path.dirname(__file__), '..', 'src'))
+sys.path.append(folder)
+
+import pytest
+from openai import RateLimitError
+
+import openai_clients
+from constants import AIMD_INITIAL_CONCURRENCY
+from openai_clients import openai_client, evict_clients, close_clients
+
+
+def test_clients_are_reused_per_key_and_evicted_when_unused():
+    async def scenario():
+        async with openai_client("sk-one") as first:
+            async with openai_client("sk-one") as again:
+                assert again is first
+            async with openai_client("sk-two") as second:
+                assert second is not first
+
+            # sk-one is still lent out, so only sk-two can be evicted
+            await evict_clients(idle_seconds=0, pool_size=0)
+            assert list(openai_clients._clients) == ["sk-one"]
+            assert second.is_closed()
+
+        await close_clients()
+        assert first.is_closed()
+
+    asyncio.run(scenario())
+
+
+def test_a_key_out_of_credit_fails_at_once():
+    calls = []
+
+    async def request(client):
+        calls.append(client)
+        response = openai_clients.httpx.Response(429, request=openai_clients.httpx.Request("POST", "https://api.openai.com/v1/chat/completions"))
+        raise RateLimitError("You exceeded your current quota", response=response,
+                             body={"code": "insufficient_quota", "type": "insufficient_quota"})
+
+    async def scenario():
+        with pytest.raises(RateLimitError):
+            await openai_clients.paced_call("sk-broke", "gpt-4o", [{"role": "user", "content": "hi"}], request)
+        await close_clients()
+
+    asyncio.run(scenario())
+    limiter = openai_clients.get_rate_limiter("sk-broke", "gpt-4o")
+    assert len(calls) == 1
+    assert limiter.concurrency.limit >= AIMD_INITIAL_CONCURRENCY
@@ -0,0 +1,29 @@
+import os
+import sys
+
+# Add the src directory to the Python path
+folder = os.path.abspath(os.path.join(os.path.dirname(__file__), '..', 'src'))
+sys.path.append(folder)
+
+from batch_api import batch_input
+from constants import MODELS, OUTPUT_TOKEN_MIN, OUTPUT_TOKEN_RESERVE
+from output_budget import output_token_cap
+
+
+def test_chunk_summaries_get_a_share_of_their_input_scaled_by_mode():
+    model = MODELS["GPT-4 Turbo (Omni)"]
+
+    assert output_token_cap(model, 100) == OUTPUT_TOKEN_MIN
+    assert output_token_cap(model, 10000) == 1500
+    assert output_token_cap(model, 10000, mode="brief") == 750
+    assert output_token_cap(model, 10000, mode="descriptive") == 3000
+    assert output_token_cap(model, 10000, final=True) == OUTPUT_TOKEN_RESERVE
+    assert output_token_cap(model, 10000, final=True, mode="brief") == OUTPUT_TOKEN_RESERVE // 2
+
+
+def test_chunk_summaries_fit_the_merge_that_follows():
+    model = {"name": "small", "context_length": 8000}
+
+    cap = output_token_cap(model, 6000, merge_tokens=500, fan_in=8)
+    assert 8 * cap <= 8000 - 500
+    assert '"max_tokens": 42' in batch_input({"k": "prompt"}, "gpt-4o", {"k": 42})
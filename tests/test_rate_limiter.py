@@ -0,0 +1,57 @@
+import asyncio
+import os
+import sys
+
+# Add the src directory to the Python path
+folder = os.path.abspath(os.path.join(os.path.dirname(__file__), '..', 'src'))
+sys.path.append(folder)
+
+from rate_limiter import AdaptiveConcurrency, RateLimiter, parse_duration
+
+
+def test_parse_duration():
+    assert parse_duration("6m0s") == 360
+    assert parse_duration("1.5s") == 1.5
+    assert parse_duration("20ms") == 0.02
+    assert parse_duration("") is None
+
+
+def test_limiter_paces_calls_from_the_headers():
+    limiter = RateLimiter()
+    limiter.update({"x-ratelimit-limit-requests": "600", "x-ratelimit-remaining-requests": "599",
+                    "x-ratelimit-limit-tokens": "60000", "x-ratelimit-remaining-tokens": "500"})
+    now = limiter.tokens.updated
+
+    assert limiter.requests.wait_time(1, now) == 0
+    assert limiter.tokens.wait_time(500, now) == 0
+    # 60000 tokens per minute refill 1000 tokens per second
+    assert limiter.tokens.wait_time(1500, now) == 1.0
+
+    asyncio.run(limiter.acquire(500))
+    assert limiter.tokens.available < 1
+
+
+def test_limiter_pauses_after_a_429():
+    limiter = RateLimiter()
+
+    assert limiter.pause({"retry-after-ms": "250"}) == 0.25
+    assert limiter.pause({"x-ratelimit-reset-tokens": "2s", "x-ratelimit-reset-requests": "1s"}) == 2
+
+
+def test_concurrency_grows_additively_and_is_cut_once_per_overload():
+    async def scenario():
+        concurrency = AdaptiveConcurrency(initial=4, maximum=8)
+        for _ in range(20):
+            started = [await concurrency.acquire() for _ in range(int(concurrency.limit))]
+            for start in started:
+                await concurrency.release(start)
+        assert concurrency.limit == 8
+
+        # Four calls fail with the same overload, the limit is only halved once
+        started = [await concurrency.acquire() for _ in range(4)]
+        for start in started:
+            await concurrency.release(start, overloaded=True)
+        assert concurrency.limit == 4
+        assert concurrency.in_flight == 0
+
+    asyncio.run(scenario())
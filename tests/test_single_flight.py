@@ -0,0 +1,73 @@
+import asyncio
+import os
+import sys
+
+# Add the src directory to the Python path
+folder = os.path.abspath(os.path.join(os.path.dirname(__file__), '..', 'src'))
+sys.path.append(folder)
+
+from single_flight import SingleFlight
+
+
+def test_identical_calls_in_flight_are_made_once():
+    calls = []
+
+    async def summarize(text):
+        calls.append(text)
+        await asyncio.sleep(0.01)
+        return text.upper()
+
+    async def scenario():
+        single_flight = SingleFlight()
+        results = await asyncio.gather(single_flight.do("k", summarize, "a"),
+                                       single_flight.do("k", summarize, "a"),
+                                       single_flight.do("other", summarize, "b"))
+        assert results == ["A", "A", "B"]
+        assert calls == ["a", "b"]
+        assert single_flight.calls == {}
+
+        # Done calls are forgotten
+        assert await single_flight.do("k", summarize, "a") == "A"
+        assert calls == ["a", "b", "a"]
+
+    asyncio.run(scenario())
+
+
+def test_a_cancelled_caller_does_not_cancel_the_shared_call():
+    async def summarize():
+        await asyncio.sleep(0.01)
+        return "done"
+
+    async def scenario():
+        single_flight = SingleFlight()
+        first = asyncio.ensure_future(single_flight.do("k", summarize))
+        second = asyncio.ensure_future(single_flight.do("k", summarize))
+        await asyncio.sleep(0)
+        first.cancel()
+        assert await second == "done"
+
+    asyncio.run(scenario())
+
+
+def test_a_call_is_cancelled_with_its_last_caller():
+    cancelled = []
+
+    async def summarize():
+        try:
+            await asyncio.sleep(1)
+        except asyncio.CancelledError:
+            cancelled.append(True)
+            raise
+
+    async def scenario():
+        single_flight = SingleFlight()
+        callers = [asyncio.ensure_future(single_flight.do("k", summarize)) for _ in range(2)]
+        await asyncio.sleep(0)
+        for caller in callers:
+            caller.cancel()
+        await asyncio.gather(*callers, return_exceptions=True)
+        await asyncio.sleep(0)
+        assert cancelled == [True]
+        assert single_flight.calls == {} and single_flight.waiters == {}
+
+    asyncio.run(scenario())
@@ -0,0 +1,59 @@
+import asyncio
+import os
+import sys
+from types import SimpleNamespace
+
+# Add the src directory to the Python path
+folder = os.path.abspath(os.path.join(os.path.dirname(__file__), '..', 'src'))
+sys.path.append(folder)
+
+import summary
+from constants import LESS_MESSAGES
+
+
+def test_messages_without_text_get_an_answer_instead_of_a_summary(monkeypatch):
+    user = {"modes": {"standard": "Summarize."}, "model": "GPT-4 Turbo (Omni)", "language": "English", "in_token_count": 0}
+    sent = []
+
+    async def followup_send(message, **kwargs):
+        sent.append(message)
+
+    async def api_key(*args):
+        return "sk-test"
+
+    async def no_thread(*args):
+        return False
+
+    monkeypatch.setattr(summary, "setup_user", lambda *args: (user, {"in_token_count": 0}))
+    monkeypatch.setattr(summary, "use_a_thread", no_thread)
+    monkeypatch.setattr(summary, "get_api_key", api_key)
+    ctx = SimpleNamespace(guild=SimpleNamespace(id=1, name="guild"), author="someone",
+                          followup=SimpleNamespace(send=followup_send))
+    attachments = [SimpleNamespace(id=i, author=SimpleNamespace(id=2, display_name="user"), content="", mentions=[])
+                   for i in range(3)]
+
+    asyncio.run(summary.send_summary(ctx, attachments, "standard"))
+
+    assert sent == [LESS_MESSAGES]
+    assert user["in_token_count"] == 0
+
+
+def test_output_tokens_are_counted_by_the_model_that_made_them(monkeypatch):
+    user = {"out_token_count": 0, "out_token_counts": {}}
+    server = {"out_token_count": 0, "out_token_counts": {}}
+    counted = []
+
+    def get_tokens(text, model_name):
+        counted.append(model_name)
+        return len(text.split())
+
+    monkeypatch.setattr(summary, "get_tokens", get_tokens)
+    monkeypatch.setattr(summary, "set_user", lambda *args: None)
+    monkeypatch.setattr(summary, "set_server", lambda *args: None)
+    ctx = SimpleNamespace(guild=SimpleNamespace(id=1, name="guild"), author="someone")
+
+    summary.update_output_token_counts([("gpt-4o-mini", "a chunk summary"), ("gpt-4o-mini", "another one"),
+                                        ("gpt-4o", "the final summary here")], user, server, ctx)
+
+    assert counted == ["gpt-4o-mini", "gpt-4o-mini", "gpt-4o"]
+    assert user == server == {"out_token_count": 9, "out_token_counts": {"gpt-4o-mini": 5, "gpt-4o": 4}}
@@ -0,0 +1,46 @@
+import asyncio
+import os
+import sys
+import time
+
+# Add the src directory to the Python path
+folder = os.path.abspath(os.path.join(os.path.dirname(__file__), '..', 'src'))
+sys.path.append(folder)
+
+from summary_cache import SummaryCache, cache_key
+
+
+def test_cache_persists_across_instances_and_counts_hits(tmp_path):
+    path = str(tmp_path / "cache" / "summaries.sqlite3")
+    key = cache_key("gpt-4o", "prompt")
+
+    async def scenario():
+        cache = SummaryCache(path)
+        assert await cache.get(key) is None
+        await cache.set(key, "summary")
+
+        reopened = SummaryCache(path)
+        assert await reopened.get(key) == "summary"
+        assert cache.stats() == {"hits": 0, "misses": 1}
+        assert reopened.stats() == {"hits": 1, "misses": 0}
+
+    asyncio.run(scenario())
+    assert key != cache_key("gpt-4o-mini", "prompt")
+
+
+def test_cache_expires_and_evicts_least_recently_used(tmp_path):
+    async def scenario():
+        cache = SummaryCache(str(tmp_path / "summaries.sqlite3"), ttl=60, max_entries=2)
+        for key in ["a", "b", "c"]:
+            await cache.set(key, key.upper())
+        await cache.get("a")
+        cache._evict(cache.connection, time.time())
+
+        assert await cache.get("a") == "A"
+        assert await cache.get("b") is None
+        assert await cache.get("c") == "C"
+
+        cache._evict(cache.connection, time.time() + 120)
+        assert await cache.get("a") is None
+
+    asyncio.run(scenario())
@@ -0,0 +1,52 @@
+import asyncio
+import os
+import sys
+
+import pytest
+
+# Add the src directory to the Python path
+folder = os.path.abspath(os.path.join(os.path.dirname(__file__), '..', 'src'))
+sys.path.append(folder)
+
+from map_reduce import gather_or_cancel
+from summary_runs import SummaryCancelled, run_cancellable
+
+
+def test_a_new_run_cancels_the_previous_one_and_its_calls():
+    cancelled = []
+
+    async def call(name):
+        try:
+            await asyncio.sleep(1)
+        except asyncio.CancelledError:
+            cancelled.append(name)
+            raise
+        return name
+
+    async def scenario():
+        first = asyncio.ensure_future(run_cancellable("user", gather_or_cancel(call("a"), call("b"))))
+        await asyncio.sleep(0.01)
+        second = await run_cancellable("user", asyncio.sleep(0, result="done"))
+        with pytest.raises(SummaryCancelled):
+            await first
+        return second
+
+    assert asyncio.run(scenario()) == "done"
+    assert sorted(cancelled) == ["a", "b"]
+
+
+def test_a_failing_call_cancels_the_others_and_a_slow_run_times_out():
+    async def fail():
+        raise ValueError("doomed")
+
+    async def scenario():
+        slow = asyncio.ensure_future(asyncio.sleep(1))
+        with pytest.raises(ValueError):
+            await gather_or_cancel(fail(), slow)
+        await asyncio.sleep(0)
+        assert slow.cancelled()
+
+        with pytest.raises(SummaryCancelled):
+            await run_cancellable("user", asyncio.sleep(1), timeout=0.01)
+
+    asyncio.run(scenario())
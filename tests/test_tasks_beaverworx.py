@@ -78,4 +78,48 @@ def test_save_and_load_task_list(task_list):
     new_task_list.load_task_list()
 
     # Verify the loaded periods
-    assert new_task_list.periods == [(now, future_time_1), (now, future_time_2)]
\ No newline at end of file
+    assert new_task_list.periods == [(now, future_time_1), (now, future_time_2)]
+
+def test_batched_jobs_are_delivered_like_live_ones_and_fetch_history_once(task_list, tmp_path, monkeypatch):
+    import asyncio
+    from types import SimpleNamespace
+    import history
+    import task_list as task_list_module
+
+    me = SimpleNamespace(id=9, _state=SimpleNamespace(_get_client=lambda: None))
+    me.guild = SimpleNamespace(me=me)
+    fetches = []
+
+    async def channel_history(after=None, before=None):
+        fetches.append((after, before))
+        yield SimpleNamespace(author=SimpleNamespace(id=1), content="hello")
+
+    channel = SimpleNamespace(id=1, guild=SimpleNamespace(me=me), history=channel_history)
+
+    async def summary_from_payload(diagnostic_channel_id, payload):
+        start = datetime.strptime(payload["starttime_to_summarize"], '%Y-%m-%d %H:%M:%S')
+        messages = await history.fetch_channel_messages(channel, start, start + timedelta(days=1))
+        return f"{len(messages)} messages"
+
+    async def summarize_in_batches(jobs, backend):
+        # A chunk level, then a merge level reading the same histories again
+        for job in jobs:
+            await job()
+        return [await job() for job in jobs]
+
+    delivered = []
+    monkeypatch.setattr(task_list_module, "summary_from_payload", summary_from_payload)
+    monkeypatch.setattr(task_list_module.summarizer, "summarize_in_batches", summarize_in_batches)
+    monkeypatch.setattr(task_list_module, "deliver_summary",
+                        lambda result, payload: delivered.append(payload) or f"Summary for document {payload['document_id']}:\n{result}")
+    task_list.SUMMARY_DIR = str(tmp_path)
+    payloads = [dict(task_list.default_payload, starttime_to_summarize=f"2025-01-0{day} 00:00:00",
+                     endtime_to_summarize=f"2025-01-0{day + 1} 00:00:00", document_id=f"day{day}") for day in (1, 2)]
+
+    asyncio.run(task_list.perform_jobs_in_batches(payloads, backend=None))
+
+    assert len(fetches) == 2
+    assert [payload["document_id"] for payload in delivered] == ["day1", "day2"]
+    assert all("bot_webhook_server" not in payload for payload in delivered)
+    with open(tmp_path / "2025-01-01_2025-01-02.md", encoding="utf-8") as file:
+        assert file.read() == "Summary for document day1:\n1 messages"